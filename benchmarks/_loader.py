@@ -0,0 +1,35 @@
+'''Load plugin modules outside of RotorHazard'''
+
+import importlib
+import os
+import sys
+import types
+
+PLUGIN_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                          'custom_plugins', 'vrx_cv2')
+
+def load_module(name):
+    """Import vrx_cv2.<name> without running the plugin's __init__
+
+    The plugin package imports RotorHazard's server modules, which are not
+    needed by the standalone modules (topics, payloads, emulator).
+    """
+    if 'vrx_cv2' not in sys.modules:
+        package = types.ModuleType('vrx_cv2')
+        package.__path__ = [PLUGIN_DIR]
+        sys.modules['vrx_cv2'] = package
+    return importlib.import_module('vrx_cv2.' + name)
+
+def load_plugin(rh_server):
+    """Import the whole plugin package, with RotorHazard's server modules taken from rh_server
+
+    Needs RotorHazard's dependencies and clearview installed. Call it before
+    load_module, which otherwise stands in an empty package.
+    """
+    package = sys.modules.get('vrx_cv2')
+    if package is not None and not hasattr(package, 'CV2Controller'):
+        raise RuntimeError("load_plugin must be called before load_module")
+    for path in (rh_server, os.path.dirname(PLUGIN_DIR)):
+        if path not in sys.path:
+            sys.path.insert(0, path)
+    return importlib.import_module('vrx_cv2')
@@ -0,0 +1,41 @@
+'''Latency and throughput summaries shared by the benchmarks'''
+
+import time
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+def summarize(latencies_s, total_s, calls=None):
+    """Per-call latency percentiles in microseconds and calls per second"""
+    latencies = sorted(latencies_s)
+    calls = len(latencies) if calls is None else calls
+    to_us = lambda value: None if value is None else round(value * 1e6, 2)
+    return {
+        'calls': calls,
+        'per_s': round(calls / total_s, 1) if total_s > 0 else None,
+        'mean_us': to_us(sum(latencies) / len(latencies)) if latencies else None,
+        'p50_us': to_us(percentile(latencies, 0.50)),
+        'p90_us': to_us(percentile(latencies, 0.90)),
+        'p99_us': to_us(percentile(latencies, 0.99)),
+        'max_us': to_us(latencies[-1]) if latencies else None,
+    }
+
+def time_calls(fn, args_list, every=None, between=None):
+    """Call fn(*args) for each args; returns (latencies, total seconds)
+
+    between(), if given, is called after every `every` calls, e.g. to let a
+    send queue catch up. It counts towards the total but not the latencies.
+    """
+    latencies = []
+    clock = time.perf_counter
+    start = clock()
+    for n, args in enumerate(args_list, 1):
+        call_start = clock()
+        fn(*args)
+        latencies.append(clock() - call_start)
+        if between is not None and n % every == 0:
+            between()
+    return latencies, clock() - start
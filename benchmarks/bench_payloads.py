@@ -0,0 +1,50 @@
+'''OSD user_msg encoding: json.dumps vs. esp_payloads.encode_user_msg'''
+
+import argparse
+import json
+import timeit
+
+from _loader import load_module
+
+esp_payloads = load_module('esp_payloads')
+
+# Messages in the shape onRaceLapRecorded and onHeatSet send
+MESSAGES = [
+    "P1 L3 0:21.337 | +0:00.512 Sparky",
+    "P4 L12 1:02.004 | -0:01.250 NightHawk",
+    "Sparky | Heat 3 | Round 2",
+    "Zoë | Arm now",
+    "Jürgen_FPV | Heat 1 | Round 1",
+    "P2 L5 0:19.870 | +0:00.033 Łukasz",
+    "P1 HS 0:03.120 | Leader Best Lap",
+    "小龙 | Heat 2 | Round 3",
+    "P3 L7 0:25.100 | +0:02.000 \"Quote\" Pilot",
+    "🚁 Rotor 🚁 | Arm now",
+]
+
+def dumps_path(message):
+    # What the seat classes did before: json.dumps, then paho encodes the str
+    return json.dumps({"user_msg" : message}).encode('utf-8')
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("-n", "--number", type=int, default=20000,
+                        help="passes over the message set per timing run")
+    args = parser.parse_args()
+
+    for message in MESSAGES:
+        assert esp_payloads.encode_user_msg(message) == dumps_path(message), message
+
+    for name, encode in [("json.dumps", dumps_path), ("encode_user_msg", esp_payloads.encode_user_msg)]:
+        best = min(timeit.repeat(lambda: [encode(m) for m in MESSAGES], number=args.number, repeat=5))
+        print("%-16s %8.1f ns/message" % (name, best / (args.number * len(MESSAGES)) * 1e9))
+
+    ascii_only = [m for m in MESSAGES if m.isascii()]
+    non_ascii = [m for m in MESSAGES if not m.isascii()]
+    for label, subset in [("ASCII", ascii_only), ("non-ASCII", non_ascii)]:
+        for name, encode in [("json.dumps", dumps_path), ("encode_user_msg", esp_payloads.encode_user_msg)]:
+            best = min(timeit.repeat(lambda: [encode(m) for m in subset], number=args.number, repeat=5))
+            print("%-10s %-16s %8.1f ns/message" % (label, name, best / (args.number * len(subset)) * 1e9))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,133 @@
+'''Broker round trips and in-flight saturation for each publish policy
+
+Publishes a burst of each command type to a running broker, using the QoS
+from PUBLISH_POLICY and, for comparison, the QoS 1 every command used to be
+sent with. Reports the time from publish() to paho's on_publish callback
+(the PUBACK round trip for QoS 1, the socket write for QoS 0) and how long the
+number of unacknowledged messages sat at paho's in-flight limit.
+
+Requires paho-mqtt and a broker, e.g. `mosquitto -p 1883`.
+'''
+
+import argparse
+import statistics
+import threading
+import time
+
+import paho.mqtt.client as mqtt_client
+
+from _loader import load_module
+
+publish_policy = load_module('publish_policy')
+esp_payloads = load_module('esp_payloads')
+
+# A representative payload for each command type
+PAYLOADS = {
+    publish_policy.CMD_USER_MSG: esp_payloads.encode_user_msg("P2 L5 0:19.870 | +0:00.033 Sparky"),
+    publish_policy.CMD_OSD_VISIBILITY: esp_payloads.OSD_VISIBILITY_OFF,
+    publish_policy.CMD_LOCK_QUERY: esp_payloads.REQUEST_LOCK,
+    publish_policy.CMD_LOCK_RESET: esp_payloads.RESET_LOCK,
+    publish_policy.CMD_STATUS_REQUEST: esp_payloads.REQUEST_VARIABLE_STATUS,
+    publish_policy.CMD_SEAT: esp_payloads.encode_command({"seat": "3"}),
+    publish_policy.CMD_FREQUENCY: esp_payloads.encode_command({"bc": "R1"}),
+    publish_policy.CMD_WIFI: esp_payloads.encode_command({"wifi": "1"}),
+}
+
+TOPIC = "rx/cv1/cmd_esp_seat/0"
+
+class Run:
+    def __init__(self, count, max_inflight):
+        self.count = count
+        self.max_inflight = max_inflight
+        self.sent_at = {}
+        self.early = {}
+        self.latencies = []
+        self.outstanding = 0
+        self.saturated_since = None
+        self.saturated_time = 0.0
+        self.max_outstanding = 0
+        self.lock = threading.Lock()
+        self.done = threading.Event()
+
+    def on_send(self, mid, sent_at):
+        with self.lock:
+            acked_at = self.early.pop(mid, None)
+            if acked_at is not None:
+                # paho's network thread got there first
+                self._complete(acked_at - sent_at)
+                return
+            self.sent_at[mid] = sent_at
+            self.outstanding += 1
+            self.max_outstanding = max(self.max_outstanding, self.outstanding)
+            if self.outstanding >= self.max_inflight and self.saturated_since is None:
+                self.saturated_since = time.perf_counter()
+
+    def on_publish(self, _client, _userdata, mid):
+        now = time.perf_counter()
+        with self.lock:
+            sent_at = self.sent_at.pop(mid, None)
+            if sent_at is None:
+                self.early[mid] = now
+                return
+            self.outstanding -= 1
+            if self.saturated_since is not None and self.outstanding < self.max_inflight:
+                self.saturated_time += now - self.saturated_since
+                self.saturated_since = None
+            self._complete(now - sent_at)
+
+    def _complete(self, latency):
+        self.latencies.append(latency)
+        if len(self.latencies) == self.count:
+            self.done.set()
+
+def run_burst(client, run, payload, qos):
+    client.on_publish = run.on_publish
+    start = time.perf_counter()
+    for _ in range(run.count):
+        sent_at = time.perf_counter()
+        info = client.publish(TOPIC, payload, qos)
+        run.on_send(info.mid, sent_at)
+    run.done.wait(timeout=30)
+    return time.perf_counter() - start
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("-a", "--address", default="localhost", help="mqtt broker ip address or hostname")
+    parser.add_argument("-p", "--port", type=int, default=1883)
+    parser.add_argument("-n", "--count", type=int, default=2000, help="messages per burst")
+    parser.add_argument("--max-inflight", type=int, default=20, help="paho max_inflight_messages")
+    args = parser.parse_args()
+
+    client = mqtt_client.Client(client_id="VRxQoSBenchmark", clean_session=True)
+    client.max_inflight_messages_set(args.max_inflight)
+    client.connect(args.address, args.port)
+    client.loop_start()
+    time.sleep(0.5)
+
+    print("%-16s %-6s %4s %10s %10s %10s %10s %12s" % (
+        "command", "policy", "qos", "msg/s", "p50 ms", "p99 ms", "max out", "saturated %"))
+    try:
+        for command, policy in publish_policy.PUBLISH_POLICY.items():
+            for label, qos in [("table", policy.qos), ("qos1", 1)]:
+                run = Run(args.count, args.max_inflight)
+                elapsed = run_burst(client, run, PAYLOADS[command], qos)
+                if not run.latencies:
+                    print("%-16s %-6s %4d  no acknowledgements" % (command, label, qos))
+                    continue
+                print("%-16s %-6s %4d %10.0f %10.3f %10.3f %10d %12.1f" % (
+                    command, label, qos,
+                    len(run.latencies) / elapsed,
+                    statistics.median(run.latencies) * 1000,
+                    percentile(run.latencies, 0.99) * 1000,
+                    run.max_outstanding,
+                    run.saturated_time / elapsed * 100))
+    finally:
+        client.loop_stop()
+        client.disconnect()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,102 @@
+'''Plugin startup time with and without a reachable broker
+
+Repeats the MQTT part of CV2Controller.onStartup (create the client, start
+its loop and the publish queue, queue the startup commands for each seat)
+and reports how long it takes to return, which is how long RotorHazard's
+startup is held up. With a reachable broker it also reports how long until
+the queued commands have been handed to paho.
+
+The blocking connect is the old behaviour; with no broker it never returns,
+so it is reported as exceeding --timeout.
+
+Requires gevent, paho-mqtt and monotonic. The reachable case needs a broker,
+e.g. `mosquitto -p 1883`; the unreachable case uses a port nothing listens on.
+'''
+
+from gevent import monkey
+monkey.patch_all()
+
+import argparse
+import time
+
+import gevent
+
+from _loader import load_module
+
+emulator = load_module('VRxCV1_emulator')
+publish_policy = load_module('publish_policy')
+publish_scheduler = load_module('publish_scheduler')
+esp_payloads = load_module('esp_payloads')
+mqtt_topics = load_module('mqtt_topics')
+
+NUM_SEATS = 8
+
+def startup(address, port, connect_async):
+    """Returns (seconds until startup returned, client, publish scheduler)"""
+    start = time.perf_counter()
+    client = emulator.MQTT_Client(client_id="VRxStartupBenchmark",
+                                  broker_ip=address,
+                                  broker_port=port,
+                                  subscribe_topics=None,
+                                  connect_async=connect_async)
+    publisher = publish_scheduler.PublishScheduler(client)
+    topics = mqtt_topics.TopicRegistry("cv1")
+    connection_topic = topics.subscriptions["receiver_connection"]
+    client.message_callback_add(connection_topic, lambda *_args: None)
+    client.subscribe(connection_topic)
+    client.loop_start()
+    publisher.start()
+
+    publisher.publish(topics.esp_all, esp_payloads.RESET_LOCK, publish_policy.CMD_LOCK_RESET)
+    publisher.publish(topics.esp_all, esp_payloads.REQUEST_STATIC_STATUS, publish_policy.CMD_STATUS_REQUEST)
+    publisher.publish(topics.esp_all, esp_payloads.OSD_VISIBILITY_OFF, publish_policy.CMD_OSD_VISIBILITY)
+    for seat in range(NUM_SEATS):
+        seat_topic = topics.esp_seat[seat]
+        publisher.publish(seat_topic, esp_payloads.REQUEST_LOCK, publish_policy.CMD_LOCK_QUERY)
+        publisher.publish(seat_topic, esp_payloads.encode_command({"bc": "R%d" % (seat + 1)}),
+                          publish_policy.CMD_FREQUENCY)
+    return time.perf_counter() - start, client, publisher
+
+def measure(label, address, port, connect_async, timeout):
+    start = time.perf_counter()
+    job = gevent.spawn(startup, address, port, connect_async)
+    job.join(timeout)
+    if not job.ready():
+        job.kill(block=False)
+        print("%-28s %14s %14s" % (label, "> %.0f s" % timeout, "-"))
+        return
+
+    returned, client, publisher = job.value
+    flushed = "-"
+    if publisher.drain(timeout):
+        if client.is_connected():
+            flushed = "%.1f" % ((time.perf_counter() - start) * 1000)
+    print("%-28s %14.1f %14s" % (label, returned * 1000, flushed))
+    teardown(client, publisher)
+
+def teardown(client, publisher):
+    """Stop everything a case started, so an async connect doesn't keep retrying into later cases"""
+    publisher.stop()
+    client.loop_stop()
+    client._client.disconnect()
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("-a", "--address", default="localhost", help="mqtt broker ip address or hostname")
+    parser.add_argument("-p", "--port", type=int, default=1883)
+    parser.add_argument("--closed-port", type=int, default=1, help="port with no broker behind it")
+    parser.add_argument("--timeout", type=float, default=10.0, help="give up on a case after this many seconds")
+    parser.add_argument("--skip-broker", action="store_true", help="only run the unreachable broker cases")
+    args = parser.parse_args()
+
+    print("%-28s %14s %14s" % ("case", "startup ms", "flushed ms"))
+    cases = [("no broker, blocking", args.address, args.closed_port, False),
+             ("no broker, async", args.address, args.closed_port, True)]
+    if not args.skip_broker:
+        cases += [("broker, blocking", args.address, args.port, False),
+                  ("broker, async", args.address, args.port, True)]
+    for label, address, port, connect_async in cases:
+        measure(label, address, port, connect_async, args.timeout)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,336 @@
+'''Publish path and response decoding benchmarks against an in-process broker
+
+Every case runs against FakeBroker, so no Mosquitto is needed, and reports
+calls per second and per-call latency percentiles. Results can be written
+to a JSON file and compared with an earlier run to spot regressions:
+
+    python bench_suite.py --output before.json
+    (change something)
+    python bench_suite.py --output after.json --compare before.json
+
+Cases on MQTT_Client, PublishScheduler, ResponseDecoder and status fan-out
+need only paho-mqtt, gevent and monotonic. Cases on VRxSeat and
+CV2Controller (set_message_direct, onRaceLapRecorded, onHeatSet,
+on_message_resp_targeted) import the whole plugin, so they need a RotorHazard
+checkout (--rh-server path/to/RotorHazard/src/server), its dependencies and
+clearview; they are skipped without --rh-server.
+'''
+
+from gevent import monkey
+monkey.patch_all()
+
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+import types
+
+import gevent
+
+import _loader
+from _timing import summarize, time_calls
+from fake_broker import FakeBroker, FakeReceiver
+
+CASES = []
+
+def case(name, needs_rh=False):
+    def register(fn):
+        CASES.append((name, needs_rh, fn))
+        return fn
+    return register
+
+def modules(*names):
+    return [_loader.load_module(name) for name in names]
+
+# Calls between letting the send queue catch up, like a burst of laps across every seat
+BURST = 8
+
+def catch_up(publisher, depth=BURST):
+    """Let the publish queue drain below depth, as it does between bursts in a race"""
+    def wait():
+        while publisher.depth > depth:
+            gevent.sleep(0)
+    return wait
+
+##############
+## Standalone
+##############
+
+@case("mqtt_client.publish")
+def bench_mqtt_client_publish(args, _plugin):
+    emulator, esp_payloads = modules('VRxCV1_emulator', 'esp_payloads')
+    broker = FakeBroker()
+    client = emulator.MQTT_Client(client_id="VRxBenchmark", broker_ip="fake", subscribe_topics=None,
+                                  client_factory=broker.client_factory)
+    client._client.loop_start()
+    payload = esp_payloads.encode_user_msg("P1 L3 0:21.345 | +0:00.450 Pilot2")
+    calls = [("rx/cv1/cmd_esp_seat/%d" % (n % 8), payload) for n in range(args.calls)]
+    latencies, total = time_calls(client.publish, calls)
+    broker.pump()
+    return summarize(latencies, total)
+
+@case("publish_scheduler.user_msg")
+def bench_publish_scheduler(args, _plugin):
+    emulator, publish_scheduler, publish_policy, esp_payloads = modules(
+        'VRxCV1_emulator', 'publish_scheduler', 'publish_policy', 'esp_payloads')
+    broker = FakeBroker()
+    broker.start()
+    client = emulator.MQTT_Client(client_id="VRxBenchmark", broker_ip="fake", subscribe_topics=None,
+                                  client_factory=broker.client_factory)
+    client._client.loop_start()
+    publisher = publish_scheduler.PublishScheduler(client)
+    publisher.start()
+
+    payload = esp_payloads.encode_user_msg("P1 L3 0:21.345 | +0:00.450 Pilot2")
+    calls = [("rx/cv1/cmd_esp_seat/%d" % (n % 8), payload, publish_policy.CMD_USER_MSG) for n in range(args.calls)]
+    start = time.perf_counter()
+    latencies, _enqueued = time_calls(publisher.publish, calls, BURST, catch_up(publisher))
+    publisher.drain(30)
+    result = summarize(latencies, time.perf_counter() - start)
+    result['published'] = broker.published
+    publisher.stop()
+    broker.stop()
+    return result
+
+@case("response_decoder.variable_status")
+def bench_response_decoder(args, _plugin):
+    response_decoder, = modules('response_decoder')
+    decoder = response_decoder.ResponseDecoder()
+    device = types.SimpleNamespace(id="CV-BENCH", name=None, address=None, video_lock=None,
+                                   map=types.SimpleNamespace(seat=None), extended_properties={})
+    payloads = [json.dumps({"seat": str(n % 8), "device_name": "CV-BENCH", "video_format": "N",
+                            "ip_addr": "10.0.0.%d" % (n % 200 + 1)}).encode('ascii') for n in range(64)]
+
+    def decode(payload):
+        decoder.apply(device, decoder.decode(payload))
+
+    calls = [(payloads[n % len(payloads)],) for n in range(args.calls)]
+    latencies, total = time_calls(decode, calls)
+    result = summarize(latencies, total)
+    result['json_backend'] = response_decoder.JSON_BACKEND
+    return result
+
+@case("status_fanout")
+def bench_status_fanout(args, _plugin):
+    """One variable status request to every receiver, until every answer is decoded"""
+    emulator, response_decoder, esp_payloads, mqtt_topics = modules(
+        'VRxCV1_emulator', 'response_decoder', 'esp_payloads', 'mqtt_topics')
+    broker = FakeBroker()
+    topics = mqtt_topics.TopicRegistry("cv1")
+    for n in range(args.receivers):
+        FakeReceiver(broker, "CV-BENCH-%04d" % n, n % 8)
+    broker.pump()
+
+    decoder = response_decoder.ResponseDecoder()
+    answers = []
+    controller = emulator.MQTT_Client(client_id="VRxBenchmark", broker_ip="fake", subscribe_topics=None,
+                                      client_factory=broker.client_factory)
+    controller._client.loop_start()
+    controller.message_callback_add(topics.subscriptions["receiver_response_targeted"],
+                                    lambda _client, _userdata, message: answers.append(decoder.decode(message.payload)))
+    controller.subscribe(topics.subscriptions["receiver_response_targeted"])
+
+    def fan_out():
+        del answers[:]
+        controller.publish(topics.esp_all, esp_payloads.REQUEST_VARIABLE_STATUS)
+        broker.pump()
+        if len(answers) != args.receivers:
+            raise RuntimeError("%d of %d receivers answered" % (len(answers), args.receivers))
+
+    fan_out()   # warm the broker's routes
+    rounds = max(1, args.calls // args.receivers)
+    latencies, total = time_calls(fan_out, [()] * rounds)
+    result = summarize(latencies, total)
+    result['receivers'] = args.receivers
+    result['answers_per_s'] = round(rounds * args.receivers / total, 1)
+    return result
+
+#####################
+## Needs RotorHazard
+#####################
+
+def start_controller(plugin, **config):
+    import rh_standins #pylint: disable=import-outside-toplevel
+    broker = FakeBroker()
+    broker.start()
+    controller, racecontext, events = rh_standins.make_controller(plugin, broker, config=config)
+    controller._publisher.drain(10)
+    return broker, controller, racecontext
+
+def stop_controller(broker, controller):
+    controller.onShutdown({})
+    broker.stop()
+
+def publish_result(broker, controller, latencies, start):
+    controller._publisher.drain(30)
+    result = summarize(latencies, time.perf_counter() - start)
+    result['published'] = broker.published
+    return result
+
+@case("seat.set_message_direct", needs_rh=True)
+def bench_seat_message(args, plugin):
+    broker, controller, _racecontext = start_controller(plugin)
+    published = broker.published
+    seat = controller._seats[0]
+    calls = [("P1 L%d 0:21.%03d" % (n, n % 1000),) for n in range(args.calls)]
+    start = time.perf_counter()
+    latencies, _total = time_calls(seat.set_message_direct, calls, BURST, catch_up(controller._publisher))
+    result = publish_result(broker, controller, latencies, start)
+    result['published'] -= published
+    stop_controller(broker, controller)
+    return result
+
+@case("controller.set_message_direct", needs_rh=True)
+def bench_controller_message(args, plugin):
+    broker, controller, _racecontext = start_controller(plugin)
+    published = broker.published
+    calls = [(n % 8, "P1 L%d 0:21.%03d" % (n, n % 1000)) for n in range(args.calls)]
+    start = time.perf_counter()
+    latencies, _total = time_calls(controller.set_message_direct, calls, BURST, catch_up(controller._publisher))
+    gevent.sleep(float(controller.config['OSD_COALESCE_MS']) / 1000.0 * 2)
+    result = publish_result(broker, controller, latencies, start)
+    result['published'] -= published
+    stop_controller(broker, controller)
+    return result
+
+@case("controller.onRaceLapRecorded", needs_rh=True)
+def bench_lap_recorded(args, plugin):
+    import rh_standins #pylint: disable=import-outside-toplevel
+    broker, controller, racecontext = start_controller(plugin)
+    published = broker.published
+    calls = []
+    lap_numbers = [0] * 8
+    for n in range(args.calls):
+        seat = n % 8
+        lap_numbers[seat] += 1
+        calls.append(({'node_index': seat,
+                       'gap_info': rh_standins.gap_info(racecontext, seat, lap_numbers[seat], 20000 + n % 997)},))
+
+    def lap(lap_args):
+        racecontext.race.node_laps[lap_args['node_index']].append(None)
+        controller.onRaceLapRecorded(lap_args)
+
+    start = time.perf_counter()
+    latencies, _total = time_calls(lap, calls, BURST, catch_up(controller._publisher))
+    gevent.sleep(float(controller.config['OSD_COALESCE_MS']) / 1000.0 * 2)
+    result = publish_result(broker, controller, latencies, start)
+    result['published'] -= published
+    stop_controller(broker, controller)
+    return result
+
+@case("controller.onHeatSet", needs_rh=True)
+def bench_heat_set(args, plugin):
+    broker, controller, _racecontext = start_controller(plugin)
+    published = broker.published
+    calls = [({'heat_id': 1},)] * max(1, args.calls // 8)
+    start = time.perf_counter()
+    latencies, _total = time_calls(controller.onHeatSet, calls, 1, catch_up(controller._publisher))
+    gevent.sleep(float(controller.config['OSD_COALESCE_MS']) / 1000.0 * 2)
+    result = publish_result(broker, controller, latencies, start)
+    result['published'] -= published
+    stop_controller(broker, controller)
+    return result
+
+@case("controller.on_message_resp_targeted", needs_rh=True)
+def bench_resp_targeted(args, plugin):
+    import paho.mqtt.client as mqtt_client #pylint: disable=import-outside-toplevel
+    broker, controller, _racecontext = start_controller(plugin)
+
+    def message(topic, payload):
+        msg = mqtt_client.MQTTMessage(topic=topic.encode('utf-8'))
+        msg.payload = payload
+        return msg
+
+    serials = ["CV-BENCH-%04d" % n for n in range(args.receivers)]
+    for n, serial in enumerate(serials):
+        controller.on_message_connection(None, None, message("rxcn/%s" % serial, b'1'))
+        controller.on_message_resp_targeted(None, None, message(
+            "rx/cv1/resp_target/%s" % serial, json.dumps({"seat": str(n % 8)}).encode('ascii')))
+
+    payloads = [json.dumps({"seat": str(n % 8), "device_name": serial, "video_format": "N",
+                            "ip_addr": "10.0.0.%d" % (n % 200 + 1)}).encode('ascii')
+                for n, serial in enumerate(serials)]
+    calls = [(None, None, message("rx/cv1/resp_target/%s" % serials[n % len(serials)], payloads[n % len(serials)]))
+             for n in range(args.calls)]
+    latencies, total = time_calls(controller.on_message_resp_targeted, calls)
+    result = summarize(latencies, total)
+    stop_controller(broker, controller)
+    return result
+
+##########
+## Report
+##########
+
+def metadata(plugin_loaded):
+    try:
+        revision = subprocess.run(["git", "describe", "--always", "--dirty"], capture_output=True, text=True,
+                                  cwd=os.path.dirname(os.path.abspath(__file__)), check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        revision = None
+    return {
+        'revision': revision,
+        'time': time.strftime("%Y-%m-%dT%H:%M:%S"),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'rotorhazard': plugin_loaded,
+    }
+
+def compare(results, baseline_path, threshold):
+    """Print each case's change from a baseline; returns the cases slower by more than threshold"""
+    with open(baseline_path) as f:
+        baseline = json.load(f)['results']
+    slower = []
+    print()
+    print("%-38s %12s %12s %8s" % ("compared with %s" % os.path.basename(baseline_path), "p50 us", "per s", ""))
+    for name, result in results.items():
+        before = baseline.get(name)
+        if not before or not before.get('per_s') or not result.get('per_s'):
+            continue
+        change = result['per_s'] / before['per_s'] - 1
+        flag = "SLOWER" if change < -threshold else ""
+        if flag:
+            slower.append(name)
+        print("%-38s %5s->%-6s %+11.1f%% %8s" % (name, before['p50_us'], result['p50_us'], change * 100, flag))
+    return slower
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--calls", type=int, default=20000, help="calls per case")
+    parser.add_argument("--receivers", type=int, default=64, help="receivers answering in the fan-out and response cases")
+    parser.add_argument("--rh-server", help="RotorHazard src/server directory, for the VRxSeat and CV2Controller cases")
+    parser.add_argument("--only", help="run only cases whose name contains this")
+    parser.add_argument("--output", help="write results to this JSON file")
+    parser.add_argument("--compare", help="JSON results of an earlier run to compare with")
+    parser.add_argument("--threshold", type=float, default=0.10,
+                        help="report a case as slower when its calls per second drop by more than this fraction")
+    args = parser.parse_args()
+
+    plugin = None
+    if args.rh_server:
+        plugin = _loader.load_plugin(args.rh_server)
+
+    results = {}
+    print("%-38s %8s %12s %9s %9s %9s" % ("case", "calls", "per s", "p50 us", "p99 us", "max us"))
+    for name, needs_rh, fn in CASES:
+        if args.only and args.only not in name:
+            continue
+        if needs_rh and plugin is None:
+            print("%-38s skipped, needs --rh-server" % name)
+            continue
+        result = fn(args, plugin)
+        results[name] = result
+        print("%-38s %8d %12s %9s %9s %9s" % (name, result['calls'], result['per_s'],
+                                              result['p50_us'], result['p99_us'], result['max_us']))
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({'meta': metadata(plugin is not None), 'results': results}, f, indent=2, sort_keys=True)
+    if args.compare:
+        if compare(results, args.compare, args.threshold):
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
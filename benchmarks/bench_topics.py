@@ -0,0 +1,34 @@
+'''Per-publish topic lookup: nested dict formatting vs. the precomputed TopicRegistry'''
+
+import argparse
+import timeit
+
+from _loader import load_module
+
+mqtt_topics = load_module('mqtt_topics')
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("-n", "--number", type=int, default=200000,
+                        help="calls per timing run")
+    args = parser.parse_args()
+
+    publish_topics = mqtt_topics.mqtt_publish_topics
+    registry = mqtt_topics.TopicRegistry("cv1")
+    seat_number = 3
+    serial_num = "CV-0A1B2C3D4E5F"
+    registry.esp_target(serial_num)
+
+    cases = [
+        ("seat, formatted", lambda: publish_topics["cv1"]["receiver_command_esp_seat_topic"][0]%seat_number),
+        ("seat, registry", lambda: registry.esp_seat[seat_number]),
+        ("target, formatted", lambda: publish_topics["cv1"]["receiver_command_esp_targeted_topic"][0]%serial_num),
+        ("target, registry", lambda: registry.esp_target(serial_num)),
+    ]
+
+    for name, fn in cases:
+        best = min(timeit.repeat(fn, number=args.number, repeat=5))
+        print("%-20s %8.1f ns/call" % (name, best / args.number * 1e9))
+
+if __name__ == "__main__":
+    main()
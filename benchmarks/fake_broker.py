@@ -0,0 +1,305 @@
+'''In-process stand-in for an MQTT broker and paho clients
+
+FakeBroker routes publishes between FakePahoClients by topic filter, with no
+sockets or threads of its own. FakePahoClient implements the part of paho's
+Client that MQTT_Client and the emulators use, so plugin code can be timed
+without a running Mosquitto:
+
+    broker = FakeBroker()
+    client = MQTT_Client(..., client_factory=broker.client_factory)
+
+Messages and publish acknowledgements are queued and handed out by
+broker.pump(), as paho hands them out from its network loop. start() pumps
+from a background thread (a greenlet once gevent has monkeypatched), for code
+that waits on acknowledgements, such as PublishScheduler.
+'''
+
+import collections
+import logging
+import threading
+
+import paho.mqtt.client as mqtt_client
+from paho.mqtt.client import topic_matches_sub, MQTT_ERR_SUCCESS, MQTT_ERR_NO_CONN
+
+logger = logging.getLogger(__name__)
+
+class FakeMessageInfo:
+    """The parts of paho's MQTTMessageInfo publishers look at"""
+    def __init__(self, mid, rc):
+        self.mid = mid
+        self.rc = rc
+
+class FakeBroker:
+    def __init__(self):
+        self._clients = []
+        # topic => subscribed clients, cleared whenever a subscription changes
+        self._routes = {}
+        self._queue = collections.deque()
+        self._observers = []
+        self._wakeup = threading.Event()
+        self._worker = None
+        self._running = False
+        self.published = 0
+        self.delivered = 0
+        self.published_bytes = 0
+        self.errors = 0
+
+    def client_factory(self, client_id="", clean_session=True, userdata=None, **_kwargs):
+        """Drop-in for paho.mqtt.client.Client"""
+        return FakePahoClient(self, client_id, userdata)
+
+    def add_observer(self, observer):
+        """Call observer(sender, topic, payload) for every message as it is published"""
+        self._observers.append(observer)
+
+    def publish(self, sender, topic, payload, qos=0, retain=False):
+        """Queue a message for every matching subscriber; returns how many there are"""
+        if isinstance(payload, str):
+            payload = payload.encode('utf-8')
+        elif isinstance(payload, (int, float)):
+            payload = str(payload).encode('ascii')
+        elif payload is None:
+            payload = b''
+        self.published += 1
+        self.published_bytes += len(payload)
+        for observer in self._observers:
+            observer(sender, topic, payload)
+        subscribers = self._routes.get(topic)
+        if subscribers is None:
+            subscribers = self._routes[topic] = [client for client in self._clients if client.matches(topic)]
+        for client in subscribers:
+            self._queue.append((client.deliver, (topic, payload, qos, retain)))
+        self._wakeup.set()
+        return len(subscribers)
+
+    def call_soon(self, fn, *args):
+        self._queue.append((fn, args))
+        self._wakeup.set()
+
+    def pump(self, limit=None):
+        """Deliver queued messages and acknowledgements, including any queued while delivering
+
+        Returns the number handed out. An exception in a callback is logged and
+        counted in errors, and delivery carries on.
+        """
+        count = 0
+        while self._queue and (limit is None or count < limit):
+            fn, args = self._queue.popleft()
+            try:
+                fn(*args)
+            except Exception:
+                self.errors += 1
+                logger.exception("Callback failed for %s", args[0] if args else fn)
+            count += 1
+        return count
+
+    @property
+    def pending(self):
+        return len(self._queue)
+
+    def start(self):
+        if self._worker is None:
+            self._running = True
+            self._worker = threading.Thread(target=self._run, name="FakeBroker", daemon=True)
+            self._worker.start()
+
+    def stop(self):
+        self._running = False
+        self._wakeup.set()
+        if self._worker is not None:
+            self._worker.join(1.0)
+            self._worker = None
+
+    def _run(self):
+        while self._running:
+            self._wakeup.wait(0.5)
+            self._wakeup.clear()
+            self.pump()
+
+    def _attach(self, client):
+        if client not in self._clients:
+            self._clients.append(client)
+            self._routes.clear()
+
+    def _detach(self, client):
+        if client in self._clients:
+            self._clients.remove(client)
+            self._routes.clear()
+
+    def _subscriptions_changed(self):
+        self._routes.clear()
+
+class FakePahoClient:
+    """A paho Client connected to a FakeBroker"""
+    def __init__(self, broker, client_id="", userdata=None):
+        self._broker = broker
+        self._client_id = client_id
+        self._userdata = userdata
+        self._filters = {}
+        self._callbacks = []
+        # topic => message callbacks matching it
+        self._topic_callbacks = {}
+        self._will = None
+        self._connected = False
+        self._connecting = False
+        self._mid = 0
+
+        self.on_connect = None
+        self.on_disconnect = None
+        self.on_message = None
+        self.on_publish = None
+        self.on_subscribe = None
+        self.on_log = None
+
+    # Connection
+    def will_set(self, topic, payload=None, qos=0, retain=False, properties=None):
+        self._will = (topic, payload, qos, retain)
+
+    def reconnect_delay_set(self, min_delay=1, max_delay=120):
+        pass
+
+    def connect(self, host="localhost", port=1883, keepalive=60, *_args, **_kwargs):
+        """Accept the connection; on_connect is called from the loop, as paho does"""
+        self._connecting = True
+        self._broker._attach(self)
+        return MQTT_ERR_SUCCESS
+
+    def loop_start(self):
+        self._finish_connect()
+
+    def loop_forever(self, *_args, **_kwargs):
+        self._finish_connect()
+        self._broker.pump()
+
+    def loop_stop(self, force=False):
+        pass
+
+    def disconnect(self, *_args, **_kwargs):
+        if self._connected:
+            self._connected = False
+            self._broker._detach(self)
+            if self.on_disconnect is not None:
+                self.on_disconnect(self, self._userdata, MQTT_ERR_SUCCESS)
+        return MQTT_ERR_SUCCESS
+
+    def drop(self):
+        """Lose the connection without a DISCONNECT, so the last will is published"""
+        if self._connected:
+            self._connected = False
+            self._broker._detach(self)
+            if self._will is not None:
+                self._broker.publish(self, *self._will)
+            if self.on_disconnect is not None:
+                self.on_disconnect(self, self._userdata, MQTT_ERR_NO_CONN)
+
+    def is_connected(self):
+        return self._connected
+
+    def _finish_connect(self):
+        if self._connecting:
+            self._connecting = False
+            self._connected = True
+            if self.on_connect is not None:
+                self.on_connect(self, self._userdata, {'session present': 0}, 0)
+
+    # Subscriptions and messages
+    def subscribe(self, topic, qos=0, *_args, **_kwargs):
+        self._filters[topic] = qos
+        self._broker._subscriptions_changed()
+        self._mid += 1
+        return MQTT_ERR_SUCCESS, self._mid
+
+    def unsubscribe(self, topic, *_args, **_kwargs):
+        self._filters.pop(topic, None)
+        self._broker._subscriptions_changed()
+        self._mid += 1
+        return MQTT_ERR_SUCCESS, self._mid
+
+    def message_callback_add(self, sub, callback):
+        self.message_callback_remove(sub)
+        self._callbacks.append((sub, callback))
+
+    def message_callback_remove(self, sub):
+        self._callbacks = [(s, cb) for s, cb in self._callbacks if s != sub]
+        self._topic_callbacks.clear()
+
+    def matches(self, topic):
+        for sub in self._filters:
+            if topic_matches_sub(sub, topic):
+                return True
+        return False
+
+    def publish(self, topic, payload=None, qos=0, retain=False, properties=None):
+        self._mid += 1
+        mid = self._mid
+        if not self._connected:
+            return FakeMessageInfo(mid, MQTT_ERR_NO_CONN)
+        self._broker.publish(self, topic, payload, qos, retain)
+        if self.on_publish is not None:
+            self._broker.call_soon(self.on_publish, self, self._userdata, mid)
+        return FakeMessageInfo(mid, MQTT_ERR_SUCCESS)
+
+    def deliver(self, topic, payload, qos, retain):
+        if not self._connected:
+            return
+        message = mqtt_client.MQTTMessage(topic=topic.encode('utf-8'))
+        message.payload = payload
+        message.qos = qos
+        message.retain = retain
+
+        callbacks = self._topic_callbacks.get(topic)
+        if callbacks is None:
+            callbacks = self._topic_callbacks[topic] = [cb for sub, cb in self._callbacks if topic_matches_sub(sub, topic)]
+        for callback in callbacks:
+            callback(self, self._userdata, message)
+        if not callbacks and self.on_message is not None:
+            self.on_message(self, self._userdata, message)
+        self._broker.delivered += 1
+
+class FakeReceiver:
+    """An emulated receiver on a FakeBroker, answering from a CVCMState
+
+    Subscribes to the same ESP command topics as a real receiver, announces
+    itself on its connection topic and answers queries straight away, unless
+    answering is set to False.
+    """
+    def __init__(self, broker, serial_num, seat_number):
+        from _loader import load_module #pylint: disable=import-outside-toplevel
+        cvcm_model = load_module('cvcm_model')
+        mqtt_topics = load_module('mqtt_topics')
+        rx_topics = mqtt_topics.mqtt_publish_topics["cv1"]
+        self._seat_topic = rx_topics["receiver_command_esp_seat_topic"]
+        self._format_topic = mqtt_topics.format_topic
+
+        self.serial_num = serial_num
+        self.state = cvcm_model.CVCMState(serial_num, seat_number)
+        self.connection_topic = mqtt_topics.mqtt_subscribe_topics["cv1"]["receiver_connection"][0] % serial_num
+        self.response_topic = mqtt_topics.mqtt_subscribe_topics["cv1"]["receiver_response_targeted"][0] % serial_num
+        self.seat_topic = self._format_topic(self._seat_topic, seat_number=seat_number)
+        self.commands = 0
+        self.answering = True
+
+        self.client = broker.client_factory(client_id=serial_num)
+        self.client.will_set(self.connection_topic, -1, 1)
+        self.client.on_message = self._on_message
+        self.client.connect()
+        self.client.loop_start()
+        for topic in (self._format_topic(rx_topics["receiver_command_esp_all_topic"]),
+                      self.seat_topic,
+                      self._format_topic(rx_topics["receiver_command_esp_targeted_topic"], serial_num=serial_num)):
+            self.client.subscribe(topic)
+        self.client.publish(self.connection_topic, 1, 1)
+
+    def _on_message(self, client, _userdata, message):
+        self.commands += 1
+        previous_seat = self.state.seat_number
+        try:
+            answer = self.state.handle(message.payload)
+        except ValueError:
+            return
+        if self.state.seat_number != previous_seat:
+            client.unsubscribe(self.seat_topic)
+            self.seat_topic = self._format_topic(self._seat_topic, seat_number=self.state.seat_number)
+            client.subscribe(self.seat_topic)
+        if answer is not None and self.answering:
+            client.publish(self.response_topic, answer)
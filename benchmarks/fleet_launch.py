@@ -0,0 +1,15 @@
+'''Emulated receivers across several processes, against a broker and a running controller
+
+Shards --receivers across --workers processes, each running a fleet, starts
+them together and reports messages and answers per second, answer lag and the
+busiest worker's CPU every --report seconds, then a per-worker summary. Raise
+--receivers (or the controller's query rate) between runs to find where the
+broker or controller saturates.
+
+    python fleet_launch.py -a 192.168.1.10 --receivers 2000 --workers 8 --duration 60
+'''
+
+from _loader import load_module
+
+if __name__ == "__main__":
+    load_module('VRxCV1_launcher').main()
@@ -0,0 +1,14 @@
+'''Ramp a fleet of emulated receivers against a broker and a running controller
+
+Adds receivers in steps and reports connect time, commands received,
+discovery time (connection to the first command addressed to the receiver)
+and this process's CPU per step. Watch the controller's and broker's CPU
+alongside, e.g. with the controller's metrics page.
+
+    python fleet_ramp.py -a 192.168.1.10 --start 8 --step 8 --max 128
+'''
+
+from _loader import load_module
+
+if __name__ == "__main__":
+    load_module('VRxCV1_fleet').main()
@@ -0,0 +1,192 @@
+'''Replay an MQTT capture
+
+Reads a capture written by MQTT_Client's capture mode (the controller's
+CAPTURE_FILE, or the emulator's --capture) and sends its messages again, in
+their recorded order and at --speed times the recorded pace (0 for as fast
+as possible):
+
+    # what the capture holds, per session and topic
+    python replay_capture.py race.vrxcap
+
+    # the receivers' side of a race, into CV2Controller's callbacks on the in-process broker
+    python replay_capture.py race.vrxcap --rh-server ~/RotorHazard/src/server --speed 0
+
+    # into a real broker, for a controller or receivers listening there
+    python replay_capture.py race.vrxcap -a localhost --speed 4
+
+--direction picks which messages are sent: received (default) replays what
+the capturing client was sent, so a controller capture replays the
+receivers' traffic to a controller under test; sent replays what the
+capturing client published, e.g. an emulator's answers.
+
+Reported: messages sent, wall time, rate, and how far the replay fell behind
+the recorded schedule; against the controller also its publishes in
+response, by topic, and any callback errors.
+'''
+
+from gevent import monkey
+monkey.patch_all()
+
+import argparse
+import json
+import time
+
+import gevent
+
+import _loader
+
+DIRECTIONS = {'received': b'I', 'sent': b'O'}
+
+def schedule(messages, direction):
+    """(seconds since the first session started, message) for each message sent in direction
+
+    Sessions follow one another, each starting where the previous one's last
+    message was.
+    """
+    base = 0.0
+    last = 0.0
+    session = None
+    for message in messages:
+        if message.session != session:
+            session = message.session
+            base += last
+            last = 0.0
+        last = message.time
+        if message.direction == direction:
+            yield base + message.time, message
+
+def replay(messages, send, speed):
+    """Call send(topic, payload) for each (at, message); returns the stats"""
+    count = 0
+    payload_bytes = 0
+    behind = 0.0
+    start = time.perf_counter()
+    for at, message in messages:
+        if speed > 0:
+            delay = start + at / speed - time.perf_counter()
+            if delay > 0:
+                gevent.sleep(delay)
+            else:
+                behind = max(behind, -delay)
+        elif count % 64 == 0:
+            gevent.sleep(0)
+        send(message.topic, message.payload)
+        count += 1
+        payload_bytes += len(message.payload)
+    elapsed = time.perf_counter() - start
+    return {
+        'messages': count,
+        'bytes': payload_bytes,
+        'wall_s': round(elapsed, 3),
+        'messages_per_s': round(count / elapsed, 1) if elapsed > 0 else None,
+        'max_behind_ms': round(behind * 1000, 2),
+    }
+
+def summarize(path, topic_class):
+    """Per session: duration and message counts by direction and topic class"""
+    mqtt_capture = _loader.load_module('mqtt_capture')
+    sessions = {}
+    for message in mqtt_capture.read_capture(path):
+        session = sessions.setdefault(message.session, {'duration_s': 0.0, 'received': {}, 'sent': {}})
+        session['duration_s'] = round(message.time, 3)
+        counts = session['received' if message.direction == mqtt_capture.INCOMING else 'sent']
+        label = topic_class(message.topic)
+        counts[label] = counts.get(label, 0) + 1
+    return sessions
+
+def to_broker(args):
+    import paho.mqtt.client as mqtt_client #pylint: disable=import-outside-toplevel
+
+    client = mqtt_client.Client(client_id="VRxReplay", clean_session=True)
+    client.connect(args.address, args.port)
+    client.loop_start()
+    send = lambda topic, payload: client.publish(topic, payload, args.qos)
+    try:
+        return replay(args.messages, send, args.speed), {}
+    finally:
+        client.loop_stop()
+        client.disconnect()
+
+def to_controller(args, topic_class):
+    import rh_standins #pylint: disable=import-outside-toplevel
+    from fake_broker import FakeBroker #pylint: disable=import-outside-toplevel
+
+    plugin = _loader.load_plugin(args.rh_server)
+    broker = FakeBroker()
+    broker.start()
+    controller, _racecontext, _events = rh_standins.make_controller(plugin, broker, args.seats)
+    controller._publisher.drain(10)
+    gevent.sleep(0.1)
+
+    sender = broker.client_factory(client_id="VRxReplay")
+    sender.connect()
+    sender.loop_start()
+
+    responses = {}
+    def observe(client, topic, _payload):
+        if client is controller._mqttc._client:
+            label = topic_class(topic)
+            responses[label] = responses.get(label, 0) + 1
+    broker.add_observer(observe)
+
+    errors = broker.errors
+    stats = replay(args.messages, sender.publish, args.speed)
+    while broker.pending:
+        gevent.sleep(0.01)
+    controller._publisher.drain(10)
+    stats['callback_errors'] = broker.errors - errors
+
+    controller.onShutdown({})
+    broker.stop()
+    return stats, responses
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("capture", help="capture file")
+    parser.add_argument("--direction", choices=sorted(DIRECTIONS), default="received",
+                        help="which of the capturing client's messages to send")
+    parser.add_argument("--speed", type=float, default=1.0, help="times the recorded pace, 0 for as fast as possible")
+    target = parser.add_mutually_exclusive_group()
+    target.add_argument("-a", "--address", help="send to the MQTT broker at this address")
+    target.add_argument("--rh-server", help="send to a CV2Controller on the in-process broker; RotorHazard src/server directory")
+    parser.add_argument("-p", "--port", type=int, default=1883)
+    parser.add_argument("--qos", type=int, default=0, choices=(0, 1, 2), help="QoS of messages sent to a broker")
+    parser.add_argument("--seats", type=int, default=8, help="seats on the controller")
+    parser.add_argument("--output", help="write the results to this JSON file")
+    args = parser.parse_args()
+
+    if args.rh_server:
+        # The whole plugin has to be imported before any one module
+        _loader.load_plugin(args.rh_server)
+    mqtt_capture = _loader.load_module('mqtt_capture')
+    topic_class = _loader.load_module('mqtt_topics').topic_class
+
+    if not args.address and not args.rh_server:
+        for session, counts in sorted(summarize(args.capture, topic_class).items()):
+            print("session %d: %.3f s" % (session, counts['duration_s']))
+            for direction in ('received', 'sent'):
+                for label, count in sorted(counts[direction].items()):
+                    print("  %-8s %-32s %8d" % (direction, label, count))
+        return
+
+    args.messages = schedule(mqtt_capture.read_capture(args.capture), DIRECTIONS[args.direction])
+    if args.address:
+        stats, responses = to_broker(args)
+    else:
+        stats, responses = to_controller(args, topic_class)
+
+    print("%(messages)d messages (%(bytes)d bytes) in %(wall_s).3f s: %(messages_per_s)s per second, "
+          "at most %(max_behind_ms).2f ms behind schedule" % stats)
+    if 'callback_errors' in stats:
+        print("controller callback errors: %d" % stats['callback_errors'])
+    for label, count in sorted(responses.items()):
+        print("  controller published %-32s %8d" % (label, count))
+
+    if args.output:
+        del args.messages
+        with open(args.output, "w") as f:
+            json.dump({'args': vars(args), 'replay': stats, 'controller_publishes': responses},
+                      f, indent=2, sort_keys=True)
+
+if __name__ == "__main__":
+    main()
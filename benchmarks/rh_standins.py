@@ -0,0 +1,204 @@
+'''Stand-ins for the RotorHazard objects CV2Controller reads
+
+Enough of rhapi, racecontext (race, rhdata, language, interface.nodes) and
+the event manager to start a CV2Controller and drive its event handlers
+outside a running RotorHazard server. RotorHazard's own modules (VRxControl,
+RHUtils, RHRace, eventmanager) are still imported from a checkout, see
+_loader.load_plugin.
+'''
+
+import types
+
+import gevent
+
+# IMD frequencies, one per seat
+FREQUENCIES = [5658, 5695, 5760, 5800, 5880, 5917, 5732, 5843]
+
+BENCH_CONFIG = {
+    'HOST': 'localhost',
+    'OSD_COALESCE_MS': 10,
+    'EVENT_FLUSH_MS': 250,
+    'PUBLISH_MAX_INFLIGHT': 10,
+    'FREQUENCY_COUNTDOWN_S': 0,
+    'CONNECT_RETRY_MAX_S': 30,
+    'STALE_RTT_MULTIPLE': 4,
+    'STALE_MIN_S': 2,
+    'REQUEST_TIMEOUT_S': 2,
+    'POLL_MIN_S': 5,
+    'POLL_MAX_S': 60,
+    'POLL_RACE_FACTOR': 4,
+    'METRICS_ENABLED': False,
+    'METRICS_FILE': '',
+    'METRICS_INTERVAL_S': 15,
+    'CAPTURE_FILE': '',
+}
+
+class Language:
+    def __(self, text):
+        return text
+
+class Pilot:
+    def __init__(self, pilot_id, callsign):
+        self.id = pilot_id
+        self.callsign = callsign
+
+class Heat:
+    def __init__(self, heat_id, name):
+        self.id = heat_id
+        self.name = name
+
+    def displayname(self):
+        return self.name
+
+class RHData:
+    def __init__(self, pilots, heats):
+        self.options = {'timeFormat': '{m}:{s}.{d}', 'osd_lapHeader': 'L', 'osd_positionHeader': 'P'}
+        self._pilots = pilots
+        self._heats = {heat.id: heat for heat in heats}
+        self.rounds = {}
+
+    def get_option(self, name, default=None):
+        return self.options.get(name, default)
+
+    def set_option(self, name, value):
+        self.options[name] = value
+
+    def get_pilots(self):
+        return list(self._pilots)
+
+    def get_heat(self, heat_id):
+        return self._heats.get(heat_id)
+
+    def get_max_round(self, heat_id):
+        return self.rounds.get(heat_id, 0)
+
+class Race:
+    def __init__(self, num_seats, win_condition):
+        self.current_heat = 1
+        self.node_pilots = {seat: seat + 1 for seat in range(num_seats)}
+        self.node_laps = {seat: [] for seat in range(num_seats)}
+        self.win_condition = win_condition
+
+class RaceContext:
+    def __init__(self, num_seats=8, win_condition=None, heats=1):
+        pilots = [Pilot(seat + 1, "Pilot%d" % (seat + 1)) for seat in range(num_seats)]
+        self.language = Language()
+        self.rhdata = RHData(pilots, [Heat(n, "Heat %d" % n) for n in range(1, heats + 1)])
+        self.race = Race(num_seats, win_condition)
+        self.interface = types.SimpleNamespace(
+            nodes=[types.SimpleNamespace(index=seat, frequency=FREQUENCIES[seat % len(FREQUENCIES)])
+                   for seat in range(num_seats)])
+
+class Events:
+    """Counts the events the controller fires and keeps the latest arguments of each"""
+    def __init__(self):
+        self.triggered = {}
+        self.last = {}
+        self.handlers = {}
+
+    def trigger(self, event, args):
+        self.triggered[event] = self.triggered.get(event, 0) + 1
+        self.last[event] = args
+
+    def on(self, event, handler, *_args, **_kwargs):
+        self.handlers.setdefault(event, []).append(handler)
+
+class RHAPI:
+    def __init__(self, events):
+        self.events = events
+        self.ui = types.SimpleNamespace(blueprint_add=lambda blueprint: None)
+
+def gap_info(racecontext, seat, lap_number, lap_time_ms=20000, diff_time_ms=450, next_seat=None):
+    """Gap info shaped like Results.get_gap_info's, for a lap by seat"""
+    race = racecontext.race
+    pilots = {pilot.id: pilot for pilot in racecontext.rhdata.get_pilots()}
+    if next_seat is None:
+        next_seat = (seat + 1) % len(race.node_pilots)
+    current = types.SimpleNamespace(
+        callsign=pilots[race.node_pilots[seat]].callsign,
+        position=seat + 1,
+        lap_number=lap_number,
+        last_lap_time=lap_time_ms,
+        consecutives=lap_time_ms * 3,
+        consecutives_base=3,
+        is_best_lap=False,
+        seat=seat)
+    next_rank = types.SimpleNamespace(
+        callsign=pilots[race.node_pilots[next_seat]].callsign,
+        position=seat,
+        lap_number=lap_number,
+        last_lap_time=lap_time_ms - diff_time_ms,
+        diff_time=diff_time_ms if seat else 0,
+        seat=next_seat)
+    return types.SimpleNamespace(race=types.SimpleNamespace(win_condition=race.win_condition),
+                                 current=current, next_rank=next_rank)
+
+def get_gap_info(racecontext, seat):
+    """Stand-in for Results.get_gap_info, worked out from race.node_laps
+
+    Laps are objects with lap_time and lap_time_stamp (ms since the start);
+    the first is the holeshot. Pilots are ranked by laps, then by time.
+    """
+    race = racecontext.race
+    pilots = {pilot.id: pilot for pilot in racecontext.rhdata.get_pilots()}
+
+    def standing(s):
+        laps = race.node_laps.get(s) or []
+        return (-len(laps), laps[-1].lap_time_stamp if laps else 0)
+
+    order = sorted((s for s in race.node_pilots if race.node_laps.get(s)), key=standing)
+    position = order.index(seat) + 1 if seat in order else len(order) + 1
+    laps = race.node_laps.get(seat) or []
+    lap_times = [lap.lap_time for lap in laps[1:]]
+
+    def rank(s, diff_time):
+        s_laps = race.node_laps.get(s) or []
+        return types.SimpleNamespace(
+            callsign=pilots[race.node_pilots[s]].callsign,
+            position=order.index(s) + 1 if s in order else position,
+            lap_number=max(0, len(s_laps) - 1),
+            last_lap_time=s_laps[-1].lap_time if s_laps else 0,
+            diff_time=diff_time,
+            seat=s)
+
+    current = rank(seat, 0)
+    current.consecutives_base = min(3, len(lap_times))
+    current.consecutives = min((sum(lap_times[i:i + 3]) for i in range(max(1, len(lap_times) - 2))), default=0)
+    current.is_best_lap = bool(lap_times) and lap_times[-1] == min(lap_times)
+
+    if position > 1:
+        ahead = order[position - 2]
+        ahead_laps = race.node_laps[ahead]
+        # Time behind the pilot ahead when they completed the same lap
+        same_lap = ahead_laps[min(len(laps), len(ahead_laps)) - 1]
+        next_rank = rank(ahead, max(0, laps[-1].lap_time_stamp - same_lap.lap_time_stamp) if laps else 0)
+    else:
+        next_rank = rank(seat, 0)
+    return types.SimpleNamespace(race=types.SimpleNamespace(win_condition=race.win_condition),
+                                 current=current, next_rank=next_rank)
+
+def make_controller(plugin, broker, num_seats=8, config=None, heats=1, connect_timeout=5.0):
+    """Start a CV2Controller connected to a FakeBroker
+
+    broker: the FakeBroker, or None to connect paho to a real broker at HOST.
+    plugin: the vrx_cv2 package from _loader.load_plugin. The plugin's
+    Results is replaced with get_gap_info above, since RotorHazard's reads
+    the database.
+    Returns (controller, racecontext, events).
+    """
+    from RHRace import WinCondition #pylint: disable=import-error,import-outside-toplevel
+
+    plugin.Config.VRX_CONTROL = dict(BENCH_CONFIG, **(config or {}))
+    plugin.Results = types.SimpleNamespace(get_gap_info=get_gap_info)
+    racecontext = RaceContext(num_seats, WinCondition.MOST_LAPS, heats)
+    events = Events()
+    controller = plugin.CV2Controller(RHAPI(events), 'cv2', 'ClearView 2.0',
+                                      mqtt_client_factory=None if broker is None else broker.client_factory)
+    controller.racecontext = racecontext
+    controller.Events = events
+    controller.onStartup({})
+
+    with gevent.Timeout(connect_timeout):
+        while not controller._mqttc.is_connected():
+            gevent.sleep(0.01)
+    return controller, racecontext, events
@@ -0,0 +1,334 @@
+'''Checks of CV2Controller behaviour against the in-process broker
+
+Each check starts a CV2Controller on fake_broker.FakeBroker with emulated
+receivers, drives it through a situation and checks the outcome:
+
+  liveness    a receiver that stops answering is reported stale, with
+              response time percentiles, in the VRx data event and metrics
+  reconnect   a receiver that reconnects while queries to it are still
+              waiting is queried afresh, and gets configured
+  stall       queries held in the publish queue, e.g. while the broker
+              stalls, don't mark receivers stale or count towards response time
+  late_will   a receiver that answers after its disconnect message, with no
+              new connection message, is indexed and polled again
+  poller      a poll's two queries back a quiet receiver's polling off once,
+              not once per answer
+  bad_seat    moving a receiver to a seat out of range raises ValueError
+              and leaves its state alone
+  config_drop a config command evicted from a full publish lane isn't
+              counted as set, so repeating it sends it
+  osd_failure a batch of OSD messages whose first publish fails still sends
+              the rest, and every seat keeps getting new messages
+  refused     a query refused by a full status lane fails straight away and
+              doesn't count as sent, in flight or awaiting an answer
+
+Prints PASS or FAIL for each check and exits non-zero if any failed.
+Needs a RotorHazard checkout and clearview, like sim_race.py:
+
+    python scenario_controller.py --rh-server ~/RotorHazard/src/server
+'''
+
+from gevent import monkey
+monkey.patch_all()
+
+import argparse
+import sys
+import time
+
+import gevent
+
+import _loader
+import rh_standins
+from fake_broker import FakeBroker, FakeReceiver
+
+class Scenario:
+    """A controller on a fresh in-process broker, with receivers added as needed"""
+    def __init__(self, plugin, config=None, num_seats=8):
+        self.broker = FakeBroker()
+        self.broker.start()
+        self.controller, self.racecontext, self.events = rh_standins.make_controller(
+            plugin, self.broker, num_seats, config)
+        self.receivers = []
+
+    def add_receiver(self, serial_num, seat_number=0):
+        receiver = FakeReceiver(self.broker, serial_num, seat_number)
+        self.receivers.append(receiver)
+        return receiver
+
+    def settle(self, seconds=0.1):
+        """Let queued publishes, deliveries and timers run"""
+        self.controller._publisher.drain(5)
+        gevent.sleep(seconds)
+
+    def close(self):
+        self.controller.onShutdown({})
+        self.broker.stop()
+
+def wait_for(condition, timeout=2.0):
+    """Wait until condition() is true; returns whether it became true"""
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() >= deadline:
+            return False
+        gevent.sleep(0.01)
+    return True
+
+def check(condition, message, *args):
+    if not condition:
+        raise AssertionError(message % args)
+
+#####################
+## Checks
+#####################
+
+def check_liveness(plugin):
+    scenario = Scenario(plugin, {'METRICS_ENABLED': True, 'STALE_MIN_S': 0.3, 'STALE_RTT_MULTIPLE': 2,
+                                 'EVENT_FLUSH_MS': 50})
+    try:
+        scenario.add_receiver("CV-LIVE-OK", 0)
+        silent = scenario.add_receiver("CV-LIVE-SILENT", 1)
+        silent.answering = False
+        scenario.settle()
+        controller = scenario.controller
+        check(wait_for(lambda: controller.liveness_status()['stale'] == ["CV-LIVE-SILENT"]),
+              "stale receivers %s", controller.liveness_status()['stale'])
+
+        event_liveness = lambda: scenario.events.last.get(plugin.Evt.VRX_DATA_RECEIVE, {}).get('liveness')
+        check(wait_for(lambda: (event_liveness() or {}).get('stale') == ["CV-LIVE-SILENT"]),
+              "VRx data event liveness %s", event_liveness())
+        check(event_liveness()['rtt_p50_ms'] is not None, "no response time in the event: %s", event_liveness())
+
+        snapshot = controller.metrics.snapshot()
+        check(snapshot.get('devices', {}).get('stale') == 1, "devices metric %s", snapshot.get('devices'))
+        check(set(snapshot.get('response_time_ms', {})) == {'p50', 'p90', 'p99'},
+              "response_time_ms metric %s", snapshot.get('response_time_ms'))
+    finally:
+        scenario.close()
+
+def check_reconnect(plugin):
+    scenario = Scenario(plugin, {'REQUEST_TIMEOUT_S': 5})
+    try:
+        receiver = scenario.add_receiver("CV-RECONNECT", 0)
+        receiver.answering = False
+        scenario.settle()
+        controller = scenario.controller
+        check(controller._requests.in_flight > 0, "no queries waiting on the silent receiver")
+
+        # Reconnect well inside REQUEST_TIMEOUT_S, now answering
+        receiver.answering = True
+        sent = controller._requests.sent
+        commands = receiver.commands
+        receiver.client.publish(receiver.connection_topic, 1, 1)
+        scenario.settle()
+        check(controller._requests.sent > sent, "no queries sent after reconnecting: %s", controller._requests.stats())
+        check(receiver.commands > commands, "receiver got no queries after reconnecting")
+        needs_config = lambda: controller.devices["CV-RECONNECT"].extended_properties["needs_config"]
+        check(wait_for(lambda: not needs_config()), "receiver still not configured after reconnecting")
+    finally:
+        scenario.close()
+
+def check_refused(plugin):
+    scenario = Scenario(plugin, {'REQUEST_TIMEOUT_S': 5})
+    try:
+        scenario.add_receiver("CV-REFUSED", 0)
+        scenario.settle()
+        controller = scenario.controller
+        check(wait_for(lambda: not controller._requests._device_requests), "startup queries still in flight")
+        device = controller.devices["CV-REFUSED"]
+        last_request = device.last_request
+        stats = controller._requests.stats()
+
+        # With the worker stopped nothing drains the status lane, so it fills
+        controller._publisher.stop()
+        topic = controller._topics.esp_target("CV-REFUSED")
+        while controller._publisher.publish(topic, "", plugin.CMD_STATUS_REQUEST):
+            pass
+
+        result = controller.req_status_targeted("lock", "CV-REFUSED")
+        check(result.ready() and isinstance(result.exception, _loader.load_module('request_tracker').RequestNotSent),
+              "refused query result %r", result.exception if result.ready() else "pending")
+        after = controller._requests.stats()
+        check(after['in_flight'] == stats['in_flight'] and after['sent'] == stats['sent'] and after['not_sent'] == stats['not_sent'] + 1,
+              "request stats before %s, after %s", stats, after)
+        check(device.last_request == last_request, "last_request stamped for a refused query")
+        check(controller._liveness.stats()['stale'] == [], "liveness %s", controller._liveness.stats())
+        check(not controller._liveness._outstanding, "liveness waiting on %s", controller._liveness._outstanding)
+    finally:
+        scenario.close()
+
+def check_stall(plugin):
+    scenario = Scenario(plugin, {'STALE_MIN_S': 0.3, 'STALE_RTT_MULTIPLE': 2})
+    try:
+        scenario.add_receiver("CV-STALL", 0)
+        scenario.settle()
+        controller = scenario.controller
+        check(wait_for(lambda: not controller._requests._device_requests), "startup queries still in flight")
+        last_request = controller.devices["CV-STALL"].last_request
+
+        controller._publisher.stop()
+        result = controller.req_status_targeted("lock", "CV-STALL")
+        gevent.sleep(0.8)
+        check(controller.liveness_status()['stale'] == [], "stale while queued: %s", controller.liveness_status()['stale'])
+        check(controller.devices["CV-STALL"].last_request == last_request, "last_request stamped while queued")
+
+        controller._publisher.start()
+        check(wait_for(result.ready), "queued query not answered")
+        rtt = controller._liveness.last_rtt("CV-STALL")
+        check(rtt is not None and rtt < 0.3, "response time %s includes the time queued", rtt)
+    finally:
+        scenario.close()
+
+def check_late_will(plugin):
+    scenario = Scenario(plugin)
+    try:
+        receiver = scenario.add_receiver("CV-LATE-WILL", 3)
+        scenario.settle()
+        controller = scenario.controller
+        check("CV-LATE-WILL" in controller._poller, "receiver not polled after connecting")
+
+        # The receiver's last will arrives late, after which it keeps answering
+        receiver.client.publish(receiver.connection_topic, -1, 1)
+        scenario.settle()
+        check("CV-LATE-WILL" not in controller._poller, "receiver still polled after disconnecting")
+        controller.req_status_targeted("variable", "CV-LATE-WILL")
+        scenario.settle()
+        check("CV-LATE-WILL" in controller._poller, "receiver not polled again after answering")
+        check("CV-LATE-WILL" in controller._device_index.at_seat(3), "receiver not indexed again after answering")
+    finally:
+        scenario.close()
+
+def check_poller(plugin):
+    scenario = Scenario(plugin, {'POLL_MIN_S': 1, 'POLL_MAX_S': 1000})
+    try:
+        receiver = scenario.add_receiver("CV-POLLED", 0)
+        scenario.settle()
+        controller = scenario.controller
+        poller = controller._poller
+        # Polls are driven by hand from here on
+        poller.stop()
+        intervals = [poller._interval["CV-POLLED"]]
+        for _ in range(4):
+            commands = receiver.commands
+            poller.poll_due(time.monotonic() + 1e6)
+            scenario.settle()
+            check(wait_for(lambda: not controller._requests._device_requests), "poll not answered")
+            check(receiver.commands - commands == 2, "%d queries in a poll", receiver.commands - commands)
+            intervals.append(poller._interval["CV-POLLED"])
+        # The first poll is adjusted from the answers to the startup queries
+        ratios = [later / earlier for earlier, later in zip(intervals[1:], intervals[2:])]
+        check(all(abs(ratio - plugin.status_poller.BACK_OFF) < 1e-9 for ratio in ratios),
+              "intervals %s", intervals)
+    finally:
+        scenario.close()
+
+def check_bad_seat(plugin):
+    scenario = Scenario(plugin)
+    try:
+        scenario.add_receiver("CV-BAD-SEAT", 2)
+        scenario.settle()
+        controller = scenario.controller
+        check(wait_for(lambda: controller.devices["CV-BAD-SEAT"].map.seat == 2), "receiver not seated")
+        cached = dict(controller._command_cache._state)
+        try:
+            controller.setDeviceSeat("CV-BAD-SEAT", 9)
+        except ValueError:
+            pass
+        else:
+            check(False, "no ValueError for seat 9")
+        check(controller.devices["CV-BAD-SEAT"].map.seat == 2, "seat changed to %s", controller.devices["CV-BAD-SEAT"].map.seat)
+        check(controller._command_cache._state == cached, "command cache changed")
+    finally:
+        scenario.close()
+
+def check_config_drop(plugin):
+    scenario = Scenario(plugin)
+    try:
+        controller = scenario.controller
+        scenario.settle()
+        seat_topic = controller._topics.esp_seat[1]
+        sent = []
+        def observe(client, topic, payload):
+            if client is controller._mqttc._client and topic == seat_topic:
+                sent.append(payload)
+        scenario.broker.add_observer(observe)
+        controller._command_cache.invalidate()
+
+        # With the worker stopped, the OSD command is still queued when the flood evicts it
+        controller._publisher.stop()
+        controller._seats[1].turn_on_osd()
+        flood_topic = controller._topics.esp_target("CV-NOBODY")
+        for _ in range(controller._publisher._lanes[_loader.load_module('publish_policy').LANE_CONFIG].max_depth):
+            controller._publisher.publish(flood_topic, "{}", plugin.CMD_WIFI)
+        controller._publisher.start()
+        scenario.settle()
+        check(not sent, "evicted command was sent: %s", sent)
+
+        controller._seats[1].turn_on_osd()
+        scenario.settle()
+        check(sent, "repeated command skipped after its first send was evicted")
+    finally:
+        scenario.close()
+
+def check_osd_failure(plugin):
+    scenario = Scenario(plugin, {'OSD_COALESCE_MS': 10})
+    try:
+        controller = scenario.controller
+        scenario.settle()
+        sent = []
+        seat_topics = {controller._topics.esp_seat[seat]: seat for seat in (0, 1)}
+        def observe(client, topic, payload):
+            if client is controller._mqttc._client and topic in seat_topics:
+                sent.append((seat_topics[topic], payload))
+        scenario.broker.add_observer(observe)
+
+        seat = controller._seats[0]
+        def fail_once(message):
+            del seat.set_message_direct
+            raise RuntimeError("publish failed")
+        seat.set_message_direct = fail_once
+
+        controller.set_messages_direct({0: "LOST", 1: "BATCH"})
+        scenario.settle()
+        controller.set_message_direct(0, "AFTER0")
+        controller.set_message_direct(1, "AFTER1")
+        scenario.settle()
+        texts = lambda seat_number: [payload for s, payload in sent if s == seat_number]
+        check(any(b"BATCH" in payload for payload in texts(1)), "seat 1 batch message not sent: %s", sent)
+        check(any(b"AFTER0" in payload for payload in texts(0)), "seat 0 stuck after the failure: %s", sent)
+        check(any(b"AFTER1" in payload for payload in texts(1)), "seat 1 stuck after the failure: %s", sent)
+        check(controller._osd_coalescer.pending == 0, "%d OSD messages still held", controller._osd_coalescer.pending)
+    finally:
+        scenario.close()
+
+CHECKS = {
+    'liveness': check_liveness,
+    'reconnect': check_reconnect,
+    'stall': check_stall,
+    'late_will': check_late_will,
+    'poller': check_poller,
+    'bad_seat': check_bad_seat,
+    'config_drop': check_config_drop,
+    'osd_failure': check_osd_failure,
+    'refused': check_refused,
+}
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rh-server", required=True, help="RotorHazard src/server directory")
+    parser.add_argument("--only", action="append", choices=sorted(CHECKS), help="run only these checks")
+    args = parser.parse_args()
+
+    plugin = _loader.load_plugin(args.rh_server)
+    failed = 0
+    for name in args.only or CHECKS:
+        try:
+            CHECKS[name](plugin)
+        except AssertionError as e:
+            failed += 1
+            print("FAIL %-12s %s" % (name, e))
+        else:
+            print("PASS %s" % name)
+    sys.exit(1 if failed else 0)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,220 @@
+'''Broker restart in the middle of a race
+
+Starts a local broker and a CV2Controller connected to it (with
+rh_standins), plus an observer standing in for the receivers, then records
+laps for each seat. Lap traffic stops, the broker is killed, one seat
+changes frequency while it is down, and the broker is restarted.
+
+Passes if, after the restart:
+
+  - the observer receives every entry of the controller's DesiredState
+    from the replay burst (no laps are sent after the outage, so user
+    messages can only come from the replay)
+  - a frequency command the controller sent before the outage is sent
+    again when repeated, since the command cache was cleared
+  - a receiver that joins after the restart is answered and marked ready,
+    so the controller's subscriptions came back (paho doesn't restore
+    them itself)
+
+Requires a RotorHazard checkout, clearview, gevent, paho-mqtt, monotonic and
+a broker executable, by default `mosquitto -p {port}`. Any broker works,
+e.g. --broker-cmd amqtt. The controller connects to HOST on MQTT's default
+port, so the broker listens on 1883:
+
+    python scenario_reconnect.py --rh-server ~/RotorHazard/src/server
+'''
+
+from gevent import monkey
+monkey.patch_all()
+
+import argparse
+import shlex
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+import paho.mqtt.client as mqtt_client
+
+import _loader
+import rh_standins
+
+NUM_SEATS = 8
+BROKER_PORT = 1883
+# Frequency seat 0 changes to while the broker is down
+OUTAGE_FREQUENCY = 5843
+
+class Broker:
+    def __init__(self, command, port):
+        self.command = shlex.split(command.format(port=port))
+        self.port = port
+        self.process = None
+
+    def start(self):
+        self.process = subprocess.Popen(self.command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        deadline = time.monotonic() + 10
+        while time.monotonic() < deadline:
+            try:
+                socket.create_connection(("localhost", self.port), timeout=0.5).close()
+                return
+            except OSError:
+                time.sleep(0.1)
+        raise RuntimeError("Broker did not start: %s" % " ".join(self.command))
+
+    def kill(self):
+        if self.process is not None:
+            self.process.kill()
+            self.process.wait()
+            self.process = None
+
+class Observer:
+    """Receives everything sent to the receivers' command topics"""
+    def __init__(self, port, topics):
+        self.received = []
+        self.lock = threading.Lock()
+        self.client = mqtt_client.Client(client_id="VRxReconnectObserver", clean_session=True)
+        self.client.on_connect = self.on_connect
+        self.client.on_message = self.on_message
+        self.client.reconnect_delay_set(0.1, 0.5)
+        self.filters = [topics.esp_all, topics.seat_prefix("receiver_command_esp_seat_topic") + "#"]
+        self.client.connect("localhost", port)
+        self.client.loop_start()
+
+    def on_connect(self, client, _userdata, _flags, _rc):
+        for topic_filter in self.filters:
+            client.subscribe(topic_filter, 1)
+
+    def on_message(self, _client, _userdata, message):
+        with self.lock:
+            self.received.append((time.monotonic(), message.topic, message.payload))
+
+    def since(self, start):
+        with self.lock:
+            return [(topic, payload) for received_at, topic, payload in self.received if received_at >= start]
+
+    def stop(self):
+        self.client.loop_stop()
+        self.client.disconnect()
+
+class Receiver:
+    """A receiver on the real broker, answering targeted queries from a CVCMState"""
+    def __init__(self, port, serial_num, seat_number):
+        cvcm_model = _loader.load_module('cvcm_model')
+        mqtt_topics = _loader.load_module('mqtt_topics')
+        self.state = cvcm_model.CVCMState(serial_num, seat_number)
+        self.response_topic = mqtt_topics.mqtt_subscribe_topics["cv1"]["receiver_response_targeted"][0] % serial_num
+        command_topic = mqtt_topics.format_topic(
+            mqtt_topics.mqtt_publish_topics["cv1"]["receiver_command_esp_targeted_topic"], serial_num=serial_num)
+        connection_topic = mqtt_topics.mqtt_subscribe_topics["cv1"]["receiver_connection"][0] % serial_num
+
+        self.client = mqtt_client.Client(client_id=serial_num, clean_session=True)
+        self.client.on_message = self.on_message
+        self.client.connect("localhost", port)
+        self.client.loop_start()
+        self.client.subscribe(command_topic, 1)
+        self.client.publish(connection_topic, 1, 1)
+
+    def on_message(self, client, _userdata, message):
+        try:
+            answer = self.state.handle(message.payload)
+        except ValueError:
+            return
+        if answer is not None:
+            client.publish(self.response_topic, answer)
+
+    def stop(self):
+        self.client.loop_stop()
+        self.client.disconnect()
+
+def wait_for(condition, timeout):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() >= deadline:
+            return False
+        time.sleep(0.05)
+    return True
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rh-server", required=True, help="RotorHazard src/server directory")
+    parser.add_argument("--broker-cmd", default="mosquitto -p {port}", help="command starting a broker on {port}")
+    parser.add_argument("--laps", type=int, default=5)
+    parser.add_argument("--lap-time", type=float, default=0.2, help="seconds between laps")
+    parser.add_argument("--outage", type=float, default=2.0, help="seconds the broker is down")
+    args = parser.parse_args()
+
+    plugin = _loader.load_plugin(args.rh_server)
+    broker = Broker(args.broker_cmd, BROKER_PORT)
+    broker.start()
+    # Reconnect quickly after the restart; frequency changes apply at once
+    controller, racecontext, _events = rh_standins.make_controller(
+        plugin, None, NUM_SEATS, {'CONNECT_RETRY_MAX_S': 1, 'FREQUENCY_COUNTDOWN_S': 0})
+    topics = controller._topics
+    observer = Observer(BROKER_PORT, topics)
+    receiver = None
+    failures = []
+    try:
+        for lap in range(1, args.laps + 1):
+            for seat in range(NUM_SEATS):
+                controller.onRaceLapRecorded({'node_index': seat,
+                                              'gap_info': rh_standins.gap_info(racecontext, seat, lap)})
+            time.sleep(args.lap_time)
+
+        # Every lap message is out before the outage, so none can pass for a replay
+        controller._publisher.drain(10)
+        time.sleep(0.5)
+        print("killing broker")
+        broker.kill()
+        controller.set_seat_frequency(0, OUTAGE_FREQUENCY)
+        time.sleep(args.outage)
+        restarted_at = time.monotonic()
+        broker.start()
+        print("broker restarted")
+
+        if not wait_for(lambda: controller._mqttc.reconnected and controller._mqttc.is_connected(), 10):
+            failures.append("controller did not reconnect")
+        controller._publisher.drain(10)
+        time.sleep(1)
+
+        received = set(observer.since(restarted_at))
+        expected = [(topic, payload) for topic, payload, _command in controller._desired_state.entries()]
+        missing = [entry for entry in expected if entry not in received]
+        print("desired state entries: %d, received after restart: %d, missing: %d"
+              % (len(expected), len(expected) - len(missing), len(missing)))
+        for topic, payload in missing:
+            print("  missing %s %s" % (topic, payload))
+        if missing:
+            failures.append("replay incomplete")
+
+        # Seat 1's frequency is unchanged; it is only sent again if the cache was cleared
+        seat_topic = topics.esp_seat[1]
+        sent_before = len([1 for topic, _payload in observer.since(restarted_at) if topic == seat_topic])
+        controller._seats[1].set_seat_frequency_direct(racecontext.interface.nodes[1].frequency)
+        controller._publisher.drain(10)
+        time.sleep(0.5)
+        sent_after = len([1 for topic, _payload in observer.since(restarted_at) if topic == seat_topic])
+        print("repeated seat 1 frequency: %d message(s) sent" % (sent_after - sent_before))
+        if sent_after == sent_before:
+            failures.append("command cache not cleared after reconnect")
+
+        receiver = Receiver(BROKER_PORT, "CV-AFTER-RESTART", NUM_SEATS - 1)
+        ready = wait_for(lambda: getattr(controller.devices.get("CV-AFTER-RESTART"), 'ready', False), 5)
+        print("receiver joining after restart: %s" % ("answered" if ready else "not answered"))
+        if not ready:
+            failures.append("no subscriptions after reconnect")
+    finally:
+        if receiver is not None:
+            receiver.stop()
+        observer.stop()
+        controller.onShutdown({})
+        controller._mqttc.loop_stop()
+        broker.kill()
+
+    if failures:
+        print("FAIL: %s" % ", ".join(failures))
+        sys.exit(1)
+    print("PASS")
+
+if __name__ == "__main__":
+    main()
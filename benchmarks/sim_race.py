@@ -0,0 +1,221 @@
+'''A race day replayed against CV2Controller
+
+Starts a CV2Controller on the in-process broker with emulated receivers,
+then runs heats through the controller's event handlers the way RotorHazard
+does: onHeatSet, onRaceStage, onRaceStart, a lap for every crossing,
+onRaceFinish, onRaceStop and onLapsClear. Crossings follow randomised lap
+times, replayed at --speed times real time (0 for as fast as possible).
+
+Reported per heat and for the day:
+  - lap to publish latency: from onRaceLapRecorded to the crossing seat's
+    OSD message reaching the broker, including the OSD_COALESCE_MS window
+  - CPU per lap: process CPU time during the laps, divided by the laps
+  - publishes: messages the controller sent, by topic
+
+Needs a RotorHazard checkout and clearview, like bench_suite.py's
+controller cases:
+
+    python sim_race.py --rh-server ~/RotorHazard/src/server --heats 10 --speed 20
+'''
+
+from gevent import monkey
+monkey.patch_all()
+
+import argparse
+import heapq
+import json
+import random
+import time
+import types
+
+import gevent
+
+import _loader
+import rh_standins
+from _timing import percentile
+from fake_broker import FakeBroker, FakeReceiver
+
+class LatencyProbe:
+    """Times each lap event to the next OSD message the controller publishes for that seat"""
+    def __init__(self, controller, topic_class):
+        self._sender = controller._mqttc._client
+        self._topic_class = topic_class
+        self._seat_topics = {controller._topics.esp_seat[seat]: seat for seat in range(controller.num_seats)}
+        self._pending = {}
+        self.latencies = []
+        self.publishes = {}
+
+    def lap(self, seat):
+        self._pending.setdefault(seat, []).append(time.perf_counter())
+
+    def observe(self, sender, topic, payload):
+        if sender is not self._sender:
+            return
+        label = self._topic_class(topic)
+        self.publishes[label] = self.publishes.get(label, 0) + 1
+
+        seat = self._seat_topics.get(topic)
+        if seat is not None and self._pending.get(seat) and payload.startswith(b'{"user_msg"'):
+            now = time.perf_counter()
+            self.latencies.extend(now - start for start in self._pending[seat])
+            self._pending[seat] = []
+
+    def take(self):
+        """Latencies and publishes since the last take"""
+        taken = (self.latencies, self.publishes)
+        self.latencies, self.publishes = [], {}
+        self._pending = {}
+        return taken
+
+def crossings(rng, seats, laps, lap_time, lap_spread):
+    """(seconds after the start, seat) for every crossing in a heat, in order"""
+    events = []
+    for seat in range(seats):
+        t = rng.uniform(1.0, 3.0)   # holeshot
+        events.append((t, seat))
+        for _lap in range(laps):
+            t += max(lap_time / 2, rng.gauss(lap_time, lap_spread))
+            events.append((t, seat))
+    heapq.heapify(events)
+    return [heapq.heappop(events) for _ in range(len(events))]
+
+def wait_until(start, seconds, speed):
+    if speed > 0:
+        delay = start + seconds / speed - time.perf_counter()
+        gevent.sleep(max(0, delay))
+    else:
+        gevent.sleep(0)
+
+def run_heat(controller, racecontext, probe, rng, heat_id, args):
+    race = racecontext.race
+    race.current_heat = heat_id
+    for laps in race.node_laps.values():
+        del laps[:]
+
+    controller.onHeatSet({'heat_id': heat_id})
+    controller.onRaceStage({})
+    wait_until(time.perf_counter(), 3.0, args.speed)
+    controller.onRaceStart({})
+    controller._publisher.drain(10)
+    probe.take()
+
+    handler_times = []
+    cpu_start = time.process_time()
+    start = time.perf_counter()
+    for at, seat in crossings(rng, args.seats, args.laps, args.lap_time, args.lap_spread):
+        wait_until(start, at, args.speed)
+        laps = race.node_laps[seat]
+        laps.append(types.SimpleNamespace(lap_time=int((at - (laps[-1].lap_time_stamp / 1000.0 if laps else 0)) * 1000),
+                                          lap_time_stamp=int(at * 1000), deleted=False))
+        probe.lap(seat)
+        handler_start = time.perf_counter()
+        controller.onRaceLapRecorded({'node_index': seat})
+        handler_times.append(time.perf_counter() - handler_start)
+
+    # Let the last coalesced messages go out before reading the numbers
+    gevent.sleep(float(controller.config['OSD_COALESCE_MS']) / 1000.0 * 2)
+    controller._publisher.drain(10)
+    cpu = time.process_time() - cpu_start
+    latencies, publishes = probe.take()
+
+    controller.onRaceFinish({})
+    controller.onRaceStop({})
+    controller.onLapsClear({})
+    controller._publisher.drain(10)
+    _latencies, after_race = probe.take()
+    for label, count in after_race.items():
+        publishes[label] = publishes.get(label, 0) + count
+
+    laps = sum(len(laps) for laps in race.node_laps.values())
+    return latencies, {
+        'heat': heat_id,
+        'laps': laps,
+        'cpu_ms_per_lap': round(cpu * 1000 / laps, 3) if laps else None,
+        'handler_us_p50': _us(percentile(sorted(handler_times), 0.5)),
+        'latency_ms': latency_summary(latencies),
+        'publishes': sum(publishes.values()),
+        'publishes_by_topic': publishes,
+    }
+
+def latency_summary(latencies):
+    latencies = sorted(latencies)
+    ms = lambda value: None if value is None else round(value * 1000, 2)
+    return {
+        'samples': len(latencies),
+        'p50': ms(percentile(latencies, 0.50)),
+        'p90': ms(percentile(latencies, 0.90)),
+        'p99': ms(percentile(latencies, 0.99)),
+        'max': ms(latencies[-1]) if latencies else None,
+    }
+
+def _us(value):
+    return None if value is None else round(value * 1e6, 1)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rh-server", required=True, help="RotorHazard src/server directory")
+    parser.add_argument("--heats", type=int, default=10)
+    parser.add_argument("--seats", type=int, default=8)
+    parser.add_argument("--laps", type=int, default=5, help="laps per pilot after the holeshot")
+    parser.add_argument("--lap-time", type=float, default=25.0, help="mean lap time in seconds")
+    parser.add_argument("--lap-spread", type=float, default=3.0, help="standard deviation of lap times in seconds")
+    parser.add_argument("--speed", type=float, default=10.0, help="times real time, 0 for as fast as possible")
+    parser.add_argument("--receivers", type=int, default=8, help="emulated receivers, spread across the seats")
+    parser.add_argument("--coalesce-ms", type=float, help="OSD_COALESCE_MS for the controller")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="write the results to this JSON file")
+    args = parser.parse_args()
+
+    plugin = _loader.load_plugin(args.rh_server)
+    mqtt_topics = _loader.load_module('mqtt_topics')
+
+    config = {}
+    if args.coalesce_ms is not None:
+        config['OSD_COALESCE_MS'] = args.coalesce_ms
+    broker = FakeBroker()
+    broker.start()
+    controller, racecontext, _events = rh_standins.make_controller(plugin, broker, args.seats, config, args.heats)
+    receivers = [FakeReceiver(broker, "CV-SIM-%04d" % n, n % args.seats) for n in range(args.receivers)]
+    controller._publisher.drain(10)
+    gevent.sleep(0.1)
+
+    probe = LatencyProbe(controller, mqtt_topics.topic_class)
+    broker.add_observer(probe.observe)
+    rng = random.Random(args.seed)
+
+    print("%5s %6s %13s %10s %10s %10s %10s %10s" % (
+        "heat", "laps", "cpu ms/lap", "handler us", "lat p50 ms", "lat p99 ms", "lat max ms", "publishes"))
+    heats = []
+    all_latencies = []
+    for heat_id in range(1, args.heats + 1):
+        latencies, heat = run_heat(controller, racecontext, probe, rng, heat_id, args)
+        heats.append(heat)
+        all_latencies.extend(latencies)
+        print("%5d %6d %13s %10s %10s %10s %10s %10d" % (
+            heat['heat'], heat['laps'], heat['cpu_ms_per_lap'], heat['handler_us_p50'],
+            heat['latency_ms']['p50'], heat['latency_ms']['p99'], heat['latency_ms']['max'], heat['publishes']))
+
+    total_laps = sum(heat['laps'] for heat in heats)
+    summary = {
+        'heats': len(heats),
+        'laps': total_laps,
+        'cpu_ms_per_lap': round(sum(heat['cpu_ms_per_lap'] * heat['laps'] for heat in heats) / total_laps, 3),
+        'latency_ms': latency_summary(all_latencies),
+        'publishes_per_race': round(sum(heat['publishes'] for heat in heats) / len(heats), 1),
+        'receiver_commands': sum(receiver.commands for receiver in receivers),
+        'controller': {'publish': controller.publish_stats, 'collapsed_messages': controller.collapsed_message_count},
+    }
+    print()
+    print("%d laps in %d heats: %.3f ms CPU per lap, %.1f publishes per race, %d commands received by receivers" % (
+        total_laps, len(heats), summary['cpu_ms_per_lap'], summary['publishes_per_race'], summary['receiver_commands']))
+    print("lap to publish latency: p50 %(p50)s ms, p90 %(p90)s ms, p99 %(p99)s ms, max %(max)s ms" % summary['latency_ms'])
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({'args': vars(args), 'summary': summary, 'heats': heats}, f, indent=2, sort_keys=True, default=str)
+
+    controller.onShutdown({})
+    broker.stop()
+
+if __name__ == "__main__":
+    main()
@@ -4,10 +4,15 @@ import paho.mqtt.client as mqtt_client
 import socket
 import argparse
 import logging
+import random
+import threading
 
 # mqtt topics are flipped for the VRX
 from .mqtt_topics import mqtt_publish_topics as mqtt_sub_topics
 from .mqtt_topics import mqtt_subscribe_topics as mqtt_pub_topics
+from .mqtt_topics import format_topic, topic_class
+from .cvcm_model import CVCMState, ResponseShaper, add_shaper_arguments, shaper_from_args
+from .mqtt_capture import CaptureWriter
 
 from paho.mqtt.client import topic_matches_sub
 from paho.mqtt.client import CONNACK_ACCEPTED
@@ -19,14 +24,41 @@ from paho.mqtt.client import CONNACK_REFUSED_NOT_AUTHORIZED
 
 import time
 
+def payload_size(payload):
+    """Bytes paho sends for a payload"""
+    if payload is None:
+        return 0
+    if isinstance(payload, (bytes, bytearray)):
+        return len(payload)
+    if isinstance(payload, str):
+        return len(payload.encode('utf-8'))
+    return len(str(payload))
+
 class MQTT_Client:
     """General Purpose MQTT Client"""
-    def __init__(self, client_id, broker_ip, subscribe_topics=None, node_number=0,debug=False):
+    def __init__(self, client_id, broker_ip, subscribe_topics=None, node_number=0,debug=False,
+                 broker_port=1883, connect_async=False, backoff_range=(1, 60), metrics=None,
+                 client_factory=None, capture=None):
+        """connect_async: connect from a background thread with capped exponential
+        backoff and jitter instead of blocking until the broker answers.
+        backoff_range: (min, max) seconds between connection attempts.
+        metrics: a MetricsRegistry counting published messages and bytes per topic class.
+        client_factory: called like paho's Client to make the underlying client; defaults to paho's Client.
+        capture: a CaptureWriter recording every message published and received.
+        """
         self._client_id = client_id
         self._broker_ip = broker_ip
+        self._broker_port = broker_port
         self._subscribe_topics_dict_at_start = subscribe_topics
         self._subscribed_topics = {}
+        self._subscriptions = {}
+        self._publish_callbacks = []
+        self._connect_callbacks = []
         self._debug = debug
+        self._connect_async = connect_async
+        self._backoff_range = backoff_range
+        self._metrics = metrics if metrics is not None and metrics.enabled else None
+        self._capture = capture
         #TODO I don't think the node number should be in here.
         # subscribed topics should be supplied preformatted using a helper written here
 
@@ -38,7 +70,9 @@ class MQTT_Client:
             raise ValueError("Node number out of range")
 
         # Start MQTT Client
-        self._client = mqtt_client.Client(client_id=client_id, clean_session=True)
+        if client_factory is None:
+            client_factory = mqtt_client.Client
+        self._client = client_factory(client_id=client_id, clean_session=True)
 
         self._set_will()
         self._bind_log_callback()
@@ -53,10 +87,31 @@ class MQTT_Client:
         self._client.on_disconnect = self.on_disconnect
         # self._client.on_subscribe = self.on_subscribe
 
+        self.loop_forever = self._client.loop_forever
+        if self._capture is None:
+            self.message_callback_add = self._client.message_callback_add
+        else:
+            self.message_callback_add = self._capturing_callback_add
+        self.message_callback_remove = self._client.message_callback_remove
+
         self._connected_mqtt = False
+        self._connect_count = 0
+        self._loop_requested = False
+        self._stopped = threading.Event()
+        self._connect_lock = threading.Lock()
+
+        if self._connect_async:
+            # paho's own reconnects after a later disconnect use the same bounds
+            self._client.reconnect_delay_set(*self._backoff_range)
+            self._connect_thread = threading.Thread(target=self._connect_with_backoff,
+                                                    name="MQTT connect %s"%self._client_id,
+                                                    daemon=True)
+            self._connect_thread.start()
+            return
+
         while not self._connected_mqtt:
             try:
-                self._client.connect(self._broker_ip)
+                self._client.connect(self._broker_ip, self._broker_port)
                 self._subscribe_start()
 
             except socket.gaierror as e:
@@ -69,13 +124,88 @@ class MQTT_Client:
             else:
                 self._connected_mqtt = True
 
-        self.loop_start = self._client.loop_start
-        self.loop_forever = self._client.loop_forever
-        self.message_callback_add = self._client.message_callback_add
-        self.message_callback_remove = self._client.message_callback_remove
-        self.subscribe = self._client.subscribe
+    def _connect_with_backoff(self):
+        """Connect in the background, doubling the wait after each failure up to the maximum"""
+        min_delay, max_delay = self._backoff_range
+        delay = min_delay
+        while True:
+            if self._stopped.is_set():
+                return
+            try:
+                self._client.connect(self._broker_ip, self._broker_port)
+            except (socket.error, OSError) as e:
+                # Jitter keeps many clients from retrying in lockstep after a broker restart
+                retry_time = delay / 2 + random.uniform(0, delay / 2)
+                self.logger.error("MQTT broker not reachable at '{0}' ({1}). Retrying in {2:.1f} seconds...".format(self._broker_ip, e, retry_time))
+                self._stopped.wait(retry_time)
+                delay = min(delay * 2, max_delay)
+            else:
+                break
+
+        with self._connect_lock:
+            if self._stopped.is_set():
+                self._client.disconnect()
+                return
+            self._connected_mqtt = True
+            start_loop = self._loop_requested
+
+        self._subscribe_start()
+        for topic, qos in list(self._subscriptions.items()):
+            self._client.subscribe(topic, qos)
+
+        if start_loop:
+            self._client.loop_start()
+
+    def loop_start(self):
+        """Start the network loop thread, or with connect_async, once the first connection is made"""
+        with self._connect_lock:
+            if self._connect_async and not self._connected_mqtt:
+                self._loop_requested = True
+                return
+        self._client.loop_start()
+
+    def loop_stop(self):
+        """Stop the network loop thread, and with connect_async any connection attempts still retrying"""
+        with self._connect_lock:
+            self._stopped.set()
+            self._loop_requested = False
+        self._client.loop_stop()
+
+    def subscribe(self, topic, qos=0):
+        """Subscribe to topic, now if there is a connection or as soon as there is one"""
+        self._subscriptions[topic] = qos
+        if self._connected_mqtt:
+            return self._client.subscribe(topic, qos)
+        return None
+
+    def unsubscribe(self, topic):
+        """Unsubscribe from topic and stop subscribing to it on reconnect"""
+        self._subscriptions.pop(topic, None)
+        for key, subscribed in list(self._subscribed_topics.items()):
+            if subscribed == topic:
+                del self._subscribed_topics[key]
+        if self._connected_mqtt:
+            return self._client.unsubscribe(topic)
+        return None
+
+    def is_connected(self):
+        return self._client.is_connected()
+
+    def add_connect_callback(self, callback):
+        """Call callback() each time the broker accepts a connection, including reconnects"""
+        self._connect_callbacks.append(callback)
+
+    def _capturing_callback_add(self, sub, callback):
+        """message_callback_add, recording each message before callback sees it"""
+        capture = self._capture
+        def captured(client, userdata, message):
+            capture.incoming(message.topic, message.payload)
+            callback(client, userdata, message)
+        self._client.message_callback_add(sub, captured)
 
     def on_message(self,client, userdata, message):
+        if self._capture is not None:
+            self._capture.incoming(message.topic, message.payload)
         self.logger.warning("Warning: Uncaptured message topic received: \n\t*Topic '%s'\n\t*Message:'%s'"%(message.topic,message.payload.strip()))
         self.logger.warning("\tIf this happens, make sure to bind the message to a function if subscribed to it.")
 
@@ -84,6 +214,14 @@ class MQTT_Client:
             self.logger.info("on_message TODO sloppy fallback. Captured direct response from %s", message.topic.split('/')[-1])
             #try parsing
 
+    def on_publish(self, client, userdata, mid):
+        for callback in self._publish_callbacks:
+            callback(client, userdata, mid)
+
+    def add_publish_callback(self, callback):
+        """Call callback(client, userdata, mid) when a message has been sent (QoS 0) or acknowledged (QoS 1 and 2)"""
+        self._publish_callbacks.append(callback)
+
     def on_subscribe(self,client, userdata, mid, granted_qos):
         raise NotImplementedError
 
@@ -105,6 +243,7 @@ class MQTT_Client:
     
     def _bind_message_callbacks(self):
         self._client.on_message = self.on_message
+        self._client.on_publish = self.on_publish
 
 
     def _bind_log_callback(self):
@@ -120,26 +259,11 @@ class MQTT_Client:
             for rec_ver in subscribe_topics:
                 rec_topics = subscribe_topics[rec_ver]
                 for topic_key in rec_topics:
-                    rec_topic = rec_topics[topic_key]
                     # Format with subtopics if they exist
-                    
-                    formatter_name = rec_topic[1]
-                    
-                    if formatter_name == "node_number":
-                        rec_topic = rec_topic[0]%self._node_number
-                    elif formatter_name == "receiver_serial_num":
-                        rec_topic = rec_topic[0]%self._client_id
-                    elif formatter_name in ["#","+"]:   # subscibe to all at single level (+) or recursively all (#)
-                        rec_topic = rec_topic[0]%formatter_name
-                    elif formatter_name is None:
-                        rec_topic = rec_topic[0]
-                    elif isinstance(rec_topic,tuple):
-                        raise ValueError("Uncaptured formatter_name: %s"%formatter_name)
-                    elif isinstance(rec_topic,str):
-                        pass
-                    else:
-                        raise TypeError("rec_topic not of correct type: %s"%rec_topic)
-                    
+                    rec_topic = format_topic(rec_topics[topic_key],
+                                             seat_number=self._node_number,
+                                             serial_num=self._client_id)
+
                     self._client.subscribe(rec_topic)
                     # TODO use a factory method to add callbacks dynamically
                     # https://www.freecodecamp.org/news/dynamic-class-definition-in-python-3e6f7d20a381/
@@ -161,6 +285,26 @@ class MQTT_Client:
         payload = 1
         self.publish(topic,payload)
 
+        self._connected_mqtt = True
+        self._connect_count += 1
+        if self._connect_count > 1:
+            self._resubscribe()
+        for callback in self._connect_callbacks:
+            callback()
+
+    def _resubscribe(self):
+        """Subscribe again to every filter after a reconnect; the broker forgets them with a clean session"""
+        topics = dict(self._subscriptions)
+        for topic in self._subscribed_topics.values():
+            topics.setdefault(topic, 0)
+        for topic, qos in topics.items():
+            self._client.subscribe(topic, qos)
+        self.logger.info("Resubscribed to %d topics after reconnect", len(topics))
+
+    @property
+    def reconnected(self):
+        """True once the broker has accepted a connection more than once"""
+        return self._connect_count > 1
         
 
     def on_disconnect(self, client, userdata, rc):
@@ -170,7 +314,13 @@ class MQTT_Client:
         self._connected_mqtt = False
 
     def publish(self, topic, payload=None, qos=1, retain=False, properties=None):
-        self._client.publish( topic, payload, qos, retain, properties)
+        if self._metrics is not None:
+            label = topic_class(topic)
+            self._metrics.count("published_messages", label)
+            self._metrics.count("published_bytes", label, payload_size(payload))
+        if self._capture is not None:
+            self._capture.outgoing(topic, payload)
+        return self._client.publish( topic, payload, qos, retain, properties)
 
     def disconnect_gracefully(self):
         self.logger.info("Gracefully disconnecting from broker")
@@ -200,15 +350,19 @@ If you have an ESP32, flash the ESP32 with the software and hook up a serial por
 Then, run the clearview's simulator linked to the serial port
 """
 class VRxCV_emulator:
-    def __init__(self, protocol_version, serial_num, broker_ip, node_number):
+    def __init__(self, protocol_version, serial_num, broker_ip, node_number, shaper=None, capture=None):
         self._protocol_version = protocol_version
         self._serial_num = serial_num
+        self._node_number = node_number
+        self._cvcm = CVCMState(serial_num, node_number)
+        self._shaper = shaper or ResponseShaper()
+        self._response_topic = mqtt_pub_topics["cv1"]["receiver_response_targeted"][0]%serial_num
         self._mqttc = MQTT_Client(client_id=serial_num, 
                                     broker_ip=broker_ip, 
                                     subscribe_topics=mqtt_sub_topics,
-                                    node_number=node_number)
+                                    node_number=node_number,
+                                    capture=capture)
         self._add_message_callbacks()
-        self._node_number = node_number
 
     
         try:
@@ -216,39 +370,66 @@ class VRxCV_emulator:
             #self._mqttc.loop_start()
         except KeyboardInterrupt:
             self._mqttc.disconnect_gracefully()
+        finally:
+            if capture is not None:
+                capture.close()
 
     def _on_message_kick(self, _client, _userdata, _message):
         self._mqttc.disconnect_gracefully()
 
+    def _on_message_command(self, _client, _userdata, message):
+        """Apply an ESP command to the CVCM model and answer any queries in it"""
+        previous_seat = self._cvcm.seat_number
+        try:
+            answer = self._cvcm.handle(message.payload)
+        except ValueError:
+            self._mqttc.logger.warning("Ignoring command that isn't a JSON object: %s"%message.payload)
+            return
+        if self._cvcm.seat_number != previous_seat:
+            self._move_seat(previous_seat, self._cvcm.seat_number)
+        if answer is None:
+            return
+
+        now = time.monotonic()
+        send_at = self._shaper.schedule(now)
+        if send_at is None:
+            return
+        delay = send_at - now
+        if delay > 0:
+            timer = threading.Timer(delay, self._mqttc.publish, (self._response_topic, answer))
+            timer.daemon = True
+            timer.start()
+        else:
+            self._mqttc.publish(self._response_topic, answer)
+
+    def _move_seat(self, previous_seat, seat_number):
+        """Listen to the new seat's commands instead of the old seat's"""
+        seat_topic = mqtt_sub_topics["cv1"]["receiver_command_esp_seat_topic"]
+        old_topic = format_topic(seat_topic, seat_number=previous_seat)
+        new_topic = format_topic(seat_topic, seat_number=seat_number)
+        self._mqttc.message_callback_remove(old_topic)
+        self._mqttc.unsubscribe(old_topic)
+        self._mqttc.message_callback_add(new_topic, self._on_message_command)
+        self._mqttc.subscribe(new_topic)
+        self._node_number = seat_number
+
     def _add_message_callbacks(self):
 
         cv1_topics = mqtt_sub_topics["cv1"]
 
         callbacks_and_topics = {
-            self._on_message_kick: cv1_topics["receiver_kick_topic"]
+            cv1_topics["receiver_kick_topic"]: self._on_message_kick,
+            cv1_topics["receiver_command_esp_all_topic"]: self._on_message_command,
+            cv1_topics["receiver_command_esp_seat_topic"]: self._on_message_command,
+            cv1_topics["receiver_command_esp_targeted_topic"]: self._on_message_command,
         }
 
 
-        for callback in callbacks_and_topics:
-            rec_topic = callbacks_and_topics[callback]
-
-            formatter_name = rec_topic[1]
-                  
-            if formatter_name == "node_number":
-                rec_topic = rec_topic[0]%self._node_number
-            elif formatter_name == "receiver_serial_num":
-                rec_topic = rec_topic[0]%self._serial_num
-            elif formatter_name in ["#","*"]:   # subscibe to all at level (*) or recursively all (#)
-                rec_topic = rec_topic[0]%formatter_name
-            elif formatter_name is None:
-                rec_topic = rec_topic[0]
-            elif isinstance(rec_topic,tuple):
-                raise ValueError("Uncaptured formatter_name: %s"%formatter_name)
-            elif isinstance(rec_topic,str):
-                pass
-            else:
-                raise TypeError("rec_topic not of correct type: %s"%rec_topic)
-                    
+        for topic, callback in callbacks_and_topics.items():
+            rec_topic = format_topic(topic,
+                                     seat_number=self._node_number,
+                                     serial_num=self._serial_num)
+
             #self.logger.debug("\tBinding callback \n\t\t*Function: 'self.%s'\n\t\t*Topic: '%s'"%(callback.__name__,rec_topic))
             self._mqttc.message_callback_add(rec_topic, 
                                              callback)
@@ -269,10 +450,19 @@ def main():
     parser.add_argument("-a","--address", 
                         default = "localhost", 
                         help = "mqtt broker ip address or hostname")
+    parser.add_argument("-n","--seat",
+                        type = int,
+                        default = 0,
+                        help = "seat the receiver starts on")
+    parser.add_argument("--capture",
+                        help = "append the receiver's MQTT traffic to this capture file")
+    add_shaper_arguments(parser)
 
     args = parser.parse_args()
 
-    _vrx = VRxCV_emulator("1.0", args.serial_number,args.address,node_number=0 )
+    _vrx = VRxCV_emulator("1.0", args.serial_number,args.address,node_number=args.seat,
+                          shaper=shaper_from_args(args),
+                          capture=CaptureWriter(args.capture) if args.capture else None)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,365 @@
+#VRxCV1_fleet.py
+'''Many emulated CV1 receivers in one process
+
+Each receiver has its own MQTT connection, serial number, seat, last will
+and connection topic, like a VRxCV_emulator. Instead of a network thread per
+client, every paho client is driven from one selectors loop through paho's
+external loop callbacks, so hundreds of receivers fit in one process.
+
+Receivers answer status and lock queries from a CVCMState, with each
+answer's timing set by the receiver's ResponseShaper.
+'''
+
+import argparse
+import bisect
+import heapq
+import itertools
+import logging
+import selectors
+import time
+
+import paho.mqtt.client as mqtt_client
+
+# mqtt topics are flipped for the VRX
+from .mqtt_topics import mqtt_publish_topics as mqtt_sub_topics
+from .mqtt_topics import mqtt_subscribe_topics as mqtt_pub_topics
+from .mqtt_topics import format_topic
+from .cvcm_model import CVCMState, ResponseShaper, add_shaper_arguments, shaper_from_args
+
+logger = logging.getLogger(__name__)
+
+# Seconds between paho housekeeping calls (keepalive pings, retries)
+MISC_INTERVAL = 1.0
+RECONNECT_DELAY = (1.0, 30.0)
+
+class LagHistogram:
+    """Counts of delays in buckets doubling from 0.1 ms
+
+    Histograms from several fleets merge exactly by adding their counts.
+    """
+    BOUNDS = tuple(0.0001 * 2 ** n for n in range(17))  # up to 6.5 s
+
+    def __init__(self):
+        self.counts = [0] * (len(self.BOUNDS) + 1)
+        self.maximum = 0.0
+
+    def add(self, seconds):
+        self.counts[bisect.bisect_left(self.BOUNDS, seconds)] += 1
+        if seconds > self.maximum:
+            self.maximum = seconds
+
+    def merge(self, other):
+        self.counts = [a + b for a, b in zip(self.counts, other.counts)]
+        self.maximum = max(self.maximum, other.maximum)
+
+    @property
+    def total(self):
+        return sum(self.counts)
+
+    def percentile(self, fraction):
+        """Upper bound of the bucket holding the given fraction of delays, None if empty"""
+        total = self.total
+        if not total:
+            return None
+        rank = fraction * total
+        seen = 0
+        for bound, count in zip(self.BOUNDS, self.counts):
+            seen += count
+            if seen >= rank:
+                return min(bound, self.maximum)
+        return self.maximum
+
+    def take(self):
+        """A copy of the histogram, which is then cleared"""
+        taken = LagHistogram()
+        taken.counts, taken.maximum = self.counts, self.maximum
+        self.counts = [0] * len(self.counts)
+        self.maximum = 0.0
+        return taken
+
+class EmulatedReceiver:
+    """One receiver's MQTT connection and counters"""
+    def __init__(self, serial_num, seat_number, shaper=None, rx_type="cv1"):
+        self.serial_num = serial_num
+        self.seat_number = seat_number
+        self.connected = False
+        self.created_at = time.monotonic()
+        self.connected_at = None
+        self.first_targeted_at = None
+        self.messages = 0
+        self.kicked = False
+        self.reconnect_at = None
+        self.reconnect_delay = RECONNECT_DELAY[0]
+        self.cvcm = CVCMState(serial_num, seat_number)
+        self.shaper = shaper or ResponseShaper()
+        # send_later(send_at, receiver, topic, payload) is set by the Fleet
+        self.send_later = None
+
+        self.response_topic = mqtt_pub_topics[rx_type]["receiver_response_targeted"][0]%serial_num
+        self.connection_topic = mqtt_pub_topics[rx_type]["receiver_connection"][0]%serial_num
+        rx_topics = mqtt_sub_topics[rx_type]
+        self._seat_topic = rx_topics["receiver_command_esp_seat_topic"]
+        self.kick_topic = format_topic(rx_topics["receiver_kick_topic"], serial_num=serial_num)
+        self.targeted_topic = format_topic(rx_topics["receiver_command_esp_targeted_topic"], serial_num=serial_num)
+        self.command_topics = [
+            format_topic(rx_topics["receiver_command_esp_all_topic"]),
+            format_topic(self._seat_topic, seat_number=seat_number),
+            self.targeted_topic,
+            self.kick_topic,
+        ]
+
+        self.client = mqtt_client.Client(client_id=serial_num, clean_session=True, userdata=self)
+        # -1 on the connection topic tells the controller the receiver dropped off
+        self.client.will_set(self.connection_topic, -1, 1, retain=False)
+        self.client.on_connect = self.on_connect
+        self.client.on_disconnect = self.on_disconnect
+        self.client.on_message = self.on_message
+
+    def on_connect(self, client, _userdata, _flags, rc):
+        if rc != 0:
+            logger.error("%s refused by broker: %s", self.serial_num, mqtt_client.connack_string(rc))
+            return
+        self.connected = True
+        if self.connected_at is None:
+            self.connected_at = time.monotonic()
+        self.reconnect_delay = RECONNECT_DELAY[0]
+        for topic in self.command_topics:
+            client.subscribe(topic)
+        client.publish(self.connection_topic, 1, qos=1)
+
+    def on_disconnect(self, _client, _userdata, rc):
+        self.connected = False
+        if rc != mqtt_client.MQTT_ERR_SUCCESS and not self.kicked:
+            self.reconnect_at = time.monotonic() + self.reconnect_delay
+            self.reconnect_delay = min(self.reconnect_delay * 2, RECONNECT_DELAY[1])
+
+    def on_message(self, client, _userdata, message):
+        self.messages += 1
+        if message.topic == self.kick_topic:
+            logger.info("%s kicked", self.serial_num)
+            self.kicked = True
+            client.publish(self.connection_topic, 0, qos=1)
+            client.disconnect()
+            return
+        if message.topic == self.targeted_topic and self.first_targeted_at is None:
+            # The controller addresses a receiver directly once it has discovered it
+            self.first_targeted_at = time.monotonic()
+        self.handle_command(message)
+
+    def handle_command(self, message):
+        """Apply a command to the CVCM model and answer any queries in it"""
+        previous_seat = self.cvcm.seat_number
+        try:
+            answer = self.cvcm.handle(message.payload)
+        except ValueError:
+            logger.warning("%s ignoring command that isn't a JSON object: %s", self.serial_num, message.payload)
+            return
+        if self.cvcm.seat_number != previous_seat:
+            self._move_seat(previous_seat, self.cvcm.seat_number)
+        if answer is None:
+            return
+
+        now = time.monotonic()
+        send_at = self.shaper.schedule(now)
+        if send_at is None:
+            return
+        if self.send_later is None:
+            self.client.publish(self.response_topic, answer)
+        else:
+            # Answers due now go out once the messages already read are handled
+            self.send_later(send_at, self, self.response_topic, answer)
+
+    def _move_seat(self, previous_seat, seat_number):
+        old_topic = format_topic(self._seat_topic, seat_number=previous_seat)
+        new_topic = format_topic(self._seat_topic, seat_number=seat_number)
+        self.command_topics[self.command_topics.index(old_topic)] = new_topic
+        self.seat_number = seat_number
+        if self.connected:
+            self.client.unsubscribe(old_topic)
+            self.client.subscribe(new_topic)
+
+    @property
+    def connect_time(self):
+        if self.connected_at is None:
+            return None
+        return self.connected_at - self.created_at
+
+    @property
+    def discovery_time(self):
+        if self.connected_at is None or self.first_targeted_at is None:
+            return None
+        return self.first_targeted_at - self.connected_at
+
+class Fleet:
+    """Drives every receiver's paho client from one selector"""
+    def __init__(self, broker_ip, broker_port=1883, receiver_factory=EmulatedReceiver, shaper_factory=ResponseShaper):
+        self.broker_ip = broker_ip
+        self.broker_port = broker_port
+        self._receiver_factory = receiver_factory
+        self._shaper_factory = shaper_factory
+        self._selector = selectors.DefaultSelector()
+        self.receivers = []
+        self._next_misc = 0.0
+        # Answers waiting for their send time: (send_at, sequence, receiver, topic, payload)
+        self._responses = []
+        self._sequence = itertools.count()
+        # How late answers go out after their send time, a sign of this process falling behind
+        self.answer_lag = LagHistogram()
+
+    def add(self, serial_num, seat_number):
+        receiver = self._receiver_factory(serial_num, seat_number, self._shaper_factory())
+        receiver.send_later = self._send_later
+        client = receiver.client
+        client.on_socket_open = self._on_socket_open
+        client.on_socket_close = self._on_socket_close
+        client.on_socket_register_write = self._on_socket_register_write
+        client.on_socket_unregister_write = self._on_socket_unregister_write
+        self.receivers.append(receiver)
+        self._connect(receiver)
+        return receiver
+
+    def ramp(self, count, seats=8, prefix="CV-FLEET"):
+        """Add receivers until there are count, spread across seats"""
+        while len(self.receivers) < count:
+            n = len(self.receivers)
+            self.add("%s-%04d" % (prefix, n), n % seats)
+
+    def stop(self):
+        for receiver in self.receivers:
+            receiver.kicked = True
+            if receiver.connected:
+                receiver.client.publish(receiver.connection_topic, 0, qos=1)
+                receiver.client.disconnect()
+        self.run(0.5)
+
+    def run(self, duration):
+        """Service every connection for duration seconds"""
+        deadline = time.monotonic() + duration
+        while True:
+            now = time.monotonic()
+            if now >= deadline:
+                return
+            self.run_once(min(MISC_INTERVAL, deadline - now))
+
+    def run_once(self, timeout):
+        if self._responses:
+            timeout = max(0, min(timeout, self._responses[0][0] - time.monotonic()))
+        if self._selector.get_map():
+            events = self._selector.select(timeout)
+        else:
+            time.sleep(timeout)
+            events = ()
+        for key, mask in events:
+            client = key.data
+            if mask & selectors.EVENT_READ:
+                client.loop_read()
+            if mask & selectors.EVENT_WRITE:
+                client.loop_write()
+
+        now = time.monotonic()
+        while self._responses and self._responses[0][0] <= now:
+            send_at, _sequence, receiver, topic, payload = heapq.heappop(self._responses)
+            if receiver.connected:
+                receiver.client.publish(topic, payload)
+                self.answer_lag.add(time.monotonic() - send_at)
+
+        if now >= self._next_misc:
+            self._next_misc = now + MISC_INTERVAL
+            for receiver in self.receivers:
+                if receiver.reconnect_at is not None and now >= receiver.reconnect_at:
+                    receiver.reconnect_at = None
+                    self._connect(receiver)
+                receiver.client.loop_misc()
+
+    def stats(self):
+        connect = sorted(r.connect_time for r in self.receivers if r.connect_time is not None)
+        discovery = sorted(r.discovery_time for r in self.receivers if r.discovery_time is not None)
+        return {
+            'receivers': len(self.receivers),
+            'connected': sum(r.connected for r in self.receivers),
+            'discovered': len(discovery),
+            'messages': sum(r.messages for r in self.receivers),
+            'answers': sum(r.shaper.sent for r in self.receivers),
+            'answers_lost': sum(r.shaper.lost + r.shaper.overflowed for r in self.receivers),
+            'connect_max_s': connect[-1] if connect else None,
+            'discovery_p50_s': discovery[len(discovery) // 2] if discovery else None,
+            'discovery_max_s': discovery[-1] if discovery else None,
+            'answer_lag_p99_s': self.answer_lag.percentile(0.99),
+            'cpu_s': time.process_time(),
+        }
+
+    def _send_later(self, send_at, receiver, topic, payload):
+        heapq.heappush(self._responses, (send_at, next(self._sequence), receiver, topic, payload))
+
+    def _connect(self, receiver):
+        try:
+            receiver.client.connect(self.broker_ip, self.broker_port)
+        except OSError as e:
+            logger.warning("%s unable to connect: %s", receiver.serial_num, e)
+            receiver.reconnect_at = time.monotonic() + receiver.reconnect_delay
+            receiver.reconnect_delay = min(receiver.reconnect_delay * 2, RECONNECT_DELAY[1])
+
+    def _on_socket_open(self, client, _userdata, sock):
+        self._selector.register(sock, selectors.EVENT_READ, client)
+
+    def _on_socket_close(self, _client, _userdata, sock):
+        try:
+            self._selector.unregister(sock)
+        except (KeyError, ValueError):
+            pass
+
+    def _on_socket_register_write(self, client, _userdata, sock):
+        self._selector.modify(sock, selectors.EVENT_READ | selectors.EVENT_WRITE, client)
+
+    def _on_socket_unregister_write(self, client, _userdata, sock):
+        try:
+            self._selector.modify(sock, selectors.EVENT_READ, client)
+        except (KeyError, ValueError):
+            pass
+
+def _seconds(value):
+    return "-" if value is None else "%.3f" % value
+
+def main():
+    parser = argparse.ArgumentParser(description="Emulate a fleet of CV1 receivers, adding receivers in steps")
+    parser.add_argument("-a","--address",
+                        default = "localhost",
+                        help = "mqtt broker ip address or hostname")
+    parser.add_argument("-p", "--port", type=int, default=1883)
+    parser.add_argument("--start", type=int, default=8, help="receivers in the first step")
+    parser.add_argument("--step", type=int, default=8, help="receivers added per step")
+    parser.add_argument("--max", type=int, default=64, help="receivers in the last step")
+    parser.add_argument("--hold", type=float, default=10.0, help="seconds per step")
+    parser.add_argument("--seats", type=int, default=8)
+    parser.add_argument("--prefix", default="CV-FLEET", help="serial number prefix")
+    add_shaper_arguments(parser)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    fleet = Fleet(args.address, args.port, shaper_factory=lambda: shaper_from_args(args))
+    print("%9s %9s %11s %10s %9s %8s %13s %13s %10s" % (
+        "receivers", "connected", "connect max", "discovered", "messages", "answers",
+        "discovery p50", "discovery max", "step cpu s"))
+    count = args.start
+    cpu = time.process_time()
+    try:
+        while True:
+            fleet.ramp(count, args.seats, args.prefix)
+            fleet.run(args.hold)
+            stats = fleet.stats()
+            print("%9d %9d %11s %10d %9d %8d %13s %13s %10.2f" % (
+                stats['receivers'], stats['connected'], _seconds(stats['connect_max_s']),
+                stats['discovered'], stats['messages'], stats['answers'],
+                _seconds(stats['discovery_p50_s']), _seconds(stats['discovery_max_s']),
+                stats['cpu_s'] - cpu))
+            cpu = stats['cpu_s']
+            if count >= args.max:
+                break
+            count = min(count + args.step, args.max)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        fleet.stop()
+
+if __name__ == "__main__":
+    main()
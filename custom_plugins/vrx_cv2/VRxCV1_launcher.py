@@ -0,0 +1,254 @@
+#VRxCV1_launcher.py
+'''Emulated CV1 receivers spread across worker processes
+
+One fleet process (see VRxCV1_fleet) tops out at one CPU core. The launcher
+shards receivers across worker processes, each running its own Fleet, so the
+load on the broker and controller can be raised past that:
+
+    python benchmarks/fleet_launch.py -a 192.168.1.10 --receivers 2000 --workers 8 --duration 60
+
+Workers start connecting together, once every worker is ready. Each reports
+every --report seconds: messages received, answers sent, answer lag (how late
+answers go out after their send time) and CPU. The launcher adds the reports
+up into one line per interval. When the busiest worker is near 100% CPU the
+emulator is the limit; add workers. When workers have CPU to spare but answer
+rates flatten or lag grows, the broker or the controller has saturated.
+
+At the end, every receiver disconnects gracefully, sending 0 on its
+connection topic as disconnect_gracefully does, so the controller sees them
+leave rather than drop.
+'''
+
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import queue
+import signal
+import time
+
+from .VRxCV1_fleet import Fleet, LagHistogram
+from .cvcm_model import add_shaper_arguments, shaper_from_args
+
+logger = logging.getLogger(__name__)
+
+# Seconds a fleet runs between checks for new receivers and the stop signal
+TICK = 0.25
+# Seconds to wait for workers to disconnect their receivers and exit
+TEARDOWN_TIMEOUT = 10.0
+
+def shard(count, workers, seats=8, prefix="CV-FLEET"):
+    """(serial number, seat, index) of each receiver, for each worker
+
+    Receivers are dealt out in turn, so each worker has receivers on every seat.
+    """
+    shards = [[] for _ in range(workers)]
+    for n in range(count):
+        shards[n % workers].append(("%s-%04d" % (prefix, n), n % seats, n))
+    return shards
+
+def run_worker(worker, receivers, args, start, stop, results):
+    """Run one Fleet: wait for start, connect receivers over args.ramp_s, report until stop"""
+    # The launcher handles Ctrl-C and tells workers to stop
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    logging.basicConfig(level=logging.WARNING)
+    fleet = Fleet(args.address, args.port, shaper_factory=lambda: shaper_from_args(args))
+    results.put(('ready', worker, None))
+    start.wait()
+
+    started = time.monotonic()
+    pending = list(receivers)
+    last = {'messages': 0, 'answers': 0, 'answers_lost': 0, 'cpu_s': time.process_time()}
+    interval = 0
+    next_report = started + args.report
+    while not stop.is_set():
+        # Receiver n of count joins at ramp_s * n / count, whichever worker it is on
+        now = time.monotonic()
+        while pending and now - started >= args.ramp_s * pending[0][2] / args.receivers:
+            serial_num, seat_number, _index = pending.pop(0)
+            fleet.add(serial_num, seat_number)
+
+        fleet.run(min(TICK, max(0, next_report - now)))
+
+        now = time.monotonic()
+        if now >= next_report:
+            results.put(('report', worker, _interval_report(fleet, last, interval, args.report)))
+            interval += 1
+            next_report += args.report
+
+    fleet.stop()
+    results.put(('done', worker, {'receivers': len(fleet.receivers), 'elapsed_s': time.monotonic() - started,
+                                  'stats': fleet.stats()}))
+
+def _interval_report(fleet, last, interval, wall_s):
+    """The worker's numbers since the last report; last is updated"""
+    stats = fleet.stats()
+    report = {
+        'interval': interval,
+        'receivers': stats['receivers'],
+        'connected': stats['connected'],
+        'discovered': stats['discovered'],
+        'wall_s': wall_s,
+        'lag': fleet.answer_lag.take(),
+    }
+    for key in ('messages', 'answers', 'answers_lost', 'cpu_s'):
+        report[key] = stats[key] - last[key]
+        last[key] = stats[key]
+    return report
+
+def combine(reports):
+    """One interval's report from every worker, added up"""
+    lag = LagHistogram()
+    for report in reports:
+        lag.merge(report['lag'])
+    wall_s = reports[0]['wall_s']
+    ms = lambda value: None if value is None else round(value * 1000, 2)
+    return {
+        'interval': reports[0]['interval'],
+        'workers': len(reports),
+        'receivers': sum(r['receivers'] for r in reports),
+        'connected': sum(r['connected'] for r in reports),
+        'discovered': sum(r['discovered'] for r in reports),
+        'messages_per_s': round(sum(r['messages'] for r in reports) / wall_s, 1),
+        'answers_per_s': round(sum(r['answers'] for r in reports) / wall_s, 1),
+        'answers_lost': sum(r['answers_lost'] for r in reports),
+        'lag_p50_ms': ms(lag.percentile(0.5)),
+        'lag_p99_ms': ms(lag.percentile(0.99)),
+        'lag_max_ms': ms(lag.maximum) if lag.total else None,
+        'busiest_cpu_pct': round(max(r['cpu_s'] for r in reports) / wall_s * 100, 1),
+    }
+
+def _value(value):
+    return "-" if value is None else str(value)
+
+class Launcher:
+    """Starts the workers and gathers their reports"""
+    def __init__(self, args):
+        self.args = args
+        # fork, so workers share the parent's imports; the plugin package is
+        # often loaded without RotorHazard (see benchmarks/_loader.py)
+        self._context = multiprocessing.get_context("fork")
+        self._start = self._context.Event()
+        self._stop = self._context.Event()
+        self._results = self._context.Queue()
+        self._processes = []
+        self._intervals = {}
+        self.rows = []
+        self.workers = {}
+
+    def run(self):
+        args = self.args
+        for worker, receivers in enumerate(shard(args.receivers, args.workers, args.seats, args.prefix)):
+            process = self._context.Process(target=run_worker, name="fleet-%d" % worker,
+                                            args=(worker, receivers, args, self._start, self._stop, self._results))
+            process.start()
+            self._processes.append(process)
+
+        ready = 0
+        while ready < len(self._processes):
+            try:
+                kind, _worker, _data = self._results.get(timeout=1.0)
+            except queue.Empty:
+                if not all(process.is_alive() for process in self._processes):
+                    logger.error("A worker exited before starting")
+                    self.stop()
+                    return
+                continue
+            ready += kind == 'ready'
+        print("%d receivers on %d workers, starting" % (args.receivers, len(self._processes)))
+        print("%7s %9s %9s %10s %10s %9s %6s %11s %11s %11s %9s" % (
+            "time s", "receivers", "connected", "discovered", "messages/s", "answers/s", "lost",
+            "lag p50 ms", "lag p99 ms", "lag max ms", "max cpu%"))
+        self._start.set()
+
+        deadline = time.monotonic() + args.duration if args.duration else None
+        try:
+            while deadline is None or time.monotonic() < deadline:
+                self._receive(timeout=0.5)
+                if not any(process.is_alive() for process in self._processes):
+                    logger.error("All workers have exited")
+                    break
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.stop()
+
+    def stop(self):
+        """Have every worker disconnect its receivers gracefully, then collect their totals"""
+        self._stop.set()
+        # Workers still waiting to start see the stop straight away
+        self._start.set()
+        teardown_deadline = time.monotonic() + TEARDOWN_TIMEOUT
+        while len(self.workers) < len(self._processes) and time.monotonic() < teardown_deadline:
+            if not self._receive(timeout=0.5) and not any(p.is_alive() for p in self._processes):
+                break
+        for process in self._processes:
+            process.join(max(0.1, teardown_deadline - time.monotonic()))
+            if process.is_alive():
+                logger.warning("%s didn't exit, terminating", process.name)
+                process.terminate()
+
+    def _receive(self, timeout):
+        try:
+            kind, worker, data = self._results.get(timeout=timeout)
+        except queue.Empty:
+            return False
+        if kind == 'report':
+            reports = self._intervals.setdefault(data['interval'], [])
+            reports.append(data)
+            if len(reports) == len(self._processes):
+                self._print_row(combine(self._intervals.pop(data['interval'])))
+        elif kind == 'done':
+            self.workers[worker] = data
+        return True
+
+    def _print_row(self, row):
+        self.rows.append(row)
+        print("%7.1f %9d %9d %10d %10.1f %9.1f %6d %11s %11s %11s %9.1f" % (
+            (row['interval'] + 1) * self.args.report, row['receivers'], row['connected'], row['discovered'],
+            row['messages_per_s'], row['answers_per_s'], row['answers_lost'],
+            _value(row['lag_p50_ms']), _value(row['lag_p99_ms']), _value(row['lag_max_ms']),
+            row['busiest_cpu_pct']))
+
+    def summary(self):
+        print()
+        print("%6s %9s %9s %9s %8s %7s" % ("worker", "receivers", "messages", "answers", "lost", "cpu s"))
+        for worker, data in sorted(self.workers.items()):
+            stats = data['stats']
+            print("%6d %9d %9d %9d %8d %7.2f" % (worker, data['receivers'], stats['messages'],
+                                                 stats['answers'], stats['answers_lost'], stats['cpu_s']))
+        missing = len(self._processes) - len(self.workers)
+        if missing:
+            print("%d workers sent no totals" % missing)
+        return {'intervals': self.rows,
+                'workers': {str(worker): data for worker, data in sorted(self.workers.items())}}
+
+def main():
+    parser = argparse.ArgumentParser(description="Emulate CV1 receivers across several processes")
+    parser.add_argument("-a","--address",
+                        default = "localhost",
+                        help = "mqtt broker ip address or hostname")
+    parser.add_argument("-p", "--port", type=int, default=1883)
+    parser.add_argument("--receivers", type=int, default=256)
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="worker processes")
+    parser.add_argument("--duration", type=float, default=60.0, help="seconds to run, 0 until Ctrl-C")
+    parser.add_argument("--ramp-s", type=float, default=5.0, help="seconds over which receivers connect")
+    parser.add_argument("--report", type=float, default=5.0, help="seconds between reports")
+    parser.add_argument("--seats", type=int, default=8)
+    parser.add_argument("--prefix", default="CV-FLEET", help="serial number prefix")
+    parser.add_argument("--output", help="write the reports to this JSON file")
+    add_shaper_arguments(parser)
+    args = parser.parse_args()
+    args.workers = max(1, min(args.workers, args.receivers))
+
+    logging.basicConfig(level=logging.WARNING)
+    launcher = Launcher(args)
+    launcher.run()
+    results = launcher.summary()
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(dict(results, args=vars(args)), f, indent=2, sort_keys=True)
+
+if __name__ == "__main__":
+    main()
@@ -3,11 +3,39 @@
 # Sample configuration:
 #     "VRX_CONTROL": {
 #         "HOST": "localhost",
-#         "ENABLED": true
+#         "ENABLED": true,
+#         "OSD_COALESCE_MS": 10,
+#         "EVENT_FLUSH_MS": 250,
+#         "PUBLISH_MAX_INFLIGHT": 10,
+#         "FREQUENCY_COUNTDOWN_S": 10,
+#         "CONNECT_RETRY_MAX_S": 30,
+#         "STALE_RTT_MULTIPLE": 4,
+#         "STALE_MIN_S": 2,
+#         "REQUEST_TIMEOUT_S": 2,
+#         "POLL_MIN_S": 5,
+#         "POLL_MAX_S": 60,
+#         "POLL_RACE_FACTOR": 4,
+#         "METRICS_ENABLED": false,
+#         "METRICS_FILE": "",
+#         "METRICS_INTERVAL_S": 15,
+#         "CAPTURE_FILE": ""
 #     }
 #
 # HOST domain or IP address of MQTT server for VRx Control messages
 # ENABLED:true is required.
+# OSD_COALESCE_MS window in which OSD messages to the same seat are collapsed to the newest (0 disables)
+# EVENT_FLUSH_MS interval at which device changes are reported to RotorHazard in one event (0 reports each change)
+# PUBLISH_MAX_INFLIGHT messages handed to the MQTT client and not yet acknowledged; the rest wait in priority order
+# FREQUENCY_COUNTDOWN_S warning given on the OSD before seat frequency changes are applied together
+# CONNECT_RETRY_MAX_S longest wait between attempts to reach the MQTT server; startup doesn't wait for it
+# STALE_RTT_MULTIPLE receivers not answering within this multiple of their typical response time are marked stale
+# STALE_MIN_S shortest wait for an answer before a receiver is marked stale
+# REQUEST_TIMEOUT_S how long a status or lock query waits for answers; repeats while waiting aren't sent again
+# POLL_MIN_S, POLL_MAX_S range of each receiver's status poll interval; it shortens while the receiver's state changes
+# POLL_RACE_FACTOR poll intervals are this many times longer while a race is running
+# METRICS_ENABLED count messages, bytes, callback time and queue depth; shown at /vrx_cv2/metrics
+# METRICS_FILE also write the metrics in Prometheus text format to this file every METRICS_INTERVAL_S (enables metrics)
+# CAPTURE_FILE append every MQTT message sent and received to this binary capture file, see mqtt_capture.py
 # ONLY ONE server may use VRx Control on a given network at a time. Setting ENABLED to false
 # is useful to store configuration settings when disabling a timer from VRx Control.
 
@@ -18,19 +46,35 @@
 # python2 -m pip install -e .
 import clearview  #pylint: disable=import-error
 
-import json
 import logging
-import gevent
+import functools
 import traceback
 from monotonic import monotonic
+from flask import Blueprint, Response
 
 import Config
 
-from .mqtt_topics import mqtt_publish_topics, mqtt_subscribe_topics, ESP_COMMANDS
+from .mqtt_topics import mqtt_subscribe_topics, TopicRegistry, cv1_topics, format_topic, topic_class
+from . import esp_payloads
 from .VRxCV1_emulator import MQTT_Client
+from .osd_coalescer import MessageCoalescer
+from .osd_templates import LapMessageTemplates, TEMPLATE_OPTIONS
+from .command_cache import CommandStateCache
+from .device_index import DeviceIndex
+from .response_decoder import ResponseDecoder
+from .event_aggregator import EventAggregator
+from .publish_scheduler import PublishScheduler
+from .frequency_scheduler import FrequencyChangeScheduler
+from .liveness import LivenessMonitor
+from .status_poller import StatusPoller
+from .request_tracker import RequestTracker, REQUEST_LOCK, REQUEST_STATIC, REQUEST_VARIABLE
+from .metrics import MetricsRegistry, MetricsFileExporter, NULL_METRICS
+from .mqtt_capture import CaptureWriter
+from .desired_state import DesiredState, KIND_FREQUENCY, KIND_OSD_VISIBILITY, KIND_USER_MSG
+from .publish_policy import CMD_USER_MSG, CMD_OSD_VISIBILITY, CMD_LOCK_QUERY, CMD_LOCK_RESET, \
+    CMD_STATUS_REQUEST, CMD_SEAT, CMD_FREQUENCY, CMD_WIFI, PUBLISH_POLICY, LANE_CONFIG
 from eventmanager import Evt
 import Results
-from RHRace import WinCondition
 import RHUtils
 
 from VRxControl import VRxController, VRxDevice, VRxDeviceMethod
@@ -40,6 +84,12 @@ logger = logging.getLogger(__name__)
 VRxALL = -1
 MINIMUM_PAYLOAD = 7
 
+# Config keys every install is expected to set; the others have working defaults
+REQUIRED_CONFIG_KEYS = ("HOST",)
+
+# Config fields receivers report back that are also sent as commands
+REPORTED_CONFIG_FIELDS = ("seat", "osd_visibility")
+
 def initialize(rhapi):
     controller = CV2Controller(
         rhapi,
@@ -47,10 +97,28 @@ def initialize(rhapi):
         'ClearView 2.0'
     ) 
     rhapi.events.on(Evt.VRX_INITIALIZE, controller.registerHandlers)
+    rhapi.ui.blueprint_add(metrics_blueprint(controller))
+
+def metrics_blueprint(controller):
+    """Page serving the controller's metrics in Prometheus text format"""
+    blueprint = Blueprint('vrx_cv2', __name__)
+
+    @blueprint.route('/vrx_cv2/metrics')
+    def vrx_cv2_metrics():
+        return Response(controller.metrics.render_prometheus(), mimetype='text/plain')
+
+    return blueprint
 
 class CV2Controller(VRxController):
-    def __init__(self, rhapi, name, label):
+    def __init__(self, rhapi, name, label, mqtt_client_factory=None):
+        """mqtt_client_factory: made in place of paho's Client, e.g. a stand-in for benchmarks"""
         self._rhapi = rhapi
+        self._mqtt_client_factory = mqtt_client_factory
+        self._device_index = DeviceIndex()
+        self._response_decoder = ResponseDecoder()
+        self._metrics = NULL_METRICS
+        self._metrics_exporter = None
+        self._capture = None
         super().__init__(name, label)
 
     def registerHandlers(self, args):
@@ -61,12 +129,29 @@ class CV2Controller(VRxController):
 
         default_config = {
             'HOST': 'localhost',
+            'OSD_COALESCE_MS': 10,
+            'EVENT_FLUSH_MS': 250,
+            'PUBLISH_MAX_INFLIGHT': 10,
+            'FREQUENCY_COUNTDOWN_S': 10,
+            'CONNECT_RETRY_MAX_S': 30,
+            'STALE_RTT_MULTIPLE': 4,
+            'STALE_MIN_S': 2,
+            'REQUEST_TIMEOUT_S': 2,
+            'POLL_MIN_S': 5,
+            'POLL_MAX_S': 60,
+            'POLL_RACE_FACTOR': 4,
+            'METRICS_ENABLED': False,
+            'METRICS_FILE': '',
+            'METRICS_INTERVAL_S': 15,
+            'CAPTURE_FILE': '',
         }
         saved_config = default_config
 
         for k, v_default in default_config.items():
             if k not in supplied_config:
-                logger.warning("VRX Config does not include config key '%s'. Using '%s'"%(k, v_default))
+                # Only a missing HOST is worth a warning; the rest are optional tuning
+                log = logger.warning if k in REQUIRED_CONFIG_KEYS else logger.debug
+                log("VRX Config does not include config key '%s'. Using '%s'"%(k, v_default))
             else:
                 saved_config[k] = supplied_config[k]
 
@@ -77,6 +162,34 @@ class CV2Controller(VRxController):
 
         self.config = self.validate_config(Config.VRX_CONTROL)
 
+        if self.config["METRICS_ENABLED"] or self.config["METRICS_FILE"]:
+            self._metrics = MetricsRegistry()
+            describe_metrics(self._metrics)
+            if self.config["METRICS_FILE"]:
+                self._metrics_exporter = MetricsFileExporter(self._metrics, self.config["METRICS_FILE"],
+                                                             float(self.config["METRICS_INTERVAL_S"]))
+                self._metrics_exporter.start()
+
+        if self.config["CAPTURE_FILE"]:
+            self._capture = CaptureWriter(self.config["CAPTURE_FILE"])
+            logger.info("Capturing MQTT traffic to %s", self.config["CAPTURE_FILE"])
+
+        self._data_events = EventAggregator(self.Events, Evt.VRX_DATA_RECEIVE,
+                                            float(self.config["EVENT_FLUSH_MS"]) / 1000.0,
+                                            summary_fn=lambda: {'liveness': self.liveness_status()})
+        self._data_events.start()
+
+        self._liveness = LivenessMonitor(float(self.config["STALE_RTT_MULTIPLE"]),
+                                         float(self.config["STALE_MIN_S"]),
+                                         on_stale=self._on_device_stale,
+                                         on_alive=self._on_device_alive)
+        self._liveness.start()
+        self._requests = RequestTracker(float(self.config["REQUEST_TIMEOUT_S"]))
+        self._poller = StatusPoller(self._poll_device,
+                                    float(self.config["POLL_MIN_S"]),
+                                    float(self.config["POLL_MAX_S"]),
+                                    float(self.config["POLL_RACE_FACTOR"]))
+
         seat_frequencies = [node.frequency for node in self.racecontext.interface.nodes]
 
         # TODO the subscribe topics subscribe it to a seat number by default
@@ -88,17 +201,47 @@ class CV2Controller(VRxController):
         # The VRxController can then run multiple clients, but duplicate messaging will have to be avoided
         # This could be done in the publisher by only passing messages to the clients that need it
 
+        # Connect in the background so a missing broker doesn't hold up RotorHazard's startup.
+        # Commands below wait in the publish queue until the connection is up.
         self._mqttc = MQTT_Client(client_id="VRxController",
                                  broker_ip=self.config["HOST"],
-                                 subscribe_topics = None)
-
-        self._add_subscribe_callbacks()
-        self._mqttc.loop_start()
+                                 subscribe_topics = None,
+                                 connect_async=True,
+                                 backoff_range=(1, float(self.config["CONNECT_RETRY_MAX_S"])),
+                                 metrics=self._metrics,
+                                 client_factory=self._mqtt_client_factory,
+                                 capture=self._capture)
+
+        self._publisher = PublishScheduler(self._mqttc, int(self.config["PUBLISH_MAX_INFLIGHT"]))
+        self._publisher.add_drop_callback(self._on_publish_dropped)
+        self._publisher.add_send_callback(self._on_query_sent)
         self.num_seats = len(seat_frequencies)
 
         self.seat_number_range = (0,7)
-        self._seats = [VRxSeat(self._mqttc, self.racecontext.language, n, seat_frequencies[n], seat_number_range=self.seat_number_range) for n in range(self.num_seats)]
-        self._seat_broadcast = VRxBroadcastSeat(self._mqttc, self.racecontext.language)
+        self._topics = TopicRegistry("cv1", self.seat_number_range)
+        self._seat_by_topic = {topic: seat_number for seat_number, topic in self._topics.esp_seat.items()}
+        self._target_prefix = self._topics.seat_prefix("receiver_command_esp_targeted_topic")
+        self._command_cache = CommandStateCache(
+            self._topics.esp_all,
+            self._topics.seat_prefix("receiver_command_esp_seat_topic"))
+        self._desired_state = DesiredState(self._topics.esp_all)
+        self._seats = [VRxSeat(self._publisher, self.racecontext.language, n, seat_frequencies[n], seat_number_range=self.seat_number_range, command_cache=self._command_cache, topics=self._topics, desired_state=self._desired_state) for n in range(self.num_seats)]
+        self._seat_broadcast = VRxBroadcastSeat(self._publisher, self.racecontext.language, command_cache=self._command_cache, topics=self._topics, desired_state=self._desired_state)
+        self._osd_coalescer = MessageCoalescer(self._publish_message,
+                                               float(self.config["OSD_COALESCE_MS"]) / 1000.0,
+                                               broadcast_key=VRxALL)
+        self._lap_templates = LapMessageTemplates(self.racecontext.rhdata, self.racecontext.language)
+        self._frequency_changes = FrequencyChangeScheduler(self._warn_frequency_change,
+                                                           self._commit_frequency_changes,
+                                                           float(self.config["FREQUENCY_COUNTDOWN_S"]))
+
+        # Only take messages once everything the callbacks use exists
+        self._add_subscribe_callbacks()
+        self._mqttc.add_connect_callback(self._on_broker_connect)
+        self._mqttc.loop_start()
+        self._publisher.start()
+        self._poller.start()
+        self._metrics.add_collector(self._collect_metrics)
 
         self._seat_broadcast.reset_lock()
         # Request status of all receivers (static and variable)
@@ -108,20 +251,39 @@ class CV2Controller(VRxController):
 
         for i in range(self.num_seats):
             self.get_seat_lock_status(i)
-            gevent.spawn(self.set_seat_frequency, i, self._seats[i]._seat_frequency)
+            self.set_seat_frequency(i, self._seats[i]._seat_frequency)
 
         # Update the DB with receivers that exist and their status
         # (Because the pi was already running, they should all be connected to the broker)
         # Even if the server.py is restarted, the broker continues to run:)
 
     def updateStatus(self):
-        self.get_seat_lock_status()
-        self.request_variable_status()
+        """Refresh receiver status soon. Known receivers are polled individually, spread over a few seconds"""
+        if self._poller.racing:
+            return
+        if self._poller.devices:
+            self._poller.nudge_all()
+        else:
+            # Nothing known yet; ask everyone so receivers can be discovered
+            self.get_seat_lock_status()
+            self.request_variable_status()
+
+    def _poll_device(self, device_id):
+        if device_id in self.devices:
+            self.req_status_targeted("lock", device_id)
+            self.req_status_targeted("variable", device_id)
 
     def setDeviceSeat(self, device_id, seat):
         if seat is not None:
+            if not self.seat_number_range[0] <= int(seat) <= self.seat_number_range[1]:
+                raise ValueError("Seat number %s out of range for %s" % (seat, device_id))
+            # The receivers at the old and new seat change, so seat-level state no longer holds
+            self.invalidate_device_state(device_id)
+            self._command_cache.invalidate(self._seat_topic(seat))
             self.set_seat_number(seat, None, device_id)
             super().setDeviceSeat(device_id, seat)
+            self._device_index.set_seat(device_id, seat)
+            self._poller.nudge(device_id)
             self.setDeviceFrequency(device_id)
         else:
             logger.debug("Seat is {} for {}".format(seat, device_id))
@@ -134,37 +296,72 @@ class CV2Controller(VRxController):
             self.set_target_frequency(device_id, frequency)
 
     def onHeatSet(self, _args):
-        seat_pilots = self.racecontext.race.node_pilots
-        heat = self.racecontext.rhdata.get_heat(self.racecontext.race.current_heat)
-        for seat in seat_pilots:
-            if seat_pilots[seat]:
-                pilot = self.racecontext.rhdata.get_pilot(seat_pilots[seat])
-                if heat:
-                    round_num = self.racecontext.rhdata.get_max_round(self.racecontext.race.current_heat) or 0
-                    message = F'{pilot.callsign} | {heat.displayname()} | {self.racecontext.language.__("Round")} {round_num + 1}'
-                else:
-                    message = self.racecontext.language.__("-None-")
+        seat_pilots = self.get_seat_pilots()
+        if not seat_pilots:
+            return
+
+        heat_id = self.racecontext.race.current_heat
+        heat = self.racecontext.rhdata.get_heat(heat_id)
+        if heat:
+            round_num = self.racecontext.rhdata.get_max_round(heat_id) or 0
+            heat_text = F'{heat.displayname()} | {self.racecontext.language.__("Round")} {round_num + 1}'
+        else:
+            none_text = self.racecontext.language.__("-None-")
+
+        messages = {}
+        for seat, pilot in seat_pilots.items():
+            if heat:
+                message = F'{pilot.callsign} | {heat_text}'
+            else:
+                message = none_text
 
-                logger.debug('cv2 s{1}:  {0}'.format(message, seat))
-                self.set_message_direct(seat, message)
+            logger.debug('cv2 s{1}:  {0}'.format(message, seat))
+            messages[seat] = message
+
+        self.set_messages_direct(messages)
 
     def onRaceStage(self, _args):
-        seat_pilots = self.racecontext.race.node_pilots
-        for seat in seat_pilots:
-            if seat_pilots[seat]:
-                pilot = self.racecontext.rhdata.get_pilot(seat_pilots[seat])
-                message = F'{pilot.callsign} | {self.racecontext.language.__("Arm now")}'
+        self._poller.set_racing(True)
+        arm_text = self.racecontext.language.__("Arm now")
+
+        messages = {}
+        for seat, pilot in self.get_seat_pilots().items():
+            message = F'{pilot.callsign} | {arm_text}'
+
+            logger.debug('cv2 s{1}:  {0}'.format(message, seat))
+            messages[seat] = message
 
-                logger.debug('cv2 s{1}:  {0}'.format(message, seat))
-                self.set_message_direct(seat, message)
+        self.set_messages_direct(messages)
+
+    def get_seat_pilots(self):
+        """Pilots for every occupied seat in the current heat, looked up in one query"""
+        seat_pilot_ids = {seat: pilot_id for seat, pilot_id in self.racecontext.race.node_pilots.items() if pilot_id}
+        if not seat_pilot_ids:
+            return {}
+
+        pilots = {pilot.id: pilot for pilot in self.racecontext.rhdata.get_pilots()}
+        seat_pilots = {}
+        for seat, pilot_id in seat_pilot_ids.items():
+            if pilot_id in pilots:
+                seat_pilots[seat] = pilots[pilot_id]
+            else:
+                logger.warning("Pilot %s for seat %s not found", pilot_id, seat)
+        return seat_pilots
 
     def onRaceStart(self, _args):
+        self._poller.set_racing(True)
         self.set_message_direct(VRxALL, self.racecontext.language.__("Go"))
 
     def onRaceFinish(self, _args):
         self.set_message_direct(VRxALL, self.racecontext.language.__("Time Expired"))
+        logger.debug("OSD lap template stats: %s", self._lap_templates.stats())
+        logger.debug("Publish queue stats: %s", self._publisher.stats())
+        logger.debug("Receiver liveness: %s", self._liveness.stats())
+        logger.debug("Status requests: %s", self._requests.stats())
+        logger.debug("Status polling: %s", self._poller.stats())
 
     def onRaceStop(self, _args):
+        self._poller.set_racing(False)
         self.set_message_direct(VRxALL, self.racecontext.language.__("Race Stopped. Land Now."))
 
     def onRaceLapRecorded(self, args):
@@ -180,47 +377,7 @@ class CV2Controller(VRxController):
         else:
             info = Results.get_gap_info(self.racecontext, seat_index)
 
-        # Set up output objects
-        TIME_FORMAT = self.racecontext.rhdata.get_option('timeFormat')
-        LAP_HEADER = '{:<1}'.format(self.racecontext.rhdata.get_option('osd_lapHeader', "L"))
-        PREVIOUS_LAP_HEADER = '{:<1}'.format(self.racecontext.rhdata.get_option('osd_previousLapHeader', "P"))
-        POS_HEADER = '{:<1}'.format(self.racecontext.rhdata.get_option('osd_positionHeader', ""))
-        BEST_LAP_TEXT = self.racecontext.language.__('Best Lap')
-        HOLESHOT_TEXT = self.racecontext.language.__('HS')
-        LEADER_TEXT = self.racecontext.language.__('Leader')
-
-        # Format and send messages
-
-        if info.current.lap_number:
-            lap_count = F"{LAP_HEADER}{info.current.lap_number}"
-        else:
-            lap_count = HOLESHOT_TEXT
-
-        # "P[n] L[n] 0:00:00"
-        message = F'{POS_HEADER}{info.current.position} {lap_count} {RHUtils.time_format(info.current.last_lap_time, TIME_FORMAT)}'
-
-        if info.race.win_condition == WinCondition.FASTEST_CONSECUTIVE:
-            # "P[n] L[n] 0:00:00 | #/0:00.000" (current | best consecutives)
-            if info.current.lap_number > 1:
-                message += F' | {info.current.consecutives_base}/{RHUtils.time_format(info.current.consecutives, TIME_FORMAT)}'
-
-        elif info.race.win_condition == WinCondition.FASTEST_LAP:
-            if info.next_rank.diff_time:
-                # pilot in 2nd or lower
-                # "P[n] L[n] 0:00:00 | +0:00.000 Callsign"
-                message += F' | +{RHUtils.time_format(info.next_rank.diff_time, TIME_FORMAT)} {info.next_rank.callsign}'
-            elif info.current.is_best_lap:
-                # pilot in 1st and is best lap
-                # "P[n] L[n] 0:00:00 | Leader Best"
-                message += F' | {LEADER_TEXT} {BEST_LAP_TEXT}'
-        else:
-            # WinCondition.MOST_LAPS
-            # WinCondition.FIRST_TO_LAP_X
-            # WinCondition.NONE
-
-            # "P[n] L[n] 0:00:00 | +0:00.000 Callsign"
-            if info.next_rank.diff_time:
-                message += F' | +{RHUtils.time_format(info.next_rank.diff_time, TIME_FORMAT)} {info.next_rank.callsign}'
+        message, split_message = self._lap_templates.render(info)
 
         # send message to crosser
         seat_dest = seat_index
@@ -228,34 +385,14 @@ class CV2Controller(VRxController):
         logger.debug('cv2 s{1}:  {0}'.format(message, seat_dest))
 
         # show split when next pilot crosses
-        if info.next_rank.diff_time:
-            if info.race.win_condition == WinCondition.FASTEST_CONSECUTIVE or info.race.win_condition == WinCondition.FASTEST_LAP:
-                # don't update
-                pass
-
-            else:
-                # WinCondition.MOST_LAPS
-                # WinCondition.FIRST_TO_LAP_X
-                # WinCondition.NONE
-
-                # update pilot ahead with split-behind
-
-                if info.next_rank.lap_number:
-                    lap_count = F"{LAP_HEADER}{info.next_rank.lap_number}"
-                else:
-                    lap_count = HOLESHOT_TEXT
-
-                # "P[n] L[n] 0:00:00"
-                message = F'{POS_HEADER}{info.next_rank.position} {lap_count} {RHUtils.time_format(info.next_rank.last_lap_time, TIME_FORMAT)}'
-
-                 # "P[n] L[n] 0:00:00 | -0:00.000 Callsign"
-                message += F' | -{RHUtils.time_format(info.next_rank.diff_time, TIME_FORMAT)} {info.current.callsign}'
-
-                seat_dest = info.next_rank.seat
-                self.set_message_direct(seat_dest, message)
-                logger.debug('cv2 s{1}:  {0}'.format(message, seat_dest))
+        if split_message:
+            # update pilot ahead with split-behind
+            seat_dest = info.next_rank.seat
+            self.set_message_direct(seat_dest, split_message)
+            logger.debug('cv2 s{1}:  {0}'.format(split_message, seat_dest))
 
     def onLapsClear(self, args):
+        self._poller.set_racing(False)
         self.set_message_direct(VRxALL, "---")
 
     def onFrequencySet(self, args):
@@ -291,44 +428,88 @@ class CV2Controller(VRxController):
                     logger.error("Cannot use reserved character '%s' in '%s'"%(cv_csum, args['option']))
                     self.racecontext.rhdata.set_option(args['option'], '')
 
+            if args['option'] in TEMPLATE_OPTIONS:
+                self._lap_templates.invalidate()
+
     def onShutdown(self, arg):
         logger.debug("VRx CV2 Shutting down")
+        self._frequency_changes.stop()
+        self._liveness.stop()
+        self._poller.stop()
+        self._requests.cancel_all()
+        self._osd_coalescer.clear()
+        self._data_events.stop()
         self._seat_broadcast.clear_user_message()
         self._seat_broadcast.turn_on_osd()
         self._seat_broadcast.set_wifi_state(clearview.comspecs.cv_device_limits["wifi_mode_ap"])
+        if not self._publisher.drain():
+            logger.warning("VRx CV2 shut down with %d messages unsent", self._publisher.depth)
+        self._publisher.stop()
+        if self._metrics_exporter is not None:
+            self._metrics_exporter.stop()
+        if self._capture is not None:
+            self._capture.close()
 
     ##############
     ## MQTT Status
     ##############
 
     def request_static_status(self, seat_number=VRxALL):
+        """Ask the receivers at a seat, or all receivers, for static status. Returns a future, see RequestTracker"""
+        return self._request_seat(REQUEST_STATIC, seat_number, lambda seat: seat.request_static_status())
+
+    def request_variable_status(self, seat_number=VRxALL):
+        """Ask the receivers at a seat, or all receivers, for variable status. Returns a future, see RequestTracker"""
+        return self._request_seat(REQUEST_VARIABLE, seat_number, lambda seat: seat.request_variable_status())
+
+    def _request_seat(self, kind, seat_number, send_fn):
         if seat_number == VRxALL:
             seat = self._seat_broadcast
-            seat.request_static_status()
-
-            for device in self.devices:
-                self.devices[device].last_request = monotonic()
+            members = None
         else:
-            self._seats[seat_number].request_static_status()
+            seat = self._seats[seat_number]
+            members = [device.id for device in self.devices_at_seat(seat_number)]
 
-            for device in self.devices:
-                if self.devices[device].map.method == VRxDeviceMethod.SEAT and self.devices[device].map.seat == seat_number:
-                    self.devices[device].last_request = monotonic()
+        return self._requests.request_group(kind, seat_number, members, lambda: send_fn(seat))
 
-    def request_variable_status(self, seat_number=VRxALL):
-        if seat_number == VRxALL:
-            seat = self._seat_broadcast
-            seat.request_variable_status()
+    def devices_at_seat(self, seat_number):
+        """Devices following a seat number"""
+        return [self.devices[device_id] for device_id in self._device_index.at_seat(seat_number)
+                if self.devices[device_id].map.method == VRxDeviceMethod.SEAT]
+
+    def _on_query_sent(self, topic, _payload, command, sent_at):
+        """Record when the devices a status or lock query went to were asked
 
-            for device in self.devices:
-                self.devices[device].last_request = monotonic()
+        Timed from when the query goes to the broker, so time spent queued,
+        e.g. while the broker is unreachable, isn't taken for a slow receiver.
+        """
+        if command not in (CMD_STATUS_REQUEST, CMD_LOCK_QUERY):
+            return
+        if topic == self._topics.esp_all:
+            device_ids = list(self._device_index.connected)
+        elif topic in self._seat_by_topic:
+            device_ids = [device.id for device in self.devices_at_seat(self._seat_by_topic[topic])]
+        elif topic.startswith(self._target_prefix) and topic[len(self._target_prefix):] in self.devices:
+            device_ids = [topic[len(self._target_prefix):]]
         else:
-            self._seats[seat_number].request_variable_status()
+            return
+        for device_id in device_ids:
+            self.devices[device_id].last_request = sent_at
+            self._liveness.request(device_id, sent_at)
 
-            for device in self.devices:
-                if self.devices[device].map.method == VRxDeviceMethod.SEAT and self.devices[device].map.seat == seat_number:
-                    self.devices[device].last_request = monotonic()
+    def liveness_status(self):
+        """Stale receivers and response time percentiles, sent with each VRx data event"""
+        return self._liveness.stats()
 
+    def _on_device_stale(self, device_id):
+        if device_id in self.devices:
+            self.devices[device_id].extended_properties["stale"] = True
+            self._data_events.mark(device_id, {"extended_properties.stale": True})
+
+    def _on_device_alive(self, device_id):
+        if device_id in self.devices:
+            self.devices[device_id].extended_properties["stale"] = False
+            self._data_events.mark(device_id, {"extended_properties.stale": False})
 
     ##############
     ## Seat Number
@@ -355,9 +536,8 @@ class CV2Controller(VRxController):
             return
 
         if serial_num is not None:
-            topic = mqtt_publish_topics["cv1"]["receiver_command_esp_targeted_topic"][0]%serial_num
-            cmd = json.dumps({"seat": str(desired_seat_num)})
-            self._mqttc.publish(topic, cmd)
+            topic = self._topics.esp_target(serial_num)
+            publish_config(self._publisher, self._command_cache, topic, {"seat": str(desired_seat_num)}, CMD_SEAT)
             self.devices[serial_num].extended_properties["needs_config"] = True
             return
 
@@ -368,17 +548,25 @@ class CV2Controller(VRxController):
     ###########
 
     def set_seat_frequency(self, seat_number, frequency):
-        seat = self._seats[seat_number]
-        seat.set_seat_frequency(frequency)
+        """Change a seat's frequency after the shared FREQUENCY_COUNTDOWN_S warning"""
+        self._frequency_changes.schedule(seat_number, frequency)
+
+    def _warn_frequency_change(self, seat_number, frequency, seconds):
+        self.set_message_direct(seat_number, self.racecontext.language.__("!!! Frequency changing to {0} in <{1}s !!!").format(frequency, seconds))
+
+    def _commit_frequency_changes(self, changes):
+        for seat_number, frequency in changes.items():
+            self._seats[seat_number].set_seat_frequency_direct(frequency)
+        self.set_messages_direct({seat_number: "" for seat_number in changes})
 
     def set_target_frequency(self, target, frequency):
         if frequency != RHUtils.FREQUENCY_ID_NONE:
-            topic = mqtt_publish_topics["cv1"]["receiver_command_esp_targeted_topic"][0]%target
+            topic = self._topics.esp_target(target)
 
             # For ClearView, set the band and channel
-            cv_bc = clearview.comspecs.frequency_to_bandchannel_dict(frequency)
-            if cv_bc:
-                self._mqttc.publish(topic, json.dumps(cv_bc))
+            bc_command = bandchannel_command(frequency)
+            if bc_command:
+                publish_config(self._publisher, self._command_cache, topic, bc_command[0], CMD_FREQUENCY, bc_command[1])
             else:
                 logger.warning("Unable to set ClearView frequency to %s", frequency)
 
@@ -397,14 +585,8 @@ class CV2Controller(VRxController):
     #     return self._lock_status
 
     def get_seat_lock_status(self, seat_number=VRxALL):
-        if seat_number == VRxALL:
-            seat = self._seat_broadcast
-            seat.get_seat_lock_status()
-        else:
-            seat = self._seats[seat_number]
-            seat.get_seat_lock_status()
-
-        #return self._seats[seat_number].seat_lock_status
+        """Ask the receivers at a seat, or all receivers, for their lock. Returns a future, see RequestTracker"""
+        return self._request_seat(REQUEST_LOCK, seat_number, lambda seat: seat.get_seat_lock_status())
 
     #############
     # Camera Type
@@ -437,17 +619,75 @@ class CV2Controller(VRxController):
     ##############
 
     def set_message_direct(self, seat_number, message):
-        """set a message directly. Truncated if over length"""
+        """set a message directly. Truncated if over length
+
+        Messages are held for OSD_COALESCE_MS so that only the newest message
+        for each seat is published during bursts of lap crossings.
+        """
         if message==None:
             logger.error("No message")
             return
 
+        self._osd_coalescer.submit(seat_number, message)
+
+    def set_messages_direct(self, messages):
+        """set messages for several seats, published together
+
+        messages: dict of seat number to message
+        """
+        messages = {seat_number: message for seat_number, message in messages.items() if message is not None}
+        if messages:
+            self._osd_coalescer.submit_batch(messages)
+
+    @property
+    def publish_stats(self):
+        """Depth, drops and wait times of the outbound publish lanes"""
+        return self._publisher.stats()
+
+    @property
+    def collapsed_message_count(self):
+        """Number of OSD messages dropped because a newer one superseded them"""
+        return self._osd_coalescer.collapsed
+
+    def _publish_message(self, seat_number, message):
+        self._metrics.count("osd_messages", "all" if seat_number == VRxALL else seat_number)
         if seat_number == VRxALL:
             seat = self._seat_broadcast
             seat.set_message_direct(message)
         else:
             self._seats[seat_number].set_message_direct(message)
 
+    ###############
+    # Command Cache
+    ###############
+
+    def invalidate_device_state(self, device_id):
+        """Forget what is known about a receiver's config, e.g. after it reconnects or is kicked"""
+        self._command_cache.invalidate(self._topics.esp_target(device_id))
+        if device_id in self.devices and self.devices[device_id].map.seat is not None:
+            self._command_cache.invalidate(self._seat_topic(self.devices[device_id].map.seat))
+
+    def _on_publish_dropped(self, topic, _payload, command):
+        """A config command dropped unsent was recorded as set; forget it so it is sent next time"""
+        if PUBLISH_POLICY[command].lane == LANE_CONFIG:
+            self._command_cache.invalidate(topic)
+
+    def invalidate_all_state(self):
+        """Forget what is known about every receiver's config, e.g. after a broker reconnect"""
+        self._command_cache.invalidate()
+
+    def _on_broker_connect(self):
+        """After a reconnect, send every seat's frequency, OSD visibility and user message again"""
+        if not self._mqttc.reconnected:
+            # Startup commands are already queued for the first connection
+            return
+        logger.warning("Reconnected to MQTT broker, replaying seat state")
+        self.invalidate_all_state()
+        self._desired_state.replay(self._publisher)
+
+    def _seat_topic(self, seat_number):
+        return self._topics.esp_seat[int(seat_number)]
+
     #############################
     # Private Functions for MQTT
     #############################
@@ -474,22 +714,50 @@ class CV2Controller(VRxController):
             self._add_subscribe_callback(topic_tuple, self.on_message_resp_targeted)
 
     def _add_subscribe_callback(self, topic_tuple, callback):
-        formatter_name = topic_tuple[1]
-
-        if formatter_name in ["#","+"]:   # subscibe to all at single level (+) or recursively all (#)
-            topic = topic_tuple[0]%formatter_name
-        elif formatter_name is None:
-            topic = topic_tuple[0]
-        elif isinstance(topic_tuple,tuple):
-            raise ValueError("Uncaptured formatter_name: %s"%formatter_name)
-        elif isinstance(topic_tuple,str):
-            topic = topic_tuple
-        else:
-            raise TypeError("topic_tuple not of correct type: %s"%topic_tuple)
+        topic = format_topic(topic_tuple)
+        if self._metrics.enabled:
+            callback = self._metered_callback(callback)
 
         self._mqttc.message_callback_add(topic, callback)
         self._mqttc.subscribe(topic)
 
+    def _metered_callback(self, callback):
+        """Wrap a message callback to count what it receives and time it"""
+        metrics = self._metrics
+        timed_callback = metrics.timed("callback_seconds", callback.__name__)(callback)
+
+        @functools.wraps(callback)
+        def metered(client, userdata, message):
+            label = topic_class(message.topic)
+            metrics.count("received_messages", label)
+            metrics.count("received_bytes", label, len(message.payload))
+            return timed_callback(client, userdata, message)
+
+        return metered
+
+    @property
+    def metrics(self):
+        return self._metrics
+
+    def _collect_metrics(self, metrics):
+        for name, lane in self._publisher.stats().items():
+            if name == 'inflight':
+                metrics.gauge("publish_inflight", "all", lane)
+            else:
+                metrics.gauge("publish_queue_depth", name, lane['depth'])
+                metrics.gauge("publish_dropped", name, lane['dropped'])
+                metrics.gauge("publish_max_wait_ms", name, lane['max_wait_ms'])
+        metrics.gauge("osd_collapsed", "all", self._osd_coalescer.collapsed)
+        metrics.gauge("osd_pending", "all", self._osd_coalescer.pending)
+        metrics.gauge("requests_in_flight", "all", self._requests.in_flight)
+        metrics.gauge("devices", "connected", len(self._device_index.connected))
+        metrics.gauge("devices", "stale", len(self._liveness.stale))
+        liveness = self._liveness.stats()
+        for percentile in ("p50", "p90", "p99"):
+            value = liveness["rtt_%s_ms" % percentile]
+            if value is not None:
+                metrics.gauge("response_time_ms", percentile, value)
+
     def perform_initial_receiver_config(self, target):
         """ Given the unique identifier of a receiver, perform the initial config"""
         initial_config_success = False
@@ -498,6 +766,9 @@ class CV2Controller(VRxController):
         try:
             _sn = self.devices[target].map.seat
         except KeyError:
+            _sn = None
+        if _sn is None:
+            # e.g. a static status answer arriving before the variable status that holds the seat
             logger.info("No seat number available for %s yet", target)
         else:
             logger.info("Performing initial configuration for %s", target)
@@ -524,6 +795,11 @@ class CV2Controller(VRxController):
         connection_status = bool(message.payload == b'1')
         logger.info("Found MQTT device: %s => %s" % (rx_name,connection_status))
 
+        # Whether it just joined, rebooted or was kicked, the receiver's config is unknown now,
+        # and it won't answer queries sent before
+        self.invalidate_device_state(rx_name)
+        self._requests.cancel_device(rx_name)
+
         device = VRxDevice()
         device.id = rx_name
         device.type = "ClearView 2.0"
@@ -533,19 +809,24 @@ class CV2Controller(VRxController):
         self.setDeviceMethod(rx_name, VRxDeviceMethod.SEAT)
 
         if device.connected:
+            self._device_index.set_seat(rx_name, self.devices[rx_name].map.seat)
+            self._device_index.set_connected(rx_name)
             logger.info("Device %s is not yet configured by the server after a successful connection. Conducting some config now" % rx_name)
             self.devices[rx_name].extended_properties["needs_config"] = True
 
             # Start by requesting the status of the device that just joined.
             # At this point, it could be any MQTT device becaue we haven't filtered by receivers.
             # See TODO in on_message_status
-            device.last_request = monotonic()
             self.req_status_targeted("variable", rx_name)
             self.req_status_targeted("static", rx_name)
+            self._poller.add(rx_name)
+        else:
+            self._device_index.remove(rx_name)
+            self._liveness.remove(rx_name)
+            self._poller.remove(rx_name)
+            self.devices[rx_name].extended_properties["stale"] = False
 
-        self.Events.trigger(Evt.VRX_DATA_RECEIVE, {
-            'rx_name': rx_name,
-            })
+        self._data_events.mark(rx_name, {'connected': connection_status})
 
     def on_message_resp_all(self, client, userdata, message):
         payload = message.payload
@@ -561,57 +842,57 @@ class CV2Controller(VRxController):
         topic = message.topic
         device_id = topic.split('/')[-1]
         device = self.devices[device_id]
+        topic_target = self._topics.esp_target(device_id)
         payload = message.payload
+        self._metrics.count("device_responses", device_id)
         if len(payload) >= MINIMUM_PAYLOAD:
             device.connected = True #TODO this is probably not needed
+            # Answering after a disconnect, without a new connection message
+            # (e.g. a late last will): index and poll it again
+            if device_id not in self._device_index.connected:
+                self._device_index.set_seat(device_id, device.map.seat)
+                self._device_index.set_connected(device_id)
+            if device_id not in self._poller:
+                self._poller.add(device_id)
             device.last_response = monotonic()
+            rtt = self._liveness.response(device_id, device.last_response)
+            previous_seat = device.map.seat
             try:
-                extracted_data = json.loads(payload)
+                extracted_data = self._response_decoder.decode(payload)
 
-            except:
+            except ValueError:
                 logger.warning("Can't load json data from '%s' of '%s'", device_id, payload)
                 logger.debug(traceback.format_exc())
                 device.ready = False
             else:
+                changed = self._response_decoder.apply(device, extracted_data)
+                if not device.ready:
+                    changed["ready"] = True
                 device.ready = True
 
-                # device.extended_properties.update(extracted_data)
-
-                if "device_name" in extracted_data:
-                    device.name = extracted_data["device_name"]
-
-                if "ip_addr" in extracted_data:
-                    device.address = extracted_data["ip_addr"]
-
-                if "seat" in extracted_data and extracted_data["seat"].isnumeric():
-                    device.map.seat = int(extracted_data["seat"])
-
-                if "lock" in extracted_data:
-                    rep_lock = extracted_data["lock"]
-
-                    device.extended_properties["chosen_camera_type"] = rep_lock[0]
-                    device.extended_properties["cam_forced_or_auto"] = rep_lock[1]
-                    device.video_lock = rep_lock[2] == "L"
-
-                if "video_format" in extracted_data:
-                    device.extended_properties["video_format"] = extracted_data["video_format"]
-
-                if "cv_version" in extracted_data:
-                    device.extended_properties["cv_version"] = extracted_data["cv_version"]
-
-                if "cvcm_version" in extracted_data:
-                    device.extended_properties["cvcm_version"] = extracted_data["cvcm_version"]
+                if rtt is not None:
+                    # Shown when the status page refreshes; not reported as a change,
+                    # since it differs on nearly every response
+                    device.extended_properties["rtt_ms"] = round(rtt * 1000, 1)
+                    device.extended_properties["rtt_typical_ms"] = round(self._liveness.typical_rtt(device_id) * 1000, 1)
+
+                if "map.seat" in changed:
+                    if previous_seat is not None:
+                        self._command_cache.invalidate(self._seat_topic(previous_seat))
+                    self.invalidate_device_state(device_id)
+                    self._device_index.set_seat(device_id, device.map.seat)
+                    self._poller.nudge(device_id)
+                else:
+                    self._poller.observe(device_id, bool(changed))
 
-                if "device_type" in extracted_data:
-                    device.extended_properties["device_type"] = extracted_data["device_type"]
+                self._requests.response(device_id, extracted_data)
 
-                if "osd_visibility" in extracted_data:
-                    device.extended_properties["osd_visibility"] = extracted_data["osd_visibility"]
+                reported_config = {k: extracted_data[k] for k in REPORTED_CONFIG_FIELDS if k in extracted_data}
+                if reported_config:
+                    self._command_cache.observe(topic_target, reported_config)
 
-                #TODO only fire event if the data changed
-                self.Events.trigger(Evt.VRX_DATA_RECEIVE, {
-                    'device_id': device_id,
-                    })
+                if changed:
+                    self._data_events.mark(device_id, changed)
 
                 if device.extended_properties["needs_config"] == True and device.ready == True:
                     self.perform_initial_receiver_config(device_id)
@@ -620,67 +901,123 @@ class CV2Controller(VRxController):
     def req_status_targeted(self, mode = "variable",serial_num = None):
         """Ask a targeted receiver for its status.
         Inputs:
-            *mode: ["variable","static"]
+            *mode: ["variable","static","lock"]
             *serial_num: The devices's unique serial number to target it
+        Returns a future resolving with the decoded response, see RequestTracker
         """
 
-        if mode not in ["variable", "static"]:
+        if mode not in ["variable", "static", "lock"]:
             logger.error("Incorrect mode in req_status_targeted")
             return None
         if serial_num not in self.devices:
             logger.error("RX %s does not exist", serial_num)
             return None
 
-        topic = mqtt_publish_topics["cv1"]["receiver_command_esp_targeted_topic"][0]%serial_num
+        topic = self._topics.esp_target(serial_num)
         if mode == "variable":
-            cmd = ESP_COMMANDS["Request Variable Status"]
+            cmd = esp_payloads.REQUEST_VARIABLE_STATUS
         elif mode == "static":
-            cmd = ESP_COMMANDS["Request Static Status"]
+            cmd = esp_payloads.REQUEST_STATIC_STATUS
+        elif mode == "lock":
+            cmd = esp_payloads.REQUEST_LOCK
         else:
             raise Exception("Error checking mode has failed")
-        self._mqttc.publish(topic,cmd)
+        command = CMD_LOCK_QUERY if mode == "lock" else CMD_STATUS_REQUEST
+
+        # A query refused by a full status lane isn't waited on; _on_query_sent times it once it goes out
+        return self._requests.request_device(mode, serial_num,
+                                             lambda: self._publisher.publish(topic, cmd, command))
 
 
     def turn_off_osd_targeted(self, target):
         """Turns off all OSD elements except user message"""
-        topic = mqtt_publish_topics["cv1"]["receiver_command_esp_targeted_topic"][0]%target
-        cmd = json.dumps({"osd_visibility" : "D"})
-        self._mqttc.publish(topic, cmd)
-        return cmd
+        topic = self._topics.esp_target(target)
+        return publish_config(self._publisher, self._command_cache, topic, {"osd_visibility" : "D"}, CMD_OSD_VISIBILITY, esp_payloads.OSD_VISIBILITY_OFF)
 
     def turn_on_osd_targeted(self, target):
         """Turns on all OSD elements except user message"""
-        topic = mqtt_publish_topics["cv1"]["receiver_command_esp_targeted_topic"][0]%target
-        cmd = json.dumps({"osd_visibility" : "E"})
-        self._mqttc.publish(topic, cmd)
-        return cmd
+        topic = self._topics.esp_target(target)
+        return publish_config(self._publisher, self._command_cache, topic, {"osd_visibility" : "E"}, CMD_OSD_VISIBILITY, esp_payloads.OSD_VISIBILITY_ON)
+
+def publish_config(publisher, command_cache, topic, fields, command, cmd=None):
+    """Publish a config command unless the target is known to hold it already
+
+    cmd is the encoded payload for fields, if it is already known.
+    """
+    if cmd is None:
+        cmd = esp_payloads.encode_command(fields)
+    if command_cache is not None and not command_cache.record(topic, fields):
+        logger.debug("Skipping %s to %s, already set", cmd, topic)
+    elif not publisher.publish(topic, cmd, command) and command_cache is not None:
+        # Refused by a full lane, so the receiver won't get the recorded value
+        command_cache.invalidate(topic)
+    return cmd
+
+@functools.lru_cache(maxsize=64)
+def bandchannel_command(frequency):
+    """Band/channel command fields and encoded payload for a frequency
+
+    Returns None if ClearView can't tune to the frequency.
+    """
+    cv_bc = clearview.comspecs.frequency_to_bandchannel_dict(frequency)
+    if not cv_bc:
+        return None
+    return cv_bc, esp_payloads.encode_command(cv_bc)
 
 CRED = '\033[91m'
 CEND = '\033[0m'
 def printc(*args):
     print(CRED + ' '.join(args) + CEND)
 
+def describe_metrics(metrics):
+    metrics.describe("published_messages", "Messages handed to the MQTT client", "topic")
+    metrics.describe("published_bytes", "Payload bytes handed to the MQTT client", "topic")
+    metrics.describe("received_messages", "Messages received from the MQTT broker", "topic")
+    metrics.describe("received_bytes", "Payload bytes received from the MQTT broker", "topic")
+    metrics.describe("callback_seconds", "Time spent in MQTT message callbacks", "callback")
+    metrics.describe("device_responses", "Responses received from each receiver", "device")
+    metrics.describe("osd_messages", "OSD messages published per seat after coalescing", "seat")
+    metrics.describe("publish_queue_depth", "Messages waiting in each publish lane", "lane")
+    metrics.describe("publish_dropped", "Messages dropped from each full publish lane", "lane")
+    metrics.describe("publish_max_wait_ms", "Longest wait of a message in each publish lane", "lane")
+    metrics.describe("devices", "Receivers by state", "state")
+    metrics.describe("response_time_ms", "Receiver response time percentiles", "percentile")
+
 class BaseVRxSeat:
     """Seat controller for both the broadcast and individual seats"""
     def __init__(self,
-                 mqtt_client, Language
+                 publisher, Language,
+                 command_cache=None,
+                 topics=cv1_topics,
+                 desired_state=None
                  ):
 
-        self._mqttc = mqtt_client
+        self._publisher = publisher
         self.language = Language
+        self._command_cache = command_cache
+        self._topics = topics
+        self._desired_state = desired_state
         logger = logging.getLogger(self.language.__class__.__name__)
 
+    def _record(self, topic, kind, command, payload):
+        """Remember a command for replay after a broker reconnect"""
+        if self._desired_state is not None:
+            self._desired_state.record(topic, kind, command, payload)
+
 class VRxSeat(BaseVRxSeat):
     """Commands and Requests apply to all receivers at a seat number"""
     def __init__(self,
-                 mqtt_client,
+                 publisher,
                  Language,
                  seat_number,
                  seat_frequency,
                  seat_number_range = (0,7), #(min,max)
-                 seat_camera_type = 'A'
+                 seat_camera_type = 'A',
+                 command_cache = None,
+                 topics = cv1_topics,
+                 desired_state = None
                  ):
-        BaseVRxSeat.__init__(self, mqtt_client, Language)
+        BaseVRxSeat.__init__(self, publisher, Language, command_cache, topics, desired_state)
 
         # RH refers to seats 0 to 7
         self.MIN_SEAT_NUM = seat_number_range[0]
@@ -693,6 +1030,8 @@ class VRxSeat(BaseVRxSeat):
         else:
             raise Exception("seat_number %d out of range", seat_number)
 
+        self._esp_seat_topic = self._topics.esp_seat[self._seat_number]
+
         self._seat_frequency = seat_frequency
         self._seat_camera_type = seat_camera_type
         self._seat_lock_status = None
@@ -716,9 +1055,13 @@ class VRxSeat(BaseVRxSeat):
             raise Exception("seat_number out of range")
 
     def set_seat_number(self, new_seat_number):
-        topic = mqtt_publish_topics["cv1"]["receiver_command_esp_seat_topic"][0]%self._seat_number
-        cmd = json.dumps({"seat": str(new_seat_number)})
-        self._mqttc.publish(topic, cmd)
+        topic = self._esp_seat_topic
+        cmd = esp_payloads.encode_command({"seat": str(new_seat_number)})
+        self._publisher.publish(topic, cmd, CMD_SEAT)
+        if self._command_cache is not None:
+            # Receivers move seats, so neither seat's known state holds any more
+            self._command_cache.invalidate(topic)
+            self._command_cache.invalidate(self._topics.esp_seat[new_seat_number])
         return
 
     @property
@@ -731,23 +1074,17 @@ class VRxSeat(BaseVRxSeat):
         """Sets all receivers at this seat number to the new frequency"""
         raise NotImplementedError
 
-    def set_seat_frequency(self, frequency):
-        self.set_message_direct(self.language.__("!!! Frequency changing to {0} in <10s !!!").format(frequency))
-        gevent.sleep(10)
-
-        self.set_seat_frequency_direct(frequency)
-        self.set_message_direct(self.language.__(""))
-
     def set_seat_frequency_direct(self, frequency):
         """Sets all receivers at this seat number to the new frequency"""
         self._seat_frequency = frequency
         if frequency != RHUtils.FREQUENCY_ID_NONE:
 
             # For ClearView, set the band and channel
-            cv_bc = clearview.comspecs.frequency_to_bandchannel_dict(frequency)
-            if cv_bc:
-                topic = mqtt_publish_topics["cv1"]["receiver_command_esp_seat_topic"][0]%self._seat_number
-                self._mqttc.publish(topic, json.dumps(cv_bc))
+            bc_command = bandchannel_command(frequency)
+            if bc_command:
+                topic = self._esp_seat_topic
+                self._record(topic, KIND_FREQUENCY, CMD_FREQUENCY, bc_command[1])
+                publish_config(self._publisher, self._command_cache, topic, bc_command[0], CMD_FREQUENCY, bc_command[1])
 
             else:
                 logger.warning("Unable to set ClearView frequency to %s", frequency)
@@ -775,108 +1112,110 @@ class VRxSeat(BaseVRxSeat):
         print("TODO seat_lock_status property")
 
     def get_seat_lock_status(self,):
-        topic = mqtt_publish_topics["cv1"]["receiver_command_esp_seat_topic"][0]%self._seat_number
-        report_req = json.dumps({"lock": "?"})
-        self._mqttc.publish(topic,report_req)
+        topic = self._esp_seat_topic
+        report_req = esp_payloads.REQUEST_LOCK
+        self._publisher.publish(topic, report_req, CMD_LOCK_QUERY)
         return report_req
 
     def request_static_status(self):
-        topic = mqtt_publish_topics["cv1"]["receiver_command_esp_seat_topic"][0]%self._seat_number
-        msg = ESP_COMMANDS["Request Static Status"]
-        self._mqttc.publish(topic,msg)
+        topic = self._esp_seat_topic
+        msg = esp_payloads.REQUEST_STATIC_STATUS
+        self._publisher.publish(topic, msg, CMD_STATUS_REQUEST)
 
     def request_variable_status(self):
-        topic = mqtt_publish_topics["cv1"]["receiver_command_esp_seat_topic"][0]%self._seat_number
-        msg = ESP_COMMANDS["Request Variable Status"]
-        self._mqttc.publish(topic,msg)
+        topic = self._esp_seat_topic
+        msg = esp_payloads.REQUEST_VARIABLE_STATUS
+        self._publisher.publish(topic, msg, CMD_STATUS_REQUEST)
 
     def set_message_direct(self, message):
         """Send a raw message to the OSD"""
-        topic = mqtt_publish_topics["cv1"]["receiver_command_esp_seat_topic"][0]%self._seat_number
-        cmd = json.dumps({"user_msg" : message})
-        self._mqttc.publish(topic, cmd)
+        topic = self._esp_seat_topic
+        cmd = esp_payloads.encode_user_msg(message)
+        self._record(topic, KIND_USER_MSG, CMD_USER_MSG, cmd)
+        self._publisher.publish(topic, cmd, CMD_USER_MSG)
         return cmd
 
     def turn_off_osd(self):
         """Turns off all OSD elements except user message"""
-        topic = mqtt_publish_topics["cv1"]["receiver_command_esp_seat_topic"][0]%self._seat_number
-        cmd = json.dumps({"osd_visibility" : "D"})
-        self._mqttc.publish(topic, cmd)
-        return cmd
+        topic = self._esp_seat_topic
+        self._record(topic, KIND_OSD_VISIBILITY, CMD_OSD_VISIBILITY, esp_payloads.OSD_VISIBILITY_OFF)
+        return publish_config(self._publisher, self._command_cache, topic, {"osd_visibility" : "D"}, CMD_OSD_VISIBILITY, esp_payloads.OSD_VISIBILITY_OFF)
 
     def turn_on_osd(self):
         """Turns on all OSD elements except user message"""
-        topic = mqtt_publish_topics["cv1"]["receiver_command_esp_seat_topic"][0]%self._seat_number
-        cmd = json.dumps({"osd_visibility" : "E"})
-        self._mqttc.publish(topic, cmd)
-        return cmd
+        topic = self._esp_seat_topic
+        self._record(topic, KIND_OSD_VISIBILITY, CMD_OSD_VISIBILITY, esp_payloads.OSD_VISIBILITY_ON)
+        return publish_config(self._publisher, self._command_cache, topic, {"osd_visibility" : "E"}, CMD_OSD_VISIBILITY, esp_payloads.OSD_VISIBILITY_ON)
 
 
 class VRxBroadcastSeat(BaseVRxSeat):
     def __init__(self,
-                 mqtt_client,
-                 Language
+                 publisher,
+                 Language,
+                 command_cache=None,
+                 topics=cv1_topics,
+                 desired_state=None
                  ):
-        BaseVRxSeat.__init__(self, mqtt_client, Language)
+        BaseVRxSeat.__init__(self, publisher, Language, command_cache, topics, desired_state)
         self._cv_broadcast_id = clearview.comspecs.clearview_specs['bc_id']
-        self._broadcast_cmd_topic = mqtt_publish_topics["cv1"]["receiver_command_all"][0]
-        self._rx_cmd_esp_all_topic = mqtt_publish_topics["cv1"]["receiver_command_esp_all_topic"][0]
+        self._broadcast_cmd_topic = self._topics.static("receiver_command_all")
+        self._rx_cmd_esp_all_topic = self._topics.esp_all
 
     def set_message_direct(self, message):
         """Send a raw message to all OSD's"""
         topic = self._rx_cmd_esp_all_topic
-        cmd = json.dumps({"user_msg" : message})
-        self._mqttc.publish(topic, cmd)
+        cmd = esp_payloads.encode_user_msg(message)
+        self._record(topic, KIND_USER_MSG, CMD_USER_MSG, cmd)
+        self._publisher.publish(topic, cmd, CMD_USER_MSG)
         return cmd
 
     def clear_user_message(self):
         """Clears the raw 'user message' on all OSD's"""
         topic = self._rx_cmd_esp_all_topic
-        cmd = json.dumps({"user_msg" : ""}) # empty string
-        self._mqttc.publish(topic, cmd)
+        cmd = esp_payloads.CLEAR_USER_MSG # empty string
+        self._record(topic, KIND_USER_MSG, CMD_USER_MSG, cmd)
+        self._publisher.publish(topic, cmd, CMD_USER_MSG)
         return cmd
 
     def turn_off_osd(self):
         """Turns off all OSD elements except user message"""
         topic = self._rx_cmd_esp_all_topic
-        cmd = json.dumps({"osd_visibility" : "D"})
-        self._mqttc.publish(topic, cmd)
-        return cmd
+        self._record(topic, KIND_OSD_VISIBILITY, CMD_OSD_VISIBILITY, esp_payloads.OSD_VISIBILITY_OFF)
+        return publish_config(self._publisher, self._command_cache, topic, {"osd_visibility" : "D"}, CMD_OSD_VISIBILITY, esp_payloads.OSD_VISIBILITY_OFF)
 
     def turn_on_osd(self):
         """Turns on all OSD elements except user message"""
         topic = self._rx_cmd_esp_all_topic
-        cmd = json.dumps({"osd_visibility" : "E"})
-        self._mqttc.publish(topic, cmd)
-        return cmd
+        self._record(topic, KIND_OSD_VISIBILITY, CMD_OSD_VISIBILITY, esp_payloads.OSD_VISIBILITY_ON)
+        return publish_config(self._publisher, self._command_cache, topic, {"osd_visibility" : "E"}, CMD_OSD_VISIBILITY, esp_payloads.OSD_VISIBILITY_ON)
 
     def reset_lock(self):
         """ Resets lock of all receivers"""
         topic = self._rx_cmd_esp_all_topic
-        cmd = json.dumps({"lock": "1"})
-        self._mqttc.publish(topic, cmd)
+        cmd = esp_payloads.RESET_LOCK
+        self._publisher.publish(topic, cmd, CMD_LOCK_RESET)
         return cmd
 
     def request_static_status(self):
         topic = self._rx_cmd_esp_all_topic
-        cmd = ESP_COMMANDS["Request Static Status"]
-        self._mqttc.publish(topic,cmd)
+        cmd = esp_payloads.REQUEST_STATIC_STATUS
+        self._publisher.publish(topic, cmd, CMD_STATUS_REQUEST)
 
     def request_variable_status(self):
         topic = self._rx_cmd_esp_all_topic
-        cmd = ESP_COMMANDS["Request Variable Status"]
-        self._mqttc.publish(topic,cmd)
+        cmd = esp_payloads.REQUEST_VARIABLE_STATUS
+        self._publisher.publish(topic, cmd, CMD_STATUS_REQUEST)
 
     def get_seat_lock_status(self,):
         topic = self._rx_cmd_esp_all_topic
-        report_req = json.dumps({"lock":"?"})
-        self._mqttc.publish(topic,report_req)
+        report_req = esp_payloads.REQUEST_LOCK
+        self._publisher.publish(topic, report_req, CMD_LOCK_QUERY)
         return report_req
 
     def set_wifi_state(self, wifi_state):
         topic = self._rx_cmd_esp_all_topic
-        cmd = json.dumps({"wifi": wifi_state})
-        self._mqttc.publish(topic, cmd)
+        cmd = esp_payloads.encode_command({"wifi": wifi_state})
+        self._publisher.publish(topic, cmd, CMD_WIFI)
         return cmd
 
 def main():
@@ -0,0 +1,89 @@
+'''Last-value cache for receiver config commands'''
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+SCOPE_ALL = 0
+SCOPE_SEAT = 1
+SCOPE_TARGET = 2
+
+class CommandStateCache:
+    """Last known value of each config field, per MQTT command topic.
+
+    Entries come from commands we published and from values receivers report
+    back. A publish can be skipped when the entry for its topic already holds
+    every field it would set.
+
+    The broadcast topic reaches every receiver, so a broadcast value is applied
+    to all entries. Seat and targeted topics overlap in ways the cache can't see
+    (a receiver is reached by both its seat and its serial), so a value sent on
+    one of them drops that field from the entries of the other kind and from
+    the broadcast entry.
+    """
+    def __init__(self, broadcast_topic, seat_prefix):
+        self._broadcast_topic = broadcast_topic
+        self._seat_prefix = seat_prefix
+        self._state = {}
+
+    def _scope(self, topic):
+        if topic == self._broadcast_topic:
+            return SCOPE_ALL
+        if topic.startswith(self._seat_prefix):
+            return SCOPE_SEAT
+        return SCOPE_TARGET
+
+    def is_current(self, topic, fields):
+        """True if every field is already known to hold the given value at topic"""
+        known = self._state.get(topic)
+        if not known:
+            return False
+        for field, value in fields.items():
+            if field not in known or known[field] != value:
+                return False
+        return True
+
+    def record(self, topic, fields):
+        """Record fields about to be sent to topic.
+
+        Returns False if the publish is redundant and should be skipped.
+        """
+        if self.is_current(topic, fields):
+            return False
+        self.update(topic, fields)
+        return True
+
+    def update(self, topic, fields):
+        """Store fields that were sent to topic"""
+        scope = self._scope(topic)
+        if scope == SCOPE_ALL:
+            for state in self._state.values():
+                state.update(fields)
+        else:
+            for other_topic, state in self._state.items():
+                if other_topic != topic and self._scope(other_topic) != scope:
+                    for field in fields:
+                        state.pop(field, None)
+        self._state.setdefault(topic, {}).update(fields)
+
+    def observe(self, topic, fields):
+        """Store fields a receiver reported about its own state"""
+        for other_topic, state in self._state.items():
+            if other_topic != topic and self._scope(other_topic) != SCOPE_TARGET:
+                for field, value in fields.items():
+                    if state.get(field, value) != value:
+                        del state[field]
+        self._state.setdefault(topic, {}).update(fields)
+
+    def invalidate(self, topic=None):
+        """Forget known state for topic, or for every topic if none is given.
+
+        Any change to a receiver also breaks what is known about all receivers,
+        so the broadcast entry is always dropped.
+        """
+        if topic is None:
+            self._state.clear()
+            logger.debug("Command cache cleared")
+        else:
+            self._state.pop(topic, None)
+            self._state.pop(self._broadcast_topic, None)
@@ -0,0 +1,137 @@
+'''Model of a ClearView receiver's CVCM, for the emulators
+
+CVCMState holds what a receiver reports (seat, band/channel, OSD visibility,
+lock, versions) and answers ESP commands the way the CVCM does: fields sent
+with "?" are queries answered on the receiver's resp_target topic, other
+fields set state and get no answer.
+
+ResponseShaper decides when, or whether, each answer is sent, so controller
+timing can be exercised against slow or lossy receivers.
+'''
+
+import json
+import random
+import time
+
+# Time the receiver takes to lock onto video again after a lock reset
+RELOCK_S = 0.5
+
+class CVCMState:
+    """Reported state of one receiver"""
+    def __init__(self, serial_num, seat_number=0, cv_version="1.20", cvcm_version="1.0.0",
+                 device_type="cv1", video_format="N", clock=time.monotonic):
+        self.serial_num = serial_num
+        self._clock = clock
+        self.fields = {
+            "seat": str(seat_number),
+            "device_name": serial_num,
+            "ip_addr": "10.0.%d.%d" % (random.randint(0, 255), random.randint(1, 254)),
+            "video_format": video_format,
+            "cv_version": cv_version,
+            "cvcm_version": cvcm_version,
+            "mac_addr": ":".join("%02X" % random.randint(0, 255) for _ in range(6)),
+            "device_type": device_type,
+            "osd_visibility": "E",
+            "user_msg": "",
+        }
+        # Camera type, forced or auto; the lock flag is worked out from _lock_reset_at
+        self._lock_prefix = "NA"
+        self._lock_reset_at = None
+        self.commands = 0
+        self.queries = 0
+
+    @property
+    def seat_number(self):
+        return int(self.fields["seat"])
+
+    @property
+    def lock(self):
+        locked = self._lock_reset_at is None or self._clock() - self._lock_reset_at >= RELOCK_S
+        return self._lock_prefix + ("L" if locked else "U")
+
+    def handle(self, payload):
+        """Apply a command payload
+
+        Returns the encoded answer to any queries in it, or None if it had none.
+        Raises ValueError if the payload isn't a JSON object.
+        """
+        command = json.loads(payload)
+        if not isinstance(command, dict):
+            raise ValueError("Command is not a JSON object")
+        self.commands += 1
+
+        answer = {}
+        for key, value in command.items():
+            if value == "?":
+                if key == "lock":
+                    answer[key] = self.lock
+                elif key in self.fields:
+                    answer[key] = self.fields[key]
+            elif key == "lock":
+                self._lock_reset_at = self._clock()
+            elif key == "seat" and not str(value).isnumeric():
+                continue
+            else:
+                # Band/channel and any other settings are stored as sent
+                self.fields[key] = value if isinstance(value, str) else str(value)
+
+        if not answer:
+            return None
+        self.queries += 1
+        return json.dumps(answer).encode('ascii')
+
+class ResponseShaper:
+    """Delays, drops and rate-limits a receiver's answers
+
+    latency and jitter are in seconds; each answer is delayed by latency plus
+    a uniform random part of up to jitter. loss is the chance an answer is
+    never sent. The ESP32 works through commands one at a time, so at most
+    rate answers per second are produced (None for no cap) and commands
+    arriving with more than max_backlog still waiting are dropped.
+    """
+    def __init__(self, latency=0.0, jitter=0.0, loss=0.0, rate=None, max_backlog=32, rng=None):
+        self.latency = latency
+        self.jitter = jitter
+        self.loss = loss
+        self.rate = rate
+        self.max_backlog = max_backlog
+        self._rng = rng or random.Random()
+        self._busy_until = 0.0
+        self.sent = 0
+        self.lost = 0
+        self.overflowed = 0
+
+    def schedule(self, now):
+        """Time to send an answer to a command received at now, or None to drop it"""
+        start = now
+        if self.rate:
+            service = 1.0 / self.rate
+            if self._busy_until - now > service * self.max_backlog:
+                self.overflowed += 1
+                return None
+            start = max(now, self._busy_until)
+            self._busy_until = start + service
+
+        if self.loss and self._rng.random() < self.loss:
+            self.lost += 1
+            return None
+        self.sent += 1
+        return start + self.latency + self._rng.uniform(0, self.jitter)
+
+    def stats(self):
+        return {'sent': self.sent, 'lost': self.lost, 'overflowed': self.overflowed}
+
+def add_shaper_arguments(parser):
+    """Command line options for a ResponseShaper"""
+    parser.add_argument("--latency-ms", type=float, default=5.0, help="delay before each answer")
+    parser.add_argument("--jitter-ms", type=float, default=5.0, help="random extra delay, up to this")
+    parser.add_argument("--loss", type=float, default=0.0, help="fraction of answers never sent")
+    parser.add_argument("--rate", type=float, default=50.0,
+                        help="answers per second each receiver can produce, 0 for no cap")
+
+def shaper_from_args(args, rng=None):
+    return ResponseShaper(latency=args.latency_ms / 1000.0,
+                          jitter=args.jitter_ms / 1000.0,
+                          loss=args.loss,
+                          rate=args.rate or None,
+                          rng=rng)
@@ -0,0 +1,45 @@
+'''Desired receiver state, replayed after a broker reconnect'''
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+KIND_FREQUENCY = "frequency"
+KIND_OSD_VISIBILITY = "osd_visibility"
+KIND_USER_MSG = "user_msg"
+
+class DesiredState:
+    """Latest command of each kind sent to each seat topic
+
+    Receivers and the broker may both lose state while the connection is down,
+    so what the controller last asked for is kept here and sent again in one
+    burst once it is back. Commands are replayed in the order they were
+    originally issued. A broadcast command overrides every seat, so it drops
+    the seat entries of the same kind issued before it.
+    """
+    def __init__(self, broadcast_topic):
+        self._broadcast_topic = broadcast_topic
+        self._entries = {}
+        self._sequence = 0
+
+    def record(self, topic, kind, command, payload):
+        """Remember payload as the latest command type command of kind for topic"""
+        self._sequence += 1
+        if topic == self._broadcast_topic:
+            for key in [key for key in self._entries if key[1] == kind]:
+                del self._entries[key]
+        self._entries[(topic, kind)] = (self._sequence, topic, payload, command)
+
+    def entries(self):
+        """(topic, payload, command) for every entry, oldest first"""
+        return [entry[1:] for entry in sorted(self._entries.values())]
+
+    def replay(self, publisher):
+        """Queue every entry on publisher. Returns the number queued"""
+        entries = self.entries()
+        publisher.publish_many(entries)
+        logger.info("Replayed %d seat commands", len(entries))
+        return len(entries)
+
+    def __len__(self):
+        return len(self._entries)
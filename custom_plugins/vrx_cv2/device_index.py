@@ -0,0 +1,40 @@
+'''Index of VRx devices by seat and connection state'''
+
+class DeviceIndex:
+    """Device IDs by seat and by connection state
+
+    Updated as devices report in, so per-seat lookups cost O(devices at seat)
+    instead of a scan of every device ever seen. A disconnected device is
+    removed until it reports in again.
+    """
+    def __init__(self):
+        self._by_seat = {}
+        self._seat_of = {}
+        self.connected = set()
+
+    def set_seat(self, device_id, seat):
+        old_seat = self._seat_of.get(device_id)
+        if old_seat == seat:
+            return
+        if old_seat is not None:
+            members = self._by_seat[old_seat]
+            members.discard(device_id)
+            if not members:
+                del self._by_seat[old_seat]
+        if seat is None:
+            self._seat_of.pop(device_id, None)
+        else:
+            self._seat_of[device_id] = seat
+            self._by_seat.setdefault(seat, set()).add(device_id)
+
+    def set_connected(self, device_id):
+        self.connected.add(device_id)
+
+    def at_seat(self, seat):
+        """Device IDs at a seat"""
+        return self._by_seat.get(seat, ())
+
+    def remove(self, device_id):
+        """Forget a device, e.g. when it disconnects, so seat queries don't wait on it"""
+        self.set_seat(device_id, None)
+        self.connected.discard(device_id)
@@ -0,0 +1,32 @@
+'''Ready-to-send payloads for ESP commands'''
+
+import json
+from json.encoder import encode_basestring_ascii
+
+from .mqtt_topics import ESP_COMMANDS
+
+def encode_command(fields):
+    """Encode a command dict the same way json.dumps does"""
+    return json.dumps(fields).encode('ascii')
+
+# Constant commands are encoded once at import
+OSD_VISIBILITY_OFF = encode_command({"osd_visibility": "D"})
+OSD_VISIBILITY_ON = encode_command({"osd_visibility": "E"})
+RESET_LOCK = encode_command({"lock": "1"})
+REQUEST_LOCK = encode_command({"lock": "?"})
+REQUEST_STATIC_STATUS = ESP_COMMANDS["Request Static Status"].encode('ascii')
+REQUEST_VARIABLE_STATUS = ESP_COMMANDS["Request Variable Status"].encode('ascii')
+
+_USER_MSG_PREFIX = '{"user_msg": '
+
+def encode_user_msg(message):
+    """Encode {"user_msg": message}
+
+    The output is byte-for-byte what json.dumps gives (ASCII with \\u escapes),
+    but the string is escaped directly instead of walking a dict.
+    """
+    if type(message) is not str:
+        return encode_command({"user_msg": message})
+    return (_USER_MSG_PREFIX + encode_basestring_ascii(message) + '}').encode('ascii')
+
+CLEAR_USER_MSG = encode_user_msg("")
@@ -0,0 +1,66 @@
+'''Aggregation of VRx data events'''
+
+import logging
+import gevent
+
+logger = logging.getLogger(__name__)
+
+class EventAggregator:
+    """Collects device changes and fires one event per flush interval
+
+    Every changed device between flushes is reported in a single event, so UI
+    refreshes follow the flush rate instead of the MQTT message rate.
+    Nothing is fired for an interval without changes.
+
+    summary_fn() returns a dict added to every event, for state that isn't
+    per device, such as receiver liveness.
+    """
+    def __init__(self, events, event_name, interval=0.25, summary_fn=None):
+        self._events = events
+        self._event_name = event_name
+        self.interval = interval
+        self._summary = summary_fn
+        self._changed = {}
+        self._flusher = None
+
+    def mark(self, device_id, changed=None):
+        """Record a change to device_id; changed is a dict of the fields that changed"""
+        if self.interval <= 0:
+            self._fire({device_id: dict(changed or {})})
+            return
+
+        fields = self._changed.setdefault(device_id, {})
+        if changed:
+            fields.update(changed)
+
+    def start(self):
+        if self._flusher is None and self.interval > 0:
+            self._flusher = gevent.spawn(self._run)
+
+    def stop(self):
+        if self._flusher is not None:
+            self._flusher.kill(block=False)
+            self._flusher = None
+        self.flush()
+
+    def flush(self):
+        if self._changed:
+            changed, self._changed = self._changed, {}
+            self._fire(changed)
+
+    def _fire(self, changed):
+        args = {
+            'device_ids': list(changed),
+            'changed': changed,
+            }
+        if self._summary is not None:
+            args.update(self._summary())
+        self._events.trigger(self._event_name, args)
+
+    def _run(self):
+        while True:
+            gevent.sleep(self.interval)
+            try:
+                self.flush()
+            except Exception:
+                logger.exception("Failed to fire aggregated VRx event")
@@ -0,0 +1,63 @@
+'''Coordinated seat frequency changes'''
+
+import logging
+import math
+import gevent
+from monotonic import monotonic
+
+logger = logging.getLogger(__name__)
+
+class FrequencyChangeScheduler:
+    """Merges seat frequency changes into a single countdown
+
+    The first change starts the countdown. Changes made before it ends join
+    it, replacing any change still pending for the same seat. When it ends,
+    every pending seat is committed at once.
+
+    warn_fn(seat, frequency, seconds) tells pilots a change is coming,
+    commit_fn(changes) applies a dict of seat to frequency.
+    """
+    def __init__(self, warn_fn, commit_fn, countdown=10.0):
+        self._warn = warn_fn
+        self._commit = commit_fn
+        self.countdown = countdown
+        self._pending = {}
+        self._deadline = None
+        self._worker = None
+
+    def schedule(self, seat, frequency):
+        if self.countdown <= 0:
+            self._commit({seat: frequency})
+            return
+
+        if self._worker is None:
+            self._deadline = monotonic() + self.countdown
+            self._worker = gevent.spawn(self._run)
+        elif seat in self._pending:
+            logger.debug("Frequency change for seat %s to %s replaces %s", seat, frequency, self._pending[seat])
+
+        self._pending[seat] = frequency
+        self._warn(seat, frequency, max(1, math.ceil(self._deadline - monotonic())))
+
+    def stop(self):
+        """Drop all pending changes"""
+        self._pending.clear()
+        if self._worker is not None:
+            self._worker.kill(block=False)
+            self._worker = None
+
+    @property
+    def pending(self):
+        return dict(self._pending)
+
+    def _run(self):
+        remaining = self._deadline - monotonic()
+        while remaining > 0:
+            gevent.sleep(remaining)
+            remaining = self._deadline - monotonic()
+
+        changes, self._pending = self._pending, {}
+        self._worker = None
+        if changes:
+            logger.info("Committing frequency changes %s", changes)
+            self._commit(changes)
@@ -0,0 +1,167 @@
+'''Receiver liveness from request and response times'''
+
+import bisect
+import heapq
+import logging
+import math
+import gevent
+import gevent.event
+from monotonic import monotonic
+
+logger = logging.getLogger(__name__)
+
+# Typical RTT of a device before it has answered anything
+DEFAULT_RTT = 0.5
+# Weight of the newest sample in a device's typical RTT
+RTT_SMOOTHING = 0.2
+
+class RttHistogram:
+    """Round trip times in logarithmic buckets, four per doubling, from 1 ms up"""
+    BUCKETS_PER_DOUBLING = 4
+    FIRST_BUCKET = 0.001
+
+    def __init__(self, max_rtt=60.0):
+        count = int(math.log2(max_rtt / self.FIRST_BUCKET) * self.BUCKETS_PER_DOUBLING) + 1
+        self.bounds = [self.FIRST_BUCKET * 2 ** (i / self.BUCKETS_PER_DOUBLING) for i in range(count)]
+        self.counts = [0] * (count + 1)
+        self.total = 0
+
+    def record(self, rtt):
+        self.counts[bisect.bisect_left(self.bounds, rtt)] += 1
+        self.total += 1
+
+    def percentile(self, fraction):
+        """Upper bound of the bucket holding the given fraction of samples, or None if empty"""
+        if not self.total:
+            return None
+        wanted = max(1, math.ceil(self.total * fraction))
+        seen = 0
+        for i, count in enumerate(self.counts):
+            seen += count
+            if seen >= wanted:
+                return self.bounds[min(i, len(self.bounds) - 1)]
+        return self.bounds[-1]
+
+class LivenessMonitor:
+    """Marks devices stale when a request goes unanswered for too long
+
+    A device is stale once a request has been outstanding for stale_multiple
+    times its typical RTT, kept within [min_timeout, max_timeout]. Deadlines
+    sit in a heap, so a check only looks at the requests that have expired.
+    A response to any later request clears the stale mark.
+
+    on_stale(device_id) and on_alive(device_id) are called as devices change state.
+    """
+    def __init__(self, stale_multiple=4.0, min_timeout=2.0, max_timeout=30.0,
+                 on_stale=None, on_alive=None):
+        self.stale_multiple = stale_multiple
+        self.min_timeout = min_timeout
+        self.max_timeout = max_timeout
+        self._on_stale = on_stale
+        self._on_alive = on_alive
+
+        self.histogram = RttHistogram()
+        self.stale = set()
+        self._typical = {}
+        self._last_rtt = {}
+        self._outstanding = {}
+        self._deadlines = []
+        self._wakeup = gevent.event.Event()
+        self._worker = None
+
+    def start(self):
+        if self._worker is None:
+            self._worker = gevent.spawn(self._run)
+
+    def stop(self):
+        if self._worker is not None:
+            self._worker.kill(block=False)
+            self._worker = None
+
+    def timeout(self, device_id):
+        rtt = self._typical.get(device_id, DEFAULT_RTT)
+        return min(self.max_timeout, max(self.min_timeout, rtt * self.stale_multiple))
+
+    def request(self, device_id, sent_at=None):
+        """Note a request to device_id. Only the oldest unanswered request is timed"""
+        if device_id in self._outstanding:
+            return
+        if sent_at is None:
+            sent_at = monotonic()
+        self._outstanding[device_id] = sent_at
+        deadline = sent_at + self.timeout(device_id)
+        earliest = self._deadlines[0][0] if self._deadlines else None
+        heapq.heappush(self._deadlines, (deadline, sent_at, device_id))
+        if earliest is None or deadline < earliest:
+            self._wakeup.set()
+
+    def response(self, device_id, received_at=None):
+        """Note a response from device_id. Returns its RTT, or None if nothing was outstanding"""
+        if received_at is None:
+            received_at = monotonic()
+        sent_at = self._outstanding.pop(device_id, None)
+        rtt = None
+        if sent_at is not None:
+            rtt = received_at - sent_at
+            self.histogram.record(rtt)
+            self._last_rtt[device_id] = rtt
+            typical = self._typical.get(device_id)
+            self._typical[device_id] = rtt if typical is None else typical + RTT_SMOOTHING * (rtt - typical)
+
+        if device_id in self.stale:
+            self.stale.discard(device_id)
+            logger.info("Device %s is responding again", device_id)
+            if self._on_alive is not None:
+                self._on_alive(device_id)
+        return rtt
+
+    def remove(self, device_id):
+        """Stop tracking device_id, e.g. after it disconnects. Its heap entry expires unnoticed"""
+        self._outstanding.pop(device_id, None)
+        self._typical.pop(device_id, None)
+        self._last_rtt.pop(device_id, None)
+        self.stale.discard(device_id)
+
+    def check(self, now=None):
+        """Mark devices whose deadline has passed as stale. Returns the seconds until the next deadline"""
+        if now is None:
+            now = monotonic()
+        while self._deadlines and self._deadlines[0][0] <= now:
+            _deadline, sent_at, device_id = heapq.heappop(self._deadlines)
+            if self._outstanding.get(device_id) != sent_at or device_id in self.stale:
+                continue
+            # The request is presumed lost; the next one is timed afresh
+            del self._outstanding[device_id]
+            self.stale.add(device_id)
+            logger.warning("Device %s has not answered for %.1fs", device_id, now - sent_at)
+            if self._on_stale is not None:
+                self._on_stale(device_id)
+        return self._deadlines[0][0] - now if self._deadlines else None
+
+    def typical_rtt(self, device_id):
+        return self._typical.get(device_id)
+
+    def last_rtt(self, device_id):
+        return self._last_rtt.get(device_id)
+
+    def stats(self):
+        return {
+            'stale': sorted(self.stale),
+            'samples': self.histogram.total,
+            'rtt_p50_ms': _ms(self.histogram.percentile(0.5)),
+            'rtt_p90_ms': _ms(self.histogram.percentile(0.9)),
+            'rtt_p99_ms': _ms(self.histogram.percentile(0.99)),
+        }
+
+    def _run(self):
+        while True:
+            try:
+                wait = self.check()
+            except Exception:
+                logger.exception("Failed to check device liveness")
+                wait = None
+            self._wakeup.wait(timeout=wait if wait is not None else self.max_timeout)
+            self._wakeup.clear()
+
+def _ms(seconds):
+    return None if seconds is None else round(seconds * 1000, 1)
@@ -0,0 +1,185 @@
+'''Message and timing metrics with a Prometheus text exporter'''
+
+import functools
+import logging
+import os
+import time
+import gevent
+
+logger = logging.getLogger(__name__)
+
+METRIC_PREFIX = "vrx_cv2_"
+
+class MetricsRegistry:
+    """Counters, gauges and timings keyed by metric name and one label value
+
+    Collectors registered with add_collector(fn) are called before each
+    snapshot or export to refresh gauges that are cheaper to read on demand,
+    such as queue depths.
+    """
+    enabled = True
+
+    def __init__(self):
+        self._counters = {}
+        self._gauges = {}
+        self._timings = {}
+        self._help = {}
+        self._label_names = {}
+        self._collectors = []
+
+    def describe(self, name, help_text, label_name="label"):
+        self._help[name] = help_text
+        self._label_names[name] = label_name
+
+    def count(self, name, label, value=1):
+        key = (name, label)
+        self._counters[key] = self._counters.get(key, 0) + value
+
+    def gauge(self, name, label, value):
+        self._gauges[(name, label)] = value
+
+    def observe(self, name, label, seconds):
+        timing = self._timings.get((name, label))
+        if timing is None:
+            self._timings[(name, label)] = [1, seconds, seconds]
+        else:
+            timing[0] += 1
+            timing[1] += seconds
+            if seconds > timing[2]:
+                timing[2] = seconds
+
+    def timed(self, name, label):
+        """Decorate fn to record its execution time"""
+        def decorator(fn):
+            @functools.wraps(fn)
+            def wrapper(*args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    return fn(*args, **kwargs)
+                finally:
+                    self.observe(name, label, time.perf_counter() - start)
+            return wrapper
+        return decorator
+
+    def add_collector(self, collector):
+        self._collectors.append(collector)
+
+    def collect(self):
+        for collector in self._collectors:
+            try:
+                collector(self)
+            except Exception:
+                logger.exception("Metrics collector failed")
+
+    def snapshot(self):
+        """All values as a dict of metric name to {label: value}"""
+        self.collect()
+        snapshot = {}
+        for (name, label), value in self._counters.items():
+            snapshot.setdefault(name, {})[label] = value
+        for (name, label), value in self._gauges.items():
+            snapshot.setdefault(name, {})[label] = value
+        for (name, label), (count, total, maximum) in self._timings.items():
+            snapshot.setdefault(name, {})[label] = {'count': count, 'sum_s': total, 'max_s': maximum}
+        return snapshot
+
+    def render_prometheus(self):
+        """Prometheus text exposition format"""
+        self.collect()
+        lines = []
+        for kind, values in (("counter", self._counters), ("gauge", self._gauges)):
+            for name in sorted({name for name, _label in values}):
+                label_name = self._header(lines, name, kind)
+                for (metric, label), value in sorted(values.items(), key=lambda item: str(item[0])):
+                    if metric == name:
+                        lines.append("%s%s{%s=\"%s\"} %s" % (METRIC_PREFIX, name, label_name, _escape(label), value))
+
+        for name in sorted({name for name, _label in self._timings}):
+            timings = sorted(((label, timing) for (metric, label), timing in self._timings.items() if metric == name),
+                             key=lambda item: str(item[0]))
+            label_name = self._header(lines, name, "summary")
+            for label, (count, total, _maximum) in timings:
+                labels = "{%s=\"%s\"}" % (label_name, _escape(label))
+                lines.append("%s%s_count%s %d" % (METRIC_PREFIX, name, labels, count))
+                lines.append("%s%s_sum%s %.6f" % (METRIC_PREFIX, name, labels, total))
+            # Summaries have no max series, so the longest time is a gauge of its own
+            lines.append("# TYPE %s%s_max gauge" % (METRIC_PREFIX, name))
+            for label, (_count, _total, maximum) in timings:
+                lines.append("%s%s_max{%s=\"%s\"} %.6f" % (METRIC_PREFIX, name, label_name, _escape(label), maximum))
+        lines.append("")
+        return "\n".join(lines)
+
+    def write(self, path):
+        """Replace the file at path with the current metrics"""
+        temp_path = path + ".tmp"
+        with open(temp_path, "w") as f:
+            f.write(self.render_prometheus())
+        os.replace(temp_path, path)
+
+    def _header(self, lines, name, kind):
+        if name in self._help:
+            lines.append("# HELP %s%s %s" % (METRIC_PREFIX, name, self._help[name]))
+        lines.append("# TYPE %s%s %s" % (METRIC_PREFIX, name, kind))
+        return self._label_names.get(name, "label")
+
+class NullMetrics:
+    """Stands in for MetricsRegistry when metrics are disabled. Every call does nothing"""
+    enabled = False
+
+    def describe(self, name, help_text, label_name="label"):
+        pass
+
+    def count(self, name, label, value=1):
+        pass
+
+    def gauge(self, name, label, value):
+        pass
+
+    def observe(self, name, label, seconds):
+        pass
+
+    def timed(self, name, label):
+        return lambda fn: fn
+
+    def add_collector(self, collector):
+        pass
+
+    def snapshot(self):
+        return {}
+
+    def render_prometheus(self):
+        return "# VRx CV2 metrics are disabled\n"
+
+NULL_METRICS = NullMetrics()
+
+class MetricsFileExporter:
+    """Writes the registry to a file every interval, for a Prometheus node exporter textfile collector"""
+    def __init__(self, registry, path, interval=15.0):
+        self._registry = registry
+        self.path = path
+        self.interval = interval
+        self._worker = None
+
+    def start(self):
+        if self._worker is None:
+            self._worker = gevent.spawn(self._run)
+
+    def stop(self):
+        if self._worker is not None:
+            self._worker.kill(block=False)
+            self._worker = None
+            self.write()
+
+    def write(self):
+        try:
+            self._registry.write(self.path)
+        except OSError as e:
+            logger.warning("Unable to write VRx metrics to %s: %s", self.path, e)
+
+    def _run(self):
+        while True:
+            gevent.sleep(self.interval)
+            self.write()
+
+def _escape(label):
+    return str(label).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
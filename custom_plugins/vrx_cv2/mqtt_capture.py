@@ -0,0 +1,198 @@
+'''Capture of MQTT traffic to a compact binary log
+
+The log is append-only. Each time a capture is opened it starts a new
+session, and every record after that belongs to the session. A record cut
+short at the end of the file, e.g. by a crash mid-write, is dropped before
+appending:
+
+    file header     b"VRXCAP\\x00\\x01"               (once, at the start of the file)
+    session         'S' <wall time: float64>
+    topic           'T' <topic id: uint16> <length: uint16> <topic>
+    message         'I' or 'O' <ns since session start: uint64> <topic id: uint16>
+                    <length: uint32> <payload>
+
+'I' is a message received from the broker, 'O' one published. A topic is
+written once per session, the first time it is seen, and messages refer to
+it by ID. All numbers are little-endian.
+'''
+
+import io
+import logging
+import struct
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+FILE_HEADER = b"VRXCAP\x00\x01"
+INCOMING = b"I"
+OUTGOING = b"O"
+_SESSION = b"S"
+_TOPIC = b"T"
+
+_SESSION_RECORD = struct.Struct("<cd")
+_TOPIC_RECORD = struct.Struct("<cHH")
+_MESSAGE_RECORD = struct.Struct("<cQHI")
+
+MAX_TOPICS = 0xFFFF
+
+def payload_bytes(payload):
+    """A payload as paho sends it"""
+    if payload is None:
+        return b''
+    if isinstance(payload, (bytes, bytearray)):
+        return bytes(payload)
+    if isinstance(payload, str):
+        return payload.encode('utf-8')
+    return str(payload).encode('ascii')
+
+class CaptureWriter:
+    """Appends captured messages to a file
+
+    Records go through a write buffer and are flushed to disk every
+    flush_interval seconds, or when the buffer fills, so recording costs one
+    struct.pack and a buffered write per message. Safe to call from several
+    threads.
+
+    Raises ValueError if path holds something other than a capture.
+    """
+    def __init__(self, path, flush_interval=1.0, buffer_size=1 << 16):
+        self.path = path
+        self.flush_interval = flush_interval
+        self._lock = threading.Lock()
+        _drop_torn_tail(path)
+        self._file = open(path, "ab", buffering=buffer_size)
+        if self._file.tell() == 0:
+            self._file.write(FILE_HEADER)
+        self._start_session()
+        self.messages = 0
+        self.bytes = 0
+
+    def _start_session(self):
+        self._topics = {}
+        self._start = time.monotonic_ns()
+        self._last_flush = time.monotonic()
+        self._file.write(_SESSION_RECORD.pack(_SESSION, time.time()))
+
+    def incoming(self, topic, payload):
+        self._record(INCOMING, topic, payload)
+
+    def outgoing(self, topic, payload):
+        self._record(OUTGOING, topic, payload)
+
+    def _record(self, direction, topic, payload):
+        payload = payload_bytes(payload)
+        with self._lock:
+            if self._file is None:
+                return
+            topic_id = self._topics.get(topic)
+            if topic_id is None:
+                if len(self._topics) >= MAX_TOPICS:
+                    self._start_session()
+                topic_id = self._topics[topic] = len(self._topics)
+                encoded = topic.encode('utf-8')
+                self._file.write(_TOPIC_RECORD.pack(_TOPIC, topic_id, len(encoded)))
+                self._file.write(encoded)
+            # Read under the lock, after any new session, so times never run backwards
+            now = time.monotonic_ns()
+            self._file.write(_MESSAGE_RECORD.pack(direction, now - self._start, topic_id, len(payload)))
+            self._file.write(payload)
+            self.messages += 1
+            self.bytes += len(payload)
+
+            if now / 1e9 - self._last_flush >= self.flush_interval:
+                self._last_flush = now / 1e9
+                self._file.flush()
+
+    def flush(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.flush()
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+        logger.info("Captured %d MQTT messages (%d payload bytes) to %s", self.messages, self.bytes, self.path)
+
+class CapturedMessage:
+    __slots__ = ('session', 'time', 'direction', 'topic', 'payload')
+
+    def __init__(self, session, at, direction, topic, payload):
+        self.session = session
+        self.time = at
+        self.direction = direction
+        self.topic = topic
+        self.payload = payload
+
+def _records(f, path):
+    """Yield (kind, fields, data) for each record from f's position on
+
+    fields are the record's unpacked numbers after kind; data is the topic or
+    payload that follows them, if any. After each yield f is at the end of
+    the record. A record cut short ends the records.
+    """
+    while True:
+        kind = f.read(1)
+        if not kind:
+            return
+        if kind in (INCOMING, OUTGOING):
+            record = _MESSAGE_RECORD
+        elif kind == _TOPIC:
+            record = _TOPIC_RECORD
+        elif kind == _SESSION:
+            record = _SESSION_RECORD
+        else:
+            raise ValueError("Unknown record %r at offset %d of %s" % (kind, f.tell() - 1, path))
+        header = f.read(record.size - 1)
+        if len(header) < record.size - 1:
+            return
+        fields = record.unpack(kind + header)[1:]
+        length = 0 if kind == _SESSION else fields[-1]
+        data = f.read(length)
+        if len(data) < length:
+            return
+        yield kind, fields, data
+
+def _drop_torn_tail(path):
+    """Truncate a capture after its last complete record, so records appended to it can be read"""
+    try:
+        f = open(path, "r+b")
+    except FileNotFoundError:
+        return
+    with f:
+        header = f.read(len(FILE_HEADER))
+        if header != FILE_HEADER[:len(header)]:
+            raise ValueError("%s is not a VRx MQTT capture" % path)
+        end = 0
+        if header == FILE_HEADER:
+            end = f.tell()
+            for _record in _records(f, path):
+                end = f.tell()
+        size = f.seek(0, io.SEEK_END)
+        if end < size:
+            logger.warning("Dropping %d bytes of a record cut short at the end of %s", size - end, path)
+            f.truncate(end)
+
+def read_capture(path):
+    """Yield each CapturedMessage in a capture file
+
+    time is in seconds since the start of the message's session; session
+    counts from 0. A record cut short at the end of the file, e.g. by a
+    crash mid-write, ends the capture.
+    """
+    with open(path, "rb") as f:
+        if f.read(len(FILE_HEADER)) != FILE_HEADER:
+            raise ValueError("%s is not a VRx MQTT capture" % path)
+        session = -1
+        topics = {}
+        for kind, fields, data in _records(f, path):
+            if kind == _SESSION:
+                session += 1
+                topics = {}
+            elif kind == _TOPIC:
+                topics[fields[0]] = data.decode('utf-8')
+            else:
+                at_ns, topic_id, _length = fields
+                yield CapturedMessage(session, at_ns / 1e9, kind, topics[topic_id], data)
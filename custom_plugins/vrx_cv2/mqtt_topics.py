@@ -1,4 +1,6 @@
+import functools
 import json
+import sys
 #########################
 # Established MQTT Topics
 #########################
@@ -110,4 +112,111 @@ ESP_COMMANDS = {
                                 "video_format": "?",
                                 "ip_addr": "?"}
                                 )
-}
\ No newline at end of file
+}
+
+def format_topic(topic_tuple, seat_number=None, serial_num=None):
+    """Substitute the parameter of a topic tuple
+
+    Wildcard parameters ('+' or '#') are substituted as themselves.
+    """
+    if isinstance(topic_tuple, str):
+        return topic_tuple
+    if not isinstance(topic_tuple, tuple):
+        raise TypeError("topic_tuple not of correct type: %s"%(topic_tuple,))
+
+    topic, formatter_name = topic_tuple
+    if formatter_name is None:
+        return topic
+    elif formatter_name in ["#","+"]:   # subscibe to all at single level (+) or recursively all (#)
+        return topic%formatter_name
+    elif formatter_name in ["seat_number", "node_number"]:
+        return topic%seat_number
+    elif formatter_name == "receiver_serial_num":
+        return topic%serial_num
+    else:
+        raise ValueError("Uncaptured formatter_name: %s"%formatter_name)
+
+
+class TopicRegistry:
+    """Preformatted topic strings for one receiver protocol version
+
+    Seat topics are built for every seat in seat_number_range up front.
+    Per-receiver topics are built the first time a serial number is used.
+    All topics are interned so later comparisons and dict lookups are cheap.
+    """
+    def __init__(self, rx_type="cv1", seat_number_range=(0,7)):
+        self._publish_topics = mqtt_publish_topics[rx_type]
+        self._subscribe_topics = mqtt_subscribe_topics[rx_type]
+        seats = range(seat_number_range[0], seat_number_range[1] + 1)
+
+        self._static = {}
+        self._seat = {}
+        self._target = {}
+        for key, topic_tuple in self._publish_topics.items():
+            formatter_name = topic_tuple[1]
+            if formatter_name is None:
+                self._static[key] = sys.intern(topic_tuple[0])
+            elif formatter_name == "seat_number":
+                self._seat[key] = {n: sys.intern(format_topic(topic_tuple, seat_number=n)) for n in seats}
+            elif formatter_name == "receiver_serial_num":
+                self._target[key] = {}
+
+        self.subscriptions = {key: sys.intern(format_topic(topic_tuple))
+                              for key, topic_tuple in self._subscribe_topics.items()}
+
+        # Shortcuts for the ESP command topics used on every publish
+        self.esp_all = self._static["receiver_command_esp_all_topic"]
+        self.esp_seat = self._seat["receiver_command_esp_seat_topic"]
+        self._esp_target = self._target["receiver_command_esp_targeted_topic"]
+
+    def static(self, key):
+        """Topic without parameters"""
+        return self._static[key]
+
+    def seat(self, key, seat_number):
+        """Topic for a seat number"""
+        return self._seat[key][seat_number]
+
+    def target(self, key, serial_num):
+        """Topic for a receiver serial number"""
+        topics = self._target[key]
+        topic = topics.get(serial_num)
+        if topic is None:
+            topic = topics[serial_num] = sys.intern(format_topic(self._publish_topics[key], serial_num=serial_num))
+        return topic
+
+    def esp_target(self, serial_num):
+        """ESP command topic for a receiver serial number"""
+        topic = self._esp_target.get(serial_num)
+        if topic is None:
+            topic = self.target("receiver_command_esp_targeted_topic", serial_num)
+        return topic
+
+    def seat_prefix(self, key):
+        """Part of a seat topic before the seat number"""
+        return self._publish_topics[key][0].split('%')[0]
+
+
+cv1_topics = TopicRegistry("cv1")
+
+
+def _topic_class_prefixes():
+    prefixes = []
+    for topics in (mqtt_publish_topics, mqtt_subscribe_topics):
+        for rx_topics in topics.values():
+            for template, formatter_name in rx_topics.values():
+                if formatter_name is not None:
+                    prefix = template.split('%')[0]
+                    prefixes.append((prefix, prefix + '+'))
+    # Longest first, so a prefix never shadows a longer one it starts
+    return sorted(set(prefixes), key=lambda entry: len(entry[0]), reverse=True)
+
+_TOPIC_CLASS_PREFIXES = _topic_class_prefixes()
+
+@functools.lru_cache(maxsize=1024)
+def topic_class(topic):
+    """Topic with its seat number or serial number replaced by '+', for grouping metrics"""
+    for prefix, topic_class_name in _TOPIC_CLASS_PREFIXES:
+        if topic.startswith(prefix):
+            return topic_class_name
+    return topic
@@ -0,0 +1,103 @@
+'''OSD message coalescing'''
+
+import logging
+import gevent
+
+logger = logging.getLogger(__name__)
+
+class MessageCoalescer:
+    """Holds OSD messages per seat for a short window and publishes only the newest.
+
+    A message submitted while an older one for the same seat is still held
+    replaces it, so the superseded message never reaches the MQTT client.
+    A message for the broadcast key overwrites every OSD, so it also drops
+    anything still held for individual seats.
+    """
+    def __init__(self, publish_fn, window=0.010, broadcast_key=None):
+        self._publish = publish_fn
+        self.window = window
+        self._broadcast_key = broadcast_key
+        self._pending = {}
+        self._timers = {}
+        self.collapsed = 0
+
+    def submit(self, key, message):
+        """Queue a message for key, replacing any message still held for it"""
+        if self.window <= 0:
+            self._publish(key, message)
+            return
+
+        if key == self._broadcast_key:
+            self._drop_seats()
+
+        if key in self._pending:
+            self.collapsed += 1
+            logger.debug("Collapsed OSD message for %s (%d total)", key, self.collapsed)
+        else:
+            self._timers[key] = gevent.spawn_later(self.window, self._flush_keys, (key,))
+
+        self._pending[key] = message
+
+    def submit_batch(self, messages):
+        """Queue messages for several keys, to be published together
+
+        messages: dict of key to message
+        """
+        if self.window <= 0:
+            for key, message in messages.items():
+                self._publish(key, message)
+            return
+
+        if self._broadcast_key in messages:
+            self._drop_seats()
+
+        timer = gevent.spawn_later(self.window, self._flush_keys, tuple(messages))
+        for key, message in messages.items():
+            if key in self._pending:
+                self.collapsed += 1
+                self._release(key)
+            self._pending[key] = message
+            self._timers[key] = timer
+
+    def flush(self):
+        """Publish everything still held without waiting for the window"""
+        for key in list(self._pending):
+            self._release(key)
+            self._publish(key, self._pending.pop(key))
+
+    def clear(self):
+        """Drop everything still held"""
+        for key in list(self._pending):
+            self._release(key)
+            del self._pending[key]
+
+    @property
+    def pending(self):
+        return len(self._pending)
+
+    def _drop_seats(self):
+        for seat_key in [k for k in self._pending if k != self._broadcast_key]:
+            self._release(seat_key)
+            del self._pending[seat_key]
+            self.collapsed += 1
+
+    def _release(self, key):
+        """Detach key from its timer, stopping the timer if no other key is waiting on it"""
+        timer = self._timers.pop(key)
+        if timer not in self._timers.values():
+            timer.kill(block=False)
+
+    def _flush_keys(self, keys):
+        timer = gevent.getcurrent()
+        # Take the whole batch before publishing, so a failed publish can't
+        # leave the rest held with no timer to send them
+        batch = []
+        for key in keys:
+            if self._timers.get(key) is timer:
+                del self._timers[key]
+                batch.append((key, self._pending.pop(key)))
+        for key, message in batch:
+            try:
+                self._publish(key, message)
+            except Exception:
+                logger.exception("Failed to publish OSD message for %s", key)
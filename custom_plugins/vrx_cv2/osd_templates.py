@@ -0,0 +1,127 @@
+'''OSD lap message templates'''
+
+import logging
+from time import perf_counter
+
+from RHRace import WinCondition
+import RHUtils
+
+logger = logging.getLogger(__name__)
+
+# Options whose values are captured in a template
+TEMPLATE_OPTIONS = ('timeFormat', 'osd_lapHeader', 'osd_previousLapHeader', 'osd_positionHeader', 'currentLanguage')
+
+class LapMessageTemplate:
+    """Lap messages for one win condition
+
+    Option values and translations are looked up once, when the template is
+    built, so rendering only formats the gap info.
+    """
+    def __init__(self, win_condition, rhdata, language):
+        self.win_condition = win_condition
+        self.time_format = rhdata.get_option('timeFormat')
+        self.lap_header = '{:<1}'.format(rhdata.get_option('osd_lapHeader', "L"))
+        self.pos_header = '{:<1}'.format(rhdata.get_option('osd_positionHeader', ""))
+        self.best_lap_text = language.__('Best Lap')
+        self.holeshot_text = language.__('HS')
+        self.leader_text = language.__('Leader')
+
+        # Pilots ahead only get a split-behind update in races decided by position
+        self.sends_split = win_condition not in [WinCondition.FASTEST_CONSECUTIVE, WinCondition.FASTEST_LAP]
+
+    def _lap_count(self, lap_number):
+        if lap_number:
+            return F"{self.lap_header}{lap_number}"
+        return self.holeshot_text
+
+    def crosser_message(self, info):
+        """Message for the pilot who crossed"""
+        # "P[n] L[n] 0:00:00"
+        message = F'{self.pos_header}{info.current.position} {self._lap_count(info.current.lap_number)} {RHUtils.time_format(info.current.last_lap_time, self.time_format)}'
+
+        if self.win_condition == WinCondition.FASTEST_CONSECUTIVE:
+            # "P[n] L[n] 0:00:00 | #/0:00.000" (current | best consecutives)
+            if info.current.lap_number > 1:
+                message += F' | {info.current.consecutives_base}/{RHUtils.time_format(info.current.consecutives, self.time_format)}'
+
+        elif self.win_condition == WinCondition.FASTEST_LAP:
+            if info.next_rank.diff_time:
+                # pilot in 2nd or lower
+                # "P[n] L[n] 0:00:00 | +0:00.000 Callsign"
+                message += F' | +{RHUtils.time_format(info.next_rank.diff_time, self.time_format)} {info.next_rank.callsign}'
+            elif info.current.is_best_lap:
+                # pilot in 1st and is best lap
+                # "P[n] L[n] 0:00:00 | Leader Best"
+                message += F' | {self.leader_text} {self.best_lap_text}'
+        else:
+            # WinCondition.MOST_LAPS
+            # WinCondition.FIRST_TO_LAP_X
+            # WinCondition.NONE
+
+            # "P[n] L[n] 0:00:00 | +0:00.000 Callsign"
+            if info.next_rank.diff_time:
+                message += F' | +{RHUtils.time_format(info.next_rank.diff_time, self.time_format)} {info.next_rank.callsign}'
+
+        return message
+
+    def split_message(self, info):
+        """Split-behind message for the pilot ahead, or None if they shouldn't be updated"""
+        if not info.next_rank.diff_time or not self.sends_split:
+            return None
+
+        # "P[n] L[n] 0:00:00"
+        message = F'{self.pos_header}{info.next_rank.position} {self._lap_count(info.next_rank.lap_number)} {RHUtils.time_format(info.next_rank.last_lap_time, self.time_format)}'
+
+        # "P[n] L[n] 0:00:00 | -0:00.000 Callsign"
+        message += F' | -{RHUtils.time_format(info.next_rank.diff_time, self.time_format)} {info.current.callsign}'
+        return message
+
+
+class LapMessageTemplates:
+    """Lap message templates per win condition, built on first use
+
+    Call invalidate() when a TEMPLATE_OPTIONS option or the language changes.
+    Build and render times are accumulated for stats().
+    """
+    def __init__(self, rhdata, language):
+        self._rhdata = rhdata
+        self._language = language
+        self._templates = {}
+
+        self.build_count = 0
+        self.build_time = 0.0
+        self.render_count = 0
+        self.render_time = 0.0
+
+    def invalidate(self):
+        self._templates.clear()
+
+    def get(self, win_condition):
+        template = self._templates.get(win_condition)
+        if template is None:
+            start = perf_counter()
+            template = LapMessageTemplate(win_condition, self._rhdata, self._language)
+            elapsed = perf_counter() - start
+            self.build_count += 1
+            self.build_time += elapsed
+            logger.debug("Built OSD lap template for win condition %s in %.3f ms", win_condition, elapsed * 1000)
+            self._templates[win_condition] = template
+        return template
+
+    def render(self, info):
+        """Returns (crosser message, split-behind message or None)"""
+        template = self.get(info.race.win_condition)
+        start = perf_counter()
+        messages = (template.crosser_message(info), template.split_message(info))
+        self.render_time += perf_counter() - start
+        self.render_count += 1
+        return messages
+
+    def stats(self):
+        return {
+            'build_count': self.build_count,
+            'build_time_ms': self.build_time * 1000,
+            'render_count': self.render_count,
+            'render_time_ms': self.render_time * 1000,
+            'mean_render_us': self.render_time / self.render_count * 1e6 if self.render_count else 0.0,
+        }
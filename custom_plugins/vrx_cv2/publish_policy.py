@@ -0,0 +1,34 @@
+'''Delivery policy for each kind of ESP command'''
+
+from collections import namedtuple
+
+# Lanes of the publish scheduler, highest priority first
+LANE_RACE = 0           # OSD messages and countdowns pilots are waiting on
+LANE_CONFIG = 1         # seat, frequency, OSD visibility and other receiver settings
+LANE_STATUS = 2         # status and lock queries
+
+# Command types
+CMD_USER_MSG = "user_msg"
+CMD_OSD_VISIBILITY = "osd_visibility"
+CMD_LOCK_QUERY = "lock_query"
+CMD_LOCK_RESET = "lock_reset"
+CMD_STATUS_REQUEST = "status_request"
+CMD_SEAT = "seat"
+CMD_FREQUENCY = "frequency"
+CMD_WIFI = "wifi"
+
+PublishPolicy = namedtuple('PublishPolicy', ['lane', 'qos', 'retain'])
+
+# OSD text is replaced within seconds and queries are repeated on the next
+# poll, so neither is worth a PUBACK round trip or a slot in the in-flight
+# window. Settings the receiver has to end up with are sent with QoS 1.
+PUBLISH_POLICY = {
+    CMD_USER_MSG: PublishPolicy(LANE_RACE, 0, False),
+    CMD_OSD_VISIBILITY: PublishPolicy(LANE_CONFIG, 1, False),
+    CMD_LOCK_QUERY: PublishPolicy(LANE_STATUS, 0, False),
+    CMD_LOCK_RESET: PublishPolicy(LANE_CONFIG, 1, False),
+    CMD_STATUS_REQUEST: PublishPolicy(LANE_STATUS, 0, False),
+    CMD_SEAT: PublishPolicy(LANE_CONFIG, 1, False),
+    CMD_FREQUENCY: PublishPolicy(LANE_CONFIG, 1, False),
+    CMD_WIFI: PublishPolicy(LANE_CONFIG, 1, False),
+}
@@ -0,0 +1,186 @@
+'''Prioritized, bounded outbound publish queue'''
+
+import logging
+from collections import deque
+import gevent
+import gevent.event
+from monotonic import monotonic
+
+from paho.mqtt.client import MQTT_ERR_SUCCESS, MQTT_ERR_NO_CONN
+
+from .publish_policy import PUBLISH_POLICY, LANE_RACE, LANE_CONFIG, LANE_STATUS
+
+logger = logging.getLogger(__name__)
+
+DROP_OLDEST = "oldest"  # make room by discarding the message queued longest
+DROP_NEWEST = "newest"  # refuse the message being queued
+
+# Messages handed to paho that are not acknowledged in this time no longer count as in flight
+INFLIGHT_TIMEOUT = 5.0
+
+class PublishLane:
+    """FIFO of messages waiting to be handed to paho"""
+    def __init__(self, name, max_depth, drop_policy):
+        self.name = name
+        self.max_depth = max_depth
+        self.drop_policy = drop_policy
+        self.queue = deque()
+
+        self.published = 0
+        self.dropped = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    def stats(self):
+        return {
+            'depth': len(self.queue),
+            'published': self.published,
+            'dropped': self.dropped,
+            'mean_wait_ms': self.wait_total / self.published * 1000 if self.published else 0.0,
+            'max_wait_ms': self.wait_max * 1000,
+        }
+
+def default_lanes():
+    return {
+        LANE_RACE: PublishLane("race", 64, DROP_OLDEST),
+        LANE_CONFIG: PublishLane("config", 256, DROP_OLDEST),
+        LANE_STATUS: PublishLane("status", 32, DROP_NEWEST),
+    }
+
+class PublishScheduler:
+    """Outbound queue in front of MQTT_Client.publish
+
+    Each command type's lane, QoS and retain flag come from PUBLISH_POLICY.
+    Messages wait in bounded per-lane queues and are handed to paho in lane
+    priority order, with at most max_inflight unacknowledged at a time. When
+    the broker stalls, messages pile up here instead of in paho's unbounded
+    queue, and a race message only ever waits behind other race messages and
+    the in-flight window. Nothing is handed over while the client is
+    disconnected; queued messages go out when the connection comes up.
+    """
+    def __init__(self, mqttc, max_inflight=10, lanes=None, policy=PUBLISH_POLICY):
+        self._mqttc = mqttc
+        self.max_inflight = max_inflight
+        self._policy = policy
+        self._lanes = lanes if lanes is not None else default_lanes()
+        self._lane_order = sorted(self._lanes)
+        self._inflight = {}
+        self._drop_callbacks = []
+        self._send_callbacks = []
+        self._wakeup = gevent.event.Event()
+        self._worker = None
+
+        self._mqttc.add_publish_callback(self._on_publish)
+        self._mqttc.add_connect_callback(self._wakeup.set)
+
+    def start(self):
+        if self._worker is None:
+            self._worker = gevent.spawn(self._run)
+
+    def stop(self):
+        if self._worker is not None:
+            self._worker.kill(block=False)
+            self._worker = None
+
+    def add_drop_callback(self, callback):
+        """Call callback(topic, payload, command) when a queued message is dropped to make room for a newer one"""
+        self._drop_callbacks.append(callback)
+
+    def add_send_callback(self, callback):
+        """Call callback(topic, payload, command, sent_at) when a message is handed to paho and goes out"""
+        self._send_callbacks.append(callback)
+
+    def publish(self, topic, payload, command):
+        """Queue a message of a command type. Returns False if the lane was full and the message was refused"""
+        accepted = self._enqueue(topic, payload, command)
+        self._wakeup.set()
+        return accepted
+
+    def publish_many(self, messages):
+        """Queue (topic, payload, command) messages as one burst. Returns how many were accepted"""
+        accepted = 0
+        for topic, payload, command in messages:
+            accepted += self._enqueue(topic, payload, command)
+        self._wakeup.set()
+        return accepted
+
+    def _enqueue(self, topic, payload, command):
+        policy = self._policy[command]
+        lane = self._lanes[policy.lane]
+        if len(lane.queue) >= lane.max_depth:
+            lane.dropped += 1
+            if lane.drop_policy == DROP_NEWEST:
+                logger.debug("Publish lane '%s' full, dropping message to %s", lane.name, topic)
+                return False
+            dropped = lane.queue.popleft()
+            logger.warning("Publish lane '%s' full, dropping message to %s", lane.name, dropped[1])
+            for callback in self._drop_callbacks:
+                callback(dropped[1], dropped[2], dropped[5])
+
+        lane.queue.append((monotonic(), topic, payload, policy.qos, policy.retain, command))
+        return True
+
+    def drain(self, timeout=1.0):
+        """Wait until every queued message has been handed to paho, or timeout"""
+        deadline = monotonic() + timeout
+        while self.depth and monotonic() < deadline:
+            gevent.sleep(0.01)
+        return not self.depth
+
+    @property
+    def depth(self):
+        return sum(len(lane.queue) for lane in self._lanes.values())
+
+    def stats(self):
+        stats = {lane.name: lane.stats() for lane in self._lanes.values()}
+        stats['inflight'] = len(self._inflight)
+        return stats
+
+    def _on_publish(self, _client, _userdata, mid):
+        if self._inflight.pop(mid, None) is not None:
+            self._wakeup.set()
+
+    def _next(self):
+        for lane_id in self._lane_order:
+            lane = self._lanes[lane_id]
+            if lane.queue:
+                return lane, lane.queue.popleft()
+        return None, None
+
+    def _prune_inflight(self):
+        if self._inflight:
+            expired = monotonic() - INFLIGHT_TIMEOUT
+            for mid in [mid for mid, sent_at in self._inflight.items() if sent_at < expired]:
+                del self._inflight[mid]
+
+    def _send(self, lane, item):
+        queued_at, topic, payload, qos, retain, command = item
+        now = monotonic()
+        wait = now - queued_at
+        lane.published += 1
+        lane.wait_total += wait
+        if wait > lane.wait_max:
+            lane.wait_max = wait
+
+        info = self._mqttc.publish(topic, payload, qos, retain)
+        if info is not None and (info.rc == MQTT_ERR_SUCCESS or (qos > 0 and info.rc == MQTT_ERR_NO_CONN)):
+            self._inflight[info.mid] = now
+        if info is not None and info.rc == MQTT_ERR_SUCCESS:
+            for callback in self._send_callbacks:
+                callback(topic, payload, command, now)
+
+    def _run(self):
+        while True:
+            self._wakeup.wait(timeout=1.0)
+            self._wakeup.clear()
+            if not self._mqttc.is_connected():
+                continue
+            self._prune_inflight()
+            try:
+                while len(self._inflight) < self.max_inflight:
+                    lane, item = self._next()
+                    if item is None:
+                        break
+                    self._send(lane, item)
+            except Exception:
+                logger.exception("Failed to hand message to MQTT client")
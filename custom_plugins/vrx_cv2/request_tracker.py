@@ -0,0 +1,155 @@
+'''Correlation of status and lock queries with receiver responses'''
+
+import logging
+import gevent
+import gevent.event
+
+logger = logging.getLogger(__name__)
+
+REQUEST_LOCK = "lock"
+REQUEST_STATIC = "static"
+REQUEST_VARIABLE = "variable"
+
+# A response answers a request of a kind if it holds this key
+RESPONSE_KEYS = {
+    REQUEST_LOCK: "lock",
+    REQUEST_STATIC: "cv_version",
+    REQUEST_VARIABLE: "seat",
+}
+
+class RequestTimeout(Exception):
+    """A receiver did not answer a targeted request in time"""
+
+class RequestNotSent(RequestTimeout):
+    """A query was refused before it was sent, e.g. by a full publish lane"""
+
+class PendingRequest:
+    def __init__(self, kind, members=None):
+        self.kind = kind
+        self.members = members
+        self.responses = {}
+        self.result = gevent.event.AsyncResult()
+        self.timer = None
+
+class RequestTracker:
+    """Hands out futures for queries and resolves them from responses
+
+    A query to one receiver resolves with its decoded response, or fails with
+    RequestTimeout. A query to a seat or to every receiver resolves with a dict
+    of device ID to response once every expected receiver has answered, or with
+    whatever has arrived when the timeout ends.
+
+    A query identical to one still waiting for answers is not sent again; the
+    caller gets the same future. A query whose publish_fn() returns False was
+    not sent; its future fails with RequestNotSent straight away, and nothing
+    waits on it.
+    """
+    def __init__(self, timeout=2.0):
+        self.timeout = timeout
+        self._device_requests = {}
+        self._group_requests = {}
+        self.sent = 0
+        self.coalesced = 0
+        self.not_sent = 0
+
+    def request_device(self, kind, device_id, publish_fn):
+        """Query one receiver; publish_fn() sends the query if none is in flight"""
+        return self._request(self._device_requests, (kind, device_id), kind, None, publish_fn)
+
+    def request_group(self, kind, group, members, publish_fn):
+        """Query a group of receivers, e.g. a seat
+
+        members: device IDs expected to answer, or None to take answers from
+        any receiver until the timeout.
+        """
+        return self._request(self._group_requests, (kind, group), kind, members, publish_fn)
+
+    def _request(self, requests, key, kind, members, publish_fn):
+        pending = requests.get(key)
+        if pending is not None:
+            self.coalesced += 1
+            logger.debug("Joining %s request already in flight to %s", kind, key[1])
+            return pending.result
+
+        pending = PendingRequest(kind, None if members is None else set(members))
+        requests[key] = pending
+        if publish_fn() is False:
+            del requests[key]
+            self.not_sent += 1
+            pending.result.set_exception(RequestNotSent("%s request to %s was not sent" % (kind, key[1])))
+            return pending.result
+        self.sent += 1
+        if pending.members is not None and not pending.members:
+            self._finish(requests, key, pending)
+        else:
+            pending.timer = gevent.spawn_later(self.timeout, self._expire, requests, key, pending)
+        return pending.result
+
+    def response(self, device_id, data):
+        """Resolve the requests a decoded response answers"""
+        for kind, response_key in RESPONSE_KEYS.items():
+            if response_key not in data:
+                continue
+
+            pending = self._device_requests.get((kind, device_id))
+            if pending is not None:
+                self._finish(self._device_requests, (kind, device_id), pending, data)
+
+            for key, pending in list(self._group_requests.items()):
+                if key[0] != kind:
+                    continue
+                if pending.members is None:
+                    pending.responses[device_id] = data
+                elif device_id in pending.members:
+                    pending.responses[device_id] = data
+                    if len(pending.responses) == len(pending.members):
+                        self._finish(self._group_requests, key, pending)
+
+    def cancel_device(self, device_id):
+        """Fail the requests waiting on one receiver, so the next query to it is sent afresh
+
+        For when the receiver reconnects: its answers to earlier queries are lost.
+        """
+        for kind in RESPONSE_KEYS:
+            pending = self._device_requests.pop((kind, device_id), None)
+            if pending is not None:
+                self._cancel(pending)
+
+    def cancel_all(self):
+        for requests in (self._device_requests, self._group_requests):
+            for pending in requests.values():
+                self._cancel(pending)
+            requests.clear()
+
+    @property
+    def in_flight(self):
+        return len(self._device_requests) + len(self._group_requests)
+
+    def stats(self):
+        return {'sent': self.sent, 'coalesced': self.coalesced, 'not_sent': self.not_sent,
+                'in_flight': self.in_flight}
+
+    def _cancel(self, pending):
+        if pending.timer is not None:
+            pending.timer.kill(block=False)
+        if not pending.result.ready():
+            pending.result.set_exception(RequestTimeout("Request cancelled"))
+
+    def _finish(self, requests, key, pending, data=None):
+        del requests[key]
+        if pending.timer is not None and pending.timer is not gevent.getcurrent():
+            pending.timer.kill(block=False)
+        if data is not None:
+            pending.result.set(data)
+        else:
+            pending.result.set(pending.responses)
+
+    def _expire(self, requests, key, pending):
+        if requests.get(key) is not pending:
+            return
+        if requests is self._device_requests:
+            del requests[key]
+            pending.result.set_exception(RequestTimeout("No %s response from %s" % (key[0], key[1])))
+        else:
+            logger.debug("%s request to %s answered by %d receivers", key[0], key[1], len(pending.responses))
+            self._finish(requests, key, pending)
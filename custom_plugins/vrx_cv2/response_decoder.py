@@ -0,0 +1,104 @@
+'''Decoding of CVCM responses into VRx device state'''
+
+import json
+import logging
+
+logger = logging.getLogger(__name__)
+
+# orjson is optional; it decodes the small CVCM payloads several times faster
+try:
+    import orjson #pylint: disable=import-error
+except ImportError:
+    orjson = None
+
+if orjson is not None:
+    json_loads = orjson.loads
+    JSON_BACKEND = "orjson"
+else:
+    json_loads = json.loads
+    JSON_BACKEND = "json"
+
+def _seat_number(value):
+    if not isinstance(value, str):
+        raise TypeError("seat is not a string: %r"%(value,))
+    if not value.isnumeric():
+        raise ValueError("seat is not a number: %s"%value)
+    return int(value)
+
+# CVCM response key => ((device attribute, converter), ...)
+# Attributes under extended_properties are dict keys, the rest are attribute paths.
+# A converter raising ValueError, IndexError, KeyError, TypeError or
+# AttributeError skips the field, e.g. a value of the wrong type.
+RESPONSE_SCHEMA = {
+    "device_name": (("name", None),),
+    "ip_addr": (("address", None),),
+    "seat": (("map.seat", _seat_number),),
+    "lock": (("extended_properties.chosen_camera_type", lambda lock: lock[0]),
+             ("extended_properties.cam_forced_or_auto", lambda lock: lock[1]),
+             ("video_lock", lambda lock: lock[2] == "L")),
+    "video_format": (("extended_properties.video_format", None),),
+    "cv_version": (("extended_properties.cv_version", None),),
+    "cvcm_version": (("extended_properties.cvcm_version", None),),
+    "device_type": (("extended_properties.device_type", None),),
+    "osd_visibility": (("extended_properties.osd_visibility", None),),
+}
+
+_MISSING = object()
+
+def _compile(schema):
+    compiled = {}
+    for key, targets in schema.items():
+        compiled[key] = []
+        for path, converter in targets:
+            parts = path.split('.')
+            if parts[0] == "extended_properties":
+                compiled[key].append((path, converter, None, parts[1]))
+            else:
+                compiled[key].append((path, converter, parts[:-1], parts[-1]))
+    return compiled
+
+class ResponseDecoder:
+    """Applies decoded CVCM responses to devices and reports what changed"""
+    def __init__(self, schema=RESPONSE_SCHEMA):
+        self._schema = _compile(schema)
+
+    def decode(self, payload):
+        """Decode a response payload. Raises ValueError if it isn't a JSON object"""
+        data = json_loads(payload)
+        if not isinstance(data, dict):
+            raise ValueError("Response is not a JSON object")
+        return data
+
+    def apply(self, device, data):
+        """Set device attributes from a decoded response
+
+        Returns a dict of attribute path to new value for the attributes that changed.
+        """
+        changed = {}
+        for key, value in data.items():
+            targets = self._schema.get(key)
+            if targets is None:
+                continue
+            for path, converter, parents, name in targets:
+                if converter is not None:
+                    try:
+                        value_out = converter(value)
+                    except (ValueError, IndexError, KeyError, TypeError, AttributeError):
+                        logger.debug("Ignoring '%s' of %r from %s", key, value, device.id)
+                        continue
+                else:
+                    value_out = value
+
+                if parents is None:
+                    properties = device.extended_properties
+                    if properties.get(name, _MISSING) != value_out:
+                        properties[name] = value_out
+                        changed[path] = value_out
+                else:
+                    obj = device
+                    for parent in parents:
+                        obj = getattr(obj, parent)
+                    if getattr(obj, name, _MISSING) != value_out:
+                        setattr(obj, name, value_out)
+                        changed[path] = value_out
+        return changed
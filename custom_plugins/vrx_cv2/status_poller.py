@@ -0,0 +1,162 @@
+'''Per-receiver status polling'''
+
+import heapq
+import logging
+import random
+import gevent
+import gevent.event
+from monotonic import monotonic
+
+logger = logging.getLogger(__name__)
+
+# Interval change after a poll whose answers changed the state, and after one whose didn't
+SPEED_UP = 0.5
+BACK_OFF = 1.5
+
+class StatusPoller:
+    """Polls each receiver at its own pace
+
+    A receiver whose reported state keeps changing is polled more often, down
+    to min_interval; one that stays the same is polled less often, up to
+    max_interval. While a race is running every interval is multiplied by
+    race_factor. Each poll time is spread by +/- jitter of the interval so
+    receivers don't all get asked at once.
+
+    poll_fn(device_id) sends the queries for one receiver. A poll may send
+    several, so observe() only notes each answer; the interval is adjusted
+    once per poll, from all of them, when the next poll comes due.
+    """
+    def __init__(self, poll_fn, min_interval=5.0, max_interval=60.0, race_factor=4.0, jitter=0.2):
+        self._poll = poll_fn
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.race_factor = race_factor
+        self.jitter = jitter
+        self.racing = False
+
+        self._interval = {}
+        self._due = {}
+        self._changed = {}
+        self._heap = []
+        self._wakeup = gevent.event.Event()
+        self._worker = None
+        self.polls = 0
+
+    def start(self):
+        if self._worker is None:
+            self._worker = gevent.spawn(self._run)
+
+    def stop(self):
+        if self._worker is not None:
+            self._worker.kill(block=False)
+            self._worker = None
+
+    def add(self, device_id):
+        """Start polling a receiver, at the fastest rate until its state settles"""
+        self._interval[device_id] = self.min_interval
+        self._schedule(device_id, monotonic() + self._delay(device_id))
+
+    def remove(self, device_id):
+        self._interval.pop(device_id, None)
+        self._due.pop(device_id, None)
+        self._changed.pop(device_id, None)
+
+    def observe(self, device_id, changed):
+        """Note whether a response changed a receiver's state, for its next interval"""
+        if device_id in self._interval:
+            self._changed[device_id] = self._changed.get(device_id, False) or changed
+
+    def nudge(self, device_id, within=None):
+        """Poll a receiver soon, e.g. after it changes seat, and from then on at the fastest rate"""
+        if device_id not in self._interval:
+            return
+        self._interval[device_id] = self.min_interval
+        self._changed.pop(device_id, None)
+        if within is None:
+            within = self.min_interval
+        due = monotonic() + random.uniform(0, within)
+        if due < self._due.get(device_id, due + 1):
+            self._schedule(device_id, due)
+
+    def nudge_all(self, within=None):
+        """Poll every receiver soon, spread over the window"""
+        if self.racing:
+            return
+        for device_id in list(self._interval):
+            self.nudge(device_id, within)
+
+    def set_racing(self, racing):
+        """Slow polling down while a race runs; every receiver is rescheduled at the new pace"""
+        if racing == self.racing:
+            return
+        self.racing = racing
+        for device_id in list(self._interval):
+            self._schedule(device_id, monotonic() + self._delay(device_id))
+
+    def __contains__(self, device_id):
+        return device_id in self._interval
+
+    @property
+    def devices(self):
+        return len(self._interval)
+
+    def stats(self):
+        return {
+            'devices': len(self._interval),
+            'polls': self.polls,
+            'racing': self.racing,
+            'mean_interval_s': sum(self._interval.values()) / len(self._interval) if self._interval else None,
+        }
+
+    def _delay(self, device_id):
+        interval = self._interval[device_id]
+        if self.racing:
+            interval *= self.race_factor
+        return interval * random.uniform(1 - self.jitter, 1 + self.jitter)
+
+    def _schedule(self, device_id, due):
+        self._due[device_id] = due
+        earliest = self._heap[0][0] if self._heap else None
+        heapq.heappush(self._heap, (due, device_id))
+        if earliest is None or due < earliest:
+            self._wakeup.set()
+
+    def _pop_due(self, now):
+        """Device IDs whose poll time has come. Entries superseded by a later _schedule are skipped"""
+        due_devices = []
+        while self._heap and self._heap[0][0] <= now:
+            due, device_id = heapq.heappop(self._heap)
+            if self._due.get(device_id) == due:
+                due_devices.append(device_id)
+        return due_devices
+
+    def _adjust(self, device_id):
+        """Set the interval from the answers to the last poll; none, e.g. from a silent receiver, leaves it"""
+        changed = self._changed.pop(device_id, None)
+        if changed is None:
+            return
+        interval = self._interval[device_id]
+        if changed:
+            self._interval[device_id] = max(self.min_interval, interval * SPEED_UP)
+        else:
+            self._interval[device_id] = min(self.max_interval, interval * BACK_OFF)
+
+    def poll_due(self, now=None):
+        """Poll the receivers whose time has come. Returns the seconds until the next poll"""
+        if now is None:
+            now = monotonic()
+        for device_id in self._pop_due(now):
+            self._adjust(device_id)
+            self._schedule(device_id, monotonic() + self._delay(device_id))
+            self.polls += 1
+            try:
+                self._poll(device_id)
+            except Exception:
+                logger.exception("Failed to poll %s", device_id)
+        return max(0, self._heap[0][0] - monotonic()) if self._heap else self.max_interval
+
+    def _run(self):
+        while True:
+            wait = self.poll_due()
+            self._wakeup.wait(timeout=wait)
+            self._wakeup.clear()